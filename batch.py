@@ -0,0 +1,389 @@
+'''
+Lockstep batch emulator: N machines ("lanes") whose registers and memory live in NumPy arrays,
+for running the same routine (checksums, codecs, ...) over many input data sets at once.
+Every step executes one instruction in every running lane. Lanes whose PCs diverged are grouped by op-code,
+so each op-code present in the batch costs one vectorized handler call over the lanes (a mask) executing it.
+
+Requires NumPy. Implements the op-codes CPU implements, with documented 6502 semantics and CPU's cycle counts.
+There is no scheduler and there are no IRQ / NMI lines: interrupt() starts the interrupt sequence in the given lanes.
+'''
+import numpy as np
+
+import execution
+import flags
+from flags import *
+from blockcache import instructionLengths
+from cpu import CPU, RunResult
+from memory import Memory
+
+opcodeTable = {opcode: (operation, mode, cycles, pageCrossPenalty)
+               for opcode, operation, mode, cycles, pageCrossPenalty in execution.opcodeTable}
+"""
+op-code -> (mnemonic, addressing mode, base cycles, page-cross penalty), taken from execution.opcodeTable,
+so BatchCPU implements the same op-codes as CPU, with the same cycle counts
+"""
+
+storeRegisters = {"STA": "a", "STX": "x", "STY": "y"}
+loadRegisters = {"LDA": "a", "LDX": "x", "LDY": "y"}
+compareRegisters = {"CMP": "a", "CPX": "x", "CPY": "y"}
+transfers = {"TAX": ("a", "x"), "TAY": ("a", "y"), "TSX": ("sp", "x"), "TXA": ("x", "a"), "TYA": ("y", "a")}
+branchConditions = {
+    "BCC": (CARRY, False), "BCS": (CARRY, True), "BEQ": (ZERO, True), "BMI": (NEGATIVE, True),
+    "BNE": (ZERO, False), "BPL": (NEGATIVE, False), "BVC": (OVERFLOW, False), "BVS": (OVERFLOW, True)
+}
+
+class BatchCPU:
+    '''
+    lanes machines in lockstep. Registers are int32 arrays of shape (lanes,), memory a uint8 array of shape (lanes, 65536).
+    A lane stops (see stopReasons) at an unimplemented op-code, and in runUntil also at traps and BRKs;
+    stopped lanes are skipped by later steps.
+    '''
+    def __init__(self, lanes):
+        self.lanes = lanes
+        self.memory = np.zeros((lanes, 65536), dtype=np.uint8)
+        self.memory[:, 0xFFFC] = 0x00
+        self.memory[:, 0xFFFD] = 0x10
+        self.a = np.zeros(lanes, dtype=np.int32)
+        self.x = np.zeros(lanes, dtype=np.int32)
+        self.y = np.zeros(lanes, dtype=np.int32)
+        self.sp = np.zeros(lanes, dtype=np.int32)
+        self.pc = np.zeros(lanes, dtype=np.int32)
+        self.p = np.zeros(lanes, dtype=np.int32)
+        self.cycles = np.zeros(lanes, dtype=np.int64)
+        self.instructions = np.zeros(lanes, dtype=np.int64)
+        self.running = np.ones(lanes, dtype=bool)
+        self.stopReasons = [None for i in range(lanes)]
+        """
+        None for running lanes, else one of the RunResult.STOP_* strings
+        """
+
+        self._znFlags = np.array(znFlags, dtype=np.int32)
+        self._handlers = [None for i in range(256)]
+        for opcode, (mnemonic, mode, cycles, pageCrossPenalty) in opcodeTable.items():
+            self._handlers[opcode] = self._buildHandler(opcode, mnemonic, mode, cycles, pageCrossPenalty)
+
+    @classmethod
+    def fromCPUs(cls, cpus):
+        '''
+        builds a batch with one lane per CPU, copying registers and memory
+        '''
+        batch = cls(len(cpus))
+        for lane, cpu in enumerate(cpus):
+            batch.memory[lane] = np.frombuffer(cpu._memory.snapshot(), dtype=np.uint8)
+            batch.a[lane], batch.x[lane], batch.y[lane] = cpu.a, cpu.x, cpu.y
+            batch.sp[lane], batch.pc[lane], batch.p[lane] = cpu.sp, cpu.pc, cpu.p
+        return batch
+
+    def toCPU(self, lane, checked=True):
+        '''
+        returns a CPU (on a new Memory) holding lane's state
+        '''
+        memory = Memory(checked=checked)
+        memory.setBytes(0, self.memory[lane].tobytes())
+        cpu = CPU(memory, checked=checked)
+        cpu.a, cpu.x, cpu.y = int(self.a[lane]), int(self.x[lane]), int(self.y[lane])
+        cpu.sp, cpu.pc, cpu.p = int(self.sp[lane]), int(self.pc[lane]), int(self.p[lane])
+        cpu._clockCycle = int(self.cycles[lane])
+        return cpu
+
+    def setBytes(self, addrStart, valArray, lanes=None):
+        '''
+        copies valArray to addrStart in every lane (or the lanes given as indices / mask)
+        '''
+        data = np.frombuffer(bytes(valArray), dtype=np.uint8)
+        if lanes is None: self.memory[:, addrStart:addrStart + len(data)] = data
+        else: self.memory[lanes, addrStart:addrStart + len(data)] = data
+
+    def getBytes(self, lane, addrStart, length):
+        return self.memory[lane, addrStart:addrStart + length].tobytes()
+
+    def reset(self):
+        '''
+        the 6502 reset procedure in every lane, see CPU.reset
+        '''
+        self.pc[:] = self.memory[:, 0xFFFC].astype(np.int32) | self.memory[:, 0xFFFD].astype(np.int32) << 8
+        self.sp[:] = 0xFD
+        self.cycles += 8
+
+    def interrupt(self, vector, lanes=None):
+        '''
+        CPU.interrupt in every lane (or the lanes given as indices / mask): pushes PC and P, sets the interrupt
+        disable flag and jumps to the address stored at vector (nmiVector or irqVector). Like CPU.interrupt,
+        this doesn't check the interrupt disable flag; pass the lanes taking the IRQ, e.g. mask=(batch.p & INTERRUPT) == 0.
+        '''
+        lanes = np.arange(self.lanes) if lanes is None else np.arange(self.lanes)[lanes]
+        sp = self.sp[lanes]
+        pc = self.pc[lanes]
+        self.memory[lanes, 0x100 + sp] = pc >> 8
+        self.memory[lanes, 0x100 + ((sp + 0xFF) & 0xFF)] = pc & 0xFF
+        self.memory[lanes, 0x100 + ((sp + 0xFE) & 0xFF)] = self.p[lanes] & ~(BREAK | UNUSED)
+        self.sp[lanes] = (sp + 0xFD) & 0xFF
+        self.p[lanes] |= INTERRUPT
+        self.pc[lanes] = self.memory[lanes, vector].astype(np.int32) | self.memory[lanes, vector + 1].astype(np.int32) << 8
+        self.cycles[lanes] += 7
+
+    def runSingleInstructionCycle(self, mask=None):
+        '''
+        runs one instruction in every running lane (and in mask, if given).
+        Returns the clock cycles used per lane, 0 for lanes which didn't run.
+        '''
+        run = self.running if mask is None else self.running & mask
+        lanes = np.flatnonzero(run)
+        cyclesBefore = self.cycles.copy()
+        if len(lanes):
+            opcodes = self.memory[lanes, self.pc[lanes]]
+            for opcode in np.unique(opcodes):
+                opcodeLanes = lanes[opcodes == opcode]
+                handler = self._handlers[opcode]
+                if handler is None: self._stop(opcodeLanes, RunResult.STOP_UNIMPLEMENTED)
+                else:
+                    handler(opcodeLanes)
+                    self.instructions[opcodeLanes] += 1
+        return self.cycles - cyclesBefore
+
+    def runUntil(self, maxInstructions, trap=True, brk=True):
+        '''
+        steps all running lanes until every lane stopped or ran maxInstructions instructions,
+        stopping lanes at traps (an instruction leaving PC unchanged) and before BRKs like CPU.runUntil.
+        Returns stopReasons.
+        '''
+        for i in range(maxInstructions):
+            lanes = np.flatnonzero(self.running)
+            if not len(lanes): break
+            if brk:
+                brkLanes = lanes[self.memory[lanes, self.pc[lanes]] == 0x00]
+                self._stop(brkLanes, RunResult.STOP_BRK)
+            pcBefore = self.pc.copy()
+            self.runSingleInstructionCycle()
+            if trap: self._stop(np.flatnonzero(self.running & (self.pc == pcBefore)), RunResult.STOP_TRAP)
+        for lane in np.flatnonzero(self.running): self.stopReasons[lane] = RunResult.STOP_MAX_INSTRUCTIONS
+        return self.stopReasons
+
+    def _stop(self, lanes, reason):
+        self.running[lanes] = False
+        for lane in lanes: self.stopReasons[lane] = reason
+
+    # addressing modes, all take an array of lane indices
+    def _operand8(self, lanes):
+        return self.memory[lanes, (self.pc[lanes] + 1) & 0xFFFF].astype(np.int32)
+
+    def _operand16(self, lanes):
+        pc = self.pc[lanes]
+        return self.memory[lanes, (pc + 1) & 0xFFFF].astype(np.int32) | self.memory[lanes, (pc + 2) & 0xFFFF].astype(np.int32) << 8
+
+    def _pointer(self, lanes, zeroPageAddr):
+        return self.memory[lanes, zeroPageAddr].astype(np.int32) | self.memory[lanes, (zeroPageAddr + 1) & 0xFF].astype(np.int32) << 8
+
+    def _address(self, lanes, mode):
+        '''
+        returns (effective address, page crossed) arrays
+        '''
+        if mode == "zeroPage": return self._operand8(lanes), None
+        if mode == "zeroPageX": return (self._operand8(lanes) + self.x[lanes]) & 0xFF, None
+        if mode == "zeroPageY": return (self._operand8(lanes) + self.y[lanes]) & 0xFF, None
+        if mode == "absolute": return self._operand16(lanes), None
+        if mode == "indirectX": return self._pointer(lanes, (self._operand8(lanes) + self.x[lanes]) & 0xFF), None
+
+        if mode == "absoluteX": base, index = self._operand16(lanes), self.x[lanes]
+        elif mode == "absoluteY": base, index = self._operand16(lanes), self.y[lanes]
+        elif mode == "indirectY": base, index = self._pointer(lanes, self._operand8(lanes)), self.y[lanes]
+        else: raise ValueError("no effective address in addressing mode " + mode)
+        addr = (base + index) & 0xFFFF
+        return addr, (base >> 8) != (addr >> 8)
+
+    def _read(self, lanes, mode, cycles, pageCrossPenalty):
+        '''
+        returns the operand of a reading instruction and adds its cycles, plus one where indexing crossed a page
+        if the op-code has a page-cross penalty
+        '''
+        if mode == "immediate":
+            self.cycles[lanes] += cycles
+            return self._operand8(lanes)
+        addr, crossed = self._address(lanes, mode)
+        self.cycles[lanes] += cycles
+        if pageCrossPenalty and crossed is not None: self.cycles[lanes[crossed]] += 1
+        return self.memory[lanes, addr].astype(np.int32)
+
+    def _setZN(self, lanes, values):
+        self.p[lanes] = (self.p[lanes] & ~ZN) | self._znFlags[values]
+
+    def _buildHandler(self, opcode, mnemonic, mode, cycles, pageCrossPenalty):
+        '''
+        returns handler(lanes), executing the op-code in the given lanes
+        '''
+        length = instructionLengths[opcode]
+
+        def advance(lanes):
+            self.pc[lanes] = (self.pc[lanes] + length) & 0xFFFF
+
+        if mnemonic in loadRegisters:
+            register = getattr(self, loadRegisters[mnemonic])
+            def execute(lanes):
+                values = self._read(lanes, mode, cycles, pageCrossPenalty)
+                register[lanes] = values
+                self._setZN(lanes, values)
+                advance(lanes)
+
+        elif mnemonic in ("ORA", "AND", "EOR"):
+            operation = {"ORA": np.bitwise_or, "AND": np.bitwise_and, "EOR": np.bitwise_xor}[mnemonic]
+            def execute(lanes):
+                values = operation(self.a[lanes], self._read(lanes, mode, cycles, pageCrossPenalty))
+                self.a[lanes] = values
+                self._setZN(lanes, values)
+                advance(lanes)
+
+        elif mnemonic in ("ADC", "SBC"):
+            subtract = mnemonic == "SBC"
+            def execute(lanes):
+                operand = self._read(lanes, mode, cycles, pageCrossPenalty)
+                p = self.p[lanes]
+                index = (p & CARRY) << 16 | self.a[lanes] << 8
+                binary = np.frombuffer(flags.adcTable, dtype=np.uint16)
+                if subtract:
+                    entries = binary[index | (operand ^ 0xFF)]
+                    decimalTable = np.frombuffer(flags.sbcDecimalTable, dtype=np.uint16)
+                else:
+                    entries = binary[index | operand]
+                    decimalTable = np.frombuffer(flags.adcDecimalTable, dtype=np.uint16)
+                decimal = (p & DECIMAL) != 0
+                if decimal.any(): entries = np.where(decimal, decimalTable[index | operand], entries)
+                entries = entries.astype(np.int32)
+                self.a[lanes] = entries & 0xFF
+                self.p[lanes] = (p & ~ZNCV) | (entries >> 8)
+                advance(lanes)
+
+        elif mnemonic in compareRegisters:
+            register = getattr(self, compareRegisters[mnemonic])
+            def execute(lanes):
+                operand = self._read(lanes, mode, cycles, pageCrossPenalty)
+                compareTable = np.frombuffer(flags.compareTable, dtype=np.uint8)
+                self.p[lanes] = (self.p[lanes] & ~ZNC) | compareTable[register[lanes] << 8 | operand]
+                advance(lanes)
+
+        elif mnemonic in storeRegisters:
+            register = getattr(self, storeRegisters[mnemonic])
+            def execute(lanes):
+                addr, crossed = self._address(lanes, mode)
+                self.memory[lanes, addr] = register[lanes]
+                self.cycles[lanes] += cycles
+                advance(lanes)
+
+        elif mnemonic == "INC":
+            def execute(lanes):
+                addr, crossed = self._address(lanes, mode)
+                values = (self.memory[lanes, addr].astype(np.int32) + 1) & 0xFF
+                self.memory[lanes, addr] = values
+                self._setZN(lanes, values)
+                self.cycles[lanes] += cycles
+                advance(lanes)
+
+        elif mnemonic in ("DEX", "DEY"):
+            register = self.x if mnemonic == "DEX" else self.y
+            def execute(lanes):
+                values = (register[lanes] + 0xFF) & 0xFF
+                register[lanes] = values
+                self._setZN(lanes, values)
+                self.cycles[lanes] += cycles
+                advance(lanes)
+
+        elif mnemonic in transfers:
+            origin, destination = (getattr(self, register) for register in transfers[mnemonic])
+            def execute(lanes):
+                values = origin[lanes]
+                destination[lanes] = values
+                self._setZN(lanes, values)
+                self.cycles[lanes] += cycles
+                advance(lanes)
+
+        elif mnemonic == "TXS":
+            def execute(lanes):
+                self.sp[lanes] = self.x[lanes]
+                self.cycles[lanes] += cycles
+                advance(lanes)
+
+        elif mnemonic in ("PHA", "PHP"):
+            def execute(lanes):
+                sp = self.sp[lanes]
+                if mnemonic == "PHA": self.memory[lanes, 0x100 + sp] = self.a[lanes]
+                else: self.memory[lanes, 0x100 + sp] = self.p[lanes] & ~(BREAK | UNUSED)
+                self.sp[lanes] = (sp + 0xFF) & 0xFF
+                self.cycles[lanes] += cycles
+                advance(lanes)
+
+        elif mnemonic in ("PLA", "PLP"):
+            def execute(lanes):
+                sp = (self.sp[lanes] + 1) & 0xFF
+                values = self.memory[lanes, 0x100 + sp].astype(np.int32)
+                if mnemonic == "PLA":
+                    self.a[lanes] = values
+                    self._setZN(lanes, values)
+                else: self.p[lanes] = (self.p[lanes] & (BREAK | UNUSED)) | (values & ~(BREAK | UNUSED))
+                self.sp[lanes] = sp
+                self.cycles[lanes] += cycles
+                advance(lanes)
+
+        elif mode == "relative":
+            flag, taken = branchConditions[mnemonic]
+            def execute(lanes):
+                takenLanes = ((self.p[lanes] & flag) != 0) == taken
+                nextPC = (self.pc[lanes] + 2) & 0xFFFF
+                offset = self._operand8(lanes)
+                target = (nextPC + offset - ((offset & 0x80) << 1)) & 0xFFFF
+                self.pc[lanes] = np.where(takenLanes, target, nextPC)
+                crossed = takenLanes & ((nextPC >> 8) != (target >> 8)) if pageCrossPenalty else 0
+                self.cycles[lanes] += cycles + takenLanes + crossed
+        elif mnemonic == "JMP" and mode == "absolute":
+            def execute(lanes):
+                self.pc[lanes] = self._operand16(lanes)
+                self.cycles[lanes] += cycles
+        elif mnemonic == "JMP":
+            def execute(lanes):
+                pointer = self._operand16(lanes)
+                # the 6502 doesn't carry into the high byte of the pointer
+                hiAddr = (pointer & 0xFF00) | ((pointer + 1) & 0xFF)
+                self.pc[lanes] = self.memory[lanes, pointer].astype(np.int32) | self.memory[lanes, hiAddr].astype(np.int32) << 8
+                self.cycles[lanes] += cycles
+        elif mnemonic == "JSR":
+            def execute(lanes):
+                # pushes the address of the last byte of the JSR, high byte first
+                returnAddr = (self.pc[lanes] + 2) & 0xFFFF
+                sp = self.sp[lanes]
+                self.memory[lanes, 0x100 + sp] = returnAddr >> 8
+                self.memory[lanes, 0x100 + ((sp + 0xFF) & 0xFF)] = returnAddr & 0xFF
+                self.sp[lanes] = (sp + 0xFE) & 0xFF
+                self.pc[lanes] = self._operand16(lanes)
+                self.cycles[lanes] += cycles
+        elif mnemonic == "RTS":
+            def execute(lanes):
+                sp = self.sp[lanes]
+                addr = self.memory[lanes, 0x100 + ((sp + 1) & 0xFF)].astype(np.int32) | self.memory[lanes, 0x100 + ((sp + 2) & 0xFF)].astype(np.int32) << 8
+                self.sp[lanes] = (sp + 2) & 0xFF
+                self.pc[lanes] = (addr + 1) & 0xFFFF
+                self.cycles[lanes] += cycles
+        elif mnemonic == "RTI":
+            def execute(lanes):
+                # pulls P, then PC, as pushed by interrupt()
+                sp = self.sp[lanes]
+                values = self.memory[lanes, 0x100 + ((sp + 1) & 0xFF)].astype(np.int32)
+                self.p[lanes] = (self.p[lanes] & (BREAK | UNUSED)) | (values & ~(BREAK | UNUSED))
+                self.pc[lanes] = self.memory[lanes, 0x100 + ((sp + 2) & 0xFF)].astype(np.int32) | self.memory[lanes, 0x100 + ((sp + 3) & 0xFF)].astype(np.int32) << 8
+                self.sp[lanes] = (sp + 3) & 0xFF
+                self.cycles[lanes] += cycles
+
+        elif mnemonic in ("CLI", "SEI"):
+            def execute(lanes):
+                if mnemonic == "CLI": self.p[lanes] &= ~INTERRUPT
+                else: self.p[lanes] |= INTERRUPT
+                self.cycles[lanes] += cycles
+                advance(lanes)
+        elif mnemonic == "CLD":
+            def execute(lanes):
+                self.p[lanes] &= ~DECIMAL
+                self.cycles[lanes] += cycles
+                advance(lanes)
+        elif mnemonic == "NOP":
+            def execute(lanes):
+                self.cycles[lanes] += cycles
+                advance(lanes)
+        else: raise ValueError("no batch handler for " + mnemonic)
+        return execute
@@ -0,0 +1,248 @@
+'''
+Throughput benchmark suite. Writes machine-readable JSON that can be compared between commits:
+
+python bench.py --output before.json
+... change things ...
+python bench.py --output after.json
+python bench.py --compare before.json after.json
+
+Groups:
+- opcode:          every implemented op-code, repeated in a straight line followed by a JMP back
+- addressingMode:  LDA in each of its addressing modes
+- branch:          branch heavy loops
+- memcopy:         memory copy loops (absolute indexed and indirect indexed)
+- functionalTest:  testProgram/6502_functional_test.bin from 0x400
+
+Every benchmark reports emulated MHz and instructions per second from one CPU.runUntil run,
+and p50 / p99 per-instruction latency from stepping runSingleInstructionCycle.
+'''
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from blockcache import instructionLengths
+from cpu import CPU, StopCondition, RunResult
+from loader import load
+from memory import Memory
+
+DIR = os.path.dirname(os.path.abspath(__file__))
+FUNCTIONAL_TEST = os.path.join(DIR, "testProgram", "6502_functional_test.bin")
+
+PROGRAM_START = 0x1000
+DATA_START = 0x2000
+repeatCount = 64
+"""
+How often an op-code is repeated before the JMP back in the opcode group.
+"""
+
+def addressingMode(opcode):
+    '''
+    name of the addressing mode of a documented op-code, decoded from aaabbbcc like blockcache.instructionLength
+    '''
+    if opcode in (0x00, 0x40, 0x60): return "implied"
+    if opcode == 0x20: return "absolute"
+    if opcode == 0x6C: return "indirect"
+    if opcode & 0x1F == 0x10: return "relative"
+
+    cc = opcode & 0b11
+    bbb = (opcode >> 2) & 0b111
+    # LDX / STX index with Y instead of X
+    indexY = cc == 0b10 and opcode & 0xE0 in (0x80, 0xA0)
+    if cc == 0b01:
+        return ["indirectX", "zeroPage", "immediate", "absolute", "indirectY", "zeroPageX", "absoluteY", "absoluteX"][bbb]
+    if bbb == 0b000: return "immediate"
+    if bbb == 0b001: return "zeroPage"
+    if bbb == 0b010: return "accumulator" if cc == 0b10 and opcode < 0x80 else "implied"
+    if bbb == 0b011: return "absolute"
+    if bbb == 0b101: return "zeroPageY" if indexY else "zeroPageX"
+    if bbb == 0b110: return "implied"
+    return "absoluteY" if indexY else "absoluteX"
+
+def instructionBytes(opcode):
+    '''
+    op-code plus operands: zero page operands point at 0x10, which holds a pointer to DATA_START,
+    absolute operands point at DATA_START and branches branch to the next instruction
+    '''
+    length = instructionLengths[opcode]
+    if length == 1: return [opcode]
+    if length == 2: return [opcode, 0x00 if addressingMode(opcode) == "relative" else 0x10]
+    return [opcode, DATA_START & 0xFF, DATA_START >> 8]
+
+def jumpBack():
+    return [0x4C, PROGRAM_START & 0xFF, PROGRAM_START >> 8]
+
+class Benchmark:
+    '''
+    A program loaded at PROGRAM_START (or an image file), run in a loop.
+    '''
+    def __init__(self, name, group, program=None, imagePath=None, startPC=PROGRAM_START):
+        self.name = name
+        self.group = group
+        self.program = program
+        self.imagePath = imagePath
+        self.startPC = startPC
+
+    def setUp(self, useBlockCache, checked):
+        memory = Memory(checked=checked)
+        cpu = CPU(memory, useBlockCache=useBlockCache, checked=checked)
+        cpu.reset()
+        if self.imagePath is not None:
+            load(memory, self.imagePath)
+        else:
+            # pointers for the indirect modes, and something to copy
+            memory.setBytes(0x10, [DATA_START & 0xFF, DATA_START >> 8, 0x00, 0x30])
+            memory.setBytes(DATA_START, bytes(range(256)))
+            memory.setBytes(PROGRAM_START, self.program)
+        cpu.setPC(self.startPC)
+        return cpu
+
+def opcodeBenchmarks(opcodes):
+    # JMP, JSR, RTS, RTI and BRK can't be repeated in a straight line
+    skipped = (0x4C, 0x6C, 0x20, 0x60, 0x40, 0x00)
+    return [Benchmark("opcode " + format(opcode, "02X"), "opcode", instructionBytes(opcode) * repeatCount + jumpBack())
+            for opcode in sorted(opcodes) if opcode not in skipped]
+
+def addressingModeBenchmarks():
+    return [Benchmark("LDA " + addressingMode(opcode), "addressingMode", instructionBytes(opcode) * repeatCount + jumpBack())
+            for opcode in (0xA9, 0xA5, 0xB5, 0xAD, 0xBD, 0xB9, 0xA1, 0xB1)]
+
+def loopBenchmarks():
+    return [
+        # LDX #0, loop: DEX, BNE loop, JMP start
+        Benchmark("branch tight loop", "branch", [0xA2, 0x00, 0xCA, 0xD0, 0xFD] + jumpBack()),
+        # LDX #0, loop: ADC #$55, BCC +0, BMI +0, BVS +0, BEQ +0, DEX, BNE loop, JMP start
+        Benchmark("branch mixed", "branch", [0xA2, 0x00, 0x69, 0x55, 0x90, 0x00, 0x30, 0x00, 0x70, 0x00, 0xF0, 0x00, 0xCA, 0xD0, 0xF3] + jumpBack()),
+        # LDX #0, loop: LDA $2000,X, STA $3000,X, DEX, BNE loop, JMP start
+        Benchmark("memcopy absolute,X", "memcopy", [0xA2, 0x00, 0xBD, 0x00, 0x20, 0x9D, 0x00, 0x30, 0xCA, 0xD0, 0xF7] + jumpBack()),
+        # LDY #0, loop: LDA ($10),Y, STA ($12),Y, DEY, BNE loop, JMP start
+        Benchmark("memcopy (indirect),Y", "memcopy", [0xA0, 0x00, 0xB1, 0x10, 0x91, 0x12, 0x88, 0xD0, 0xF9] + jumpBack()),
+    ]
+
+def functionalTestBenchmarks():
+    return [Benchmark("functional test", "functionalTest", imagePath=FUNCTIONAL_TEST, startPC=0x400)]
+
+def allBenchmarks():
+    implemented = CPU(Memory())._implementedOpcodes
+    return opcodeBenchmarks(implemented) + addressingModeBenchmarks() + loopBenchmarks() + functionalTestBenchmarks()
+
+def percentile(sortedSamples, fraction):
+    return sortedSamples[min(len(sortedSamples) - 1, int(len(sortedSamples) * fraction))]
+
+def runBenchmark(benchmark, instructions, samples, useBlockCache=False, checked=False):
+    '''
+    returns a dict of results, or {"group": ..., "error": ...} if the benchmark's op-codes don't work yet
+    '''
+    # run everything, don't stop at traps or BRKs
+    condition = StopCondition(trap=False, brk=False)
+    try:
+        cpu = benchmark.setUp(useBlockCache, checked)
+        # warm up: builds the lazy flag tables and compiles blocks outside of the timed run
+        cpu.runUntil(condition, maxInstructions=min(instructions, 1000))
+        result = cpu.runUntil(condition, maxInstructions=instructions)
+        if result.reason != RunResult.STOP_MAX_INSTRUCTIONS:
+            return {"group": benchmark.group, "error": "stopped ({reason}) at {pc}".format(reason = result.reason, pc = hex(result.pc))}
+
+        cpu = benchmark.setUp(useBlockCache, checked)
+        latencies = []
+        step = cpu.runSingleInstructionCycle
+        clock = time.perf_counter_ns
+        for i in range(samples):
+            beginTime = clock()
+            step()
+            latencies.append(clock() - beginTime)
+    except Exception as error:
+        return {"group": benchmark.group, "error": repr(error)}
+
+    latencies.sort()
+    return {
+        "group": benchmark.group,
+        "instructions": result.instructions,
+        "cycles": result.cycles,
+        "seconds": result.wallTime,
+        "mhz": result.cycles / result.wallTime / 1000000,
+        "ips": result.instructionsPerSecond(),
+        "p50Ns": percentile(latencies, 0.5),
+        "p99Ns": percentile(latencies, 0.99)
+    }
+
+def gitCommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=DIR, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def runSuite(benchmarks, instructions=100000, samples=2000, useBlockCache=False, checked=False, log=None):
+    '''
+    runs benchmarks and returns the JSON-serializable report
+    '''
+    results = {}
+    for benchmark in benchmarks:
+        results[benchmark.name] = runBenchmark(benchmark, instructions, samples, useBlockCache, checked)
+        if log is not None: log(benchmark.name, results[benchmark.name])
+    return {
+        "meta": {
+            "commit": gitCommit(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_implementation() + " " + platform.python_version(),
+            "platform": platform.platform(),
+            "useBlockCache": useBlockCache,
+            "checked": checked,
+            "instructions": instructions,
+            "samples": samples
+        },
+        "results": results
+    }
+
+def formatResult(name, result):
+    if "error" in result: return "{name:<24} {error}".format(name = name, error = result["error"])
+    return "{name:<24} {mhz:8.3f} MHz {ips:12.0f} instructions/s   p50 {p50:6d}ns   p99 {p99:6d}ns".format(
+        name = name, mhz = result["mhz"], ips = result["ips"], p50 = result["p50Ns"], p99 = result["p99Ns"])
+
+def compare(base, new, threshold=0.05):
+    '''
+    compares the instructions per second of two reports.
+    Returns a list of (name, base ips, new ips, ratio, regressed) for benchmarks present and working in both.
+    '''
+    rows = []
+    for name, newResult in new["results"].items():
+        baseResult = base["results"].get(name)
+        if baseResult is None or "error" in baseResult or "error" in newResult: continue
+        ratio = newResult["ips"] / baseResult["ips"]
+        rows.append((name, baseResult["ips"], newResult["ips"], ratio, ratio < 1 - threshold))
+    return rows
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="6502 emulator throughput benchmarks")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--group", action="append", help="only run these groups (opcode, addressingMode, branch, memcopy, functionalTest)")
+    parser.add_argument("--instructions", type=int, default=100000, help="instructions per throughput run")
+    parser.add_argument("--samples", type=int, default=2000, help="instructions timed individually for p50 / p99")
+    parser.add_argument("--blocks", action="store_true", help="use the block cache")
+    parser.add_argument("--checked", action="store_true", help="run CPU and Memory in checked mode")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="compare two JSON reports instead of running")
+    parser.add_argument("--threshold", type=float, default=0.05, help="slowdown counted as a regression by --compare")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as file: base = json.load(file)
+        with open(args.compare[1]) as file: new = json.load(file)
+        rows = compare(base, new, args.threshold)
+        for name, baseIps, newIps, ratio, regressed in rows:
+            print("{name:<24} {base:12.0f} -> {new:12.0f} instructions/s  {ratio:6.2f}x{flag}".format(
+                name = name, base = baseIps, new = newIps, ratio = ratio, flag = "  REGRESSION" if regressed else ""))
+        return 1 if any(row[4] for row in rows) else 0
+
+    benchmarks = allBenchmarks()
+    if args.group: benchmarks = [benchmark for benchmark in benchmarks if benchmark.group in args.group]
+    report = runSuite(benchmarks, args.instructions, args.samples, args.blocks, args.checked,
+                      log=lambda name, result: print(formatResult(name, result)))
+    if args.output:
+        with open(args.output, "w") as file: json.dump(report, file, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,258 @@
+def instructionLength(opcode):
+    '''
+    returns the length in bytes (op-code + operands) of a documented 6502 instruction.
+    The addressing mode is encoded in the op-code as aaabbbcc:
+    - bbb = 011 and 111 are absolute modes (3 bytes), as is absolute,Y (cc = 01, bbb = 110)
+    - bbb = 010 and 110 are implied / accumulator (1 byte), except immediate (cc = 01, bbb = 010)
+    - everything else takes a single operand byte (2 bytes)
+    JSR, BRK, RTI and RTS are the exceptions.
+    '''
+    if opcode == 0x20: return 3
+    if opcode in (0x00, 0x40, 0x60): return 1
+
+    cc = opcode & 0b11
+    bbb = (opcode >> 2) & 0b111
+    if bbb in (0b011, 0b111) or (cc == 0b01 and bbb == 0b110): return 3
+    if bbb in (0b010, 0b110) and cc != 0b01: return 1
+    return 2
+
+instructionLengths = [instructionLength(i) for i in range(256)]
+
+blockEndOpcodes = frozenset([
+    0x10, 0x30, 0x50, 0x70, 0x90, 0xB0, 0xD0, 0xF0, # branches
+    0x4C, 0x6C,                                     # JMP
+    0x20, 0x60, 0x40, 0x00,                         # JSR, RTS, RTI, BRK
+    0x58,                                           # CLI, so a pending IRQ is taken right after it
+])
+"""
+Op-codes which change control flow and therefore end a block.
+"""
+
+memoryWriteOpcodes = frozenset([
+    0x85, 0x95, 0x8D, 0x9D, 0x99, 0x81, 0x91,       # STA
+    0x86, 0x96, 0x8E,                               # STX
+    0x84, 0x94, 0x8C,                               # STY
+    0xE6, 0xF6, 0xEE, 0xFE,                         # INC
+    0xC6, 0xD6, 0xCE, 0xDE,                         # DEC
+    0x06, 0x16, 0x0E, 0x1E,                         # ASL
+    0x46, 0x56, 0x4E, 0x5E,                         # LSR
+    0x26, 0x36, 0x2E, 0x3E,                         # ROL
+    0x66, 0x76, 0x6E, 0x7E,                         # ROR
+    0x08, 0x48,                                     # PHP, PHA
+])
+"""
+Op-codes which may write to memory, and thus may overwrite the block they are part of.
+"""
+
+branchOpcodes = frozenset([0x10, 0x30, 0x50, 0x70, 0x90, 0xB0, 0xD0, 0xF0])
+
+countingOpcodes = frozenset([
+    0xCA, 0x88, 0xE8, 0xC8,                         # DEX, DEY, INX, INY
+    0x69, 0x65, 0x75, 0x6D, 0x7D, 0x79, 0x61, 0x71, # ADC
+    0xE9, 0xE5, 0xF5, 0xED, 0xFD, 0xF9, 0xE1, 0xF1, # SBC
+    0x49, 0x45, 0x55, 0x4D, 0x5D, 0x59, 0x41, 0x51, # EOR
+    0x68, 0x28,                                     # PLA, PLP
+])
+"""
+Op-codes which change a register on (almost) every execution. Loops containing them are counting loops,
+not idle ones, so their blocks aren't checked for idling.
+"""
+
+class BlockCache:
+    '''
+    Caches straight-line runs of instructions ("blocks") compiled into a single python function.
+    A block starts at a PC and ends after the first branch, JMP or other control flow op-code,
+    or before the first unimplemented op-code or breakpoint.
+    Blocks are cached by start PC and dropped as soon as memory covered by them is written.
+    Operands are decoded once, when compiling, so a block calls its handlers with constant operands
+    and doesn't fetch anything. Blocks don't update currentInstruction.
+    Consecutive op-codes for which the CPU has a fused handler (CPU.fuseOpcodePairs) are run with a single call.
+    '''
+    maxBlockLength = 64
+
+    def __init__(self, cpu, memory):
+        self._cpu = cpu
+        self._memory = memory
+        self._blocks = {}
+        """
+        start PC -> (block function, end PC)
+        """
+        self._pageBlocks = [None for i in range(256)]
+        """
+        page -> set of start PCs of blocks covering that page
+        """
+        self._codeMap = bytearray(65536)
+        """
+        1 for every byte that is covered by at least one block
+        """
+        self.stale = False
+        """
+        set when a block was invalidated; a running block checks it after each memory write and returns early.
+        """
+        self._breakpointMap = bytes(65536)
+        """
+        copy of the breakpoint bitmap the blocks were compiled for
+        """
+
+        memory.addBulkWriteHook(self._onBulkWrite)
+
+    def getBlock(self, pc):
+        '''
+        returns the compiled block starting at pc, compiling it if necessary.
+        Calling it returns the number of instructions executed; block.length is the number it holds,
+        block.lastPC the address of its last instruction and block.idleCandidate tells whether it may be an idle loop.
+        Returns None if the op-code at pc is not implemented.
+        '''
+        block = self._blocks.get(pc)
+        if block is None:
+            block = self._compile(pc)
+            if block is None: return None
+        return block[0]
+
+    def setBreakpointMap(self, breakpointMap):
+        '''
+        makes blocks end before breakpoints in breakpointMap (see StopCondition), recompiling all blocks if it changed
+        '''
+        if self._breakpointMap == breakpointMap: return
+        self._breakpointMap = bytes(breakpointMap)
+        self.flush()
+
+    def _decode(self, pc):
+        '''
+        returns a list of (pc, op-code, operand) making up the block starting at pc
+        '''
+        cpu = self._cpu
+        fetch = self._memory.fetchByte
+        breakpointMap = self._breakpointMap
+        instructions = []
+        while len(instructions) < self.maxBlockLength:
+            if instructions and breakpointMap[pc]: break
+            opcode = fetch(pc)
+            if opcode not in cpu._implementedOpcodes: break
+
+            length = instructionLengths[opcode]
+            operand = 0
+            if length == 2: operand = fetch((pc + 1) & 0xFFFF)
+            elif length == 3: operand = fetch((pc + 1) & 0xFFFF) | fetch((pc + 2) & 0xFFFF) << 8
+            instructions.append((pc, opcode, operand))
+            pc += length
+            if opcode in blockEndOpcodes or pc > 0xFFFF: break
+        return instructions
+
+    def _compile(self, pc):
+        instructions = self._decode(pc)
+        if not instructions: return None
+
+        cpu = self._cpu
+        lut = cpu._decodeFunctionLookupTable
+        handlers = cpu._handlers
+        fusedHandlers = cpu._fusedHandlers
+        namespace = {"cpu": cpu, "cache": self}
+        source = ["def block():"]
+        # the decode stage happens here: PC and the operands are constants
+        i = 0
+        while i < len(instructions):
+            instructionPC, opcode, operand = instructions[i]
+            nextPC = (instructionPC + instructionLengths[opcode]) & 0xFFFF
+            fused = None
+            if i + 1 < len(instructions):
+                nextPC2, opcode2, operand2 = instructions[i + 1]
+                fused = fusedHandlers.get((opcode, opcode2))
+                # wrapped handlers (instrumentation, Profiler) have to see every instruction
+                if fused is not None and (lut[opcode] is not handlers[opcode] or lut[opcode2] is not handlers[opcode2]): fused = None
+
+            if fused is None:
+                namespace["h" + str(i)] = lut[opcode]
+                source.append("    cpu.pc = " + hex(nextPC))
+                source.append("    h" + str(i) + "(" + hex(operand) + ")")
+                i += 1
+            else:
+                namespace["h" + str(i)] = fused
+                call = "h" + str(i) + "(" + hex(operand) + ", " + hex(operand2) + ")"
+                if fused.writesFirst:
+                    # the first write may invalidate the block, the handler then returns True before the second op-code
+                    source.append("    cpu.pc = " + hex(nextPC))
+                    source.append("    if " + call + ": return " + str(i + 1))
+                else:
+                    source.append("    cpu.pc = " + hex((nextPC2 + instructionLengths[opcode2]) & 0xFFFF))
+                    source.append("    " + call)
+                opcode = opcode2
+                i += 2
+            if opcode in memoryWriteOpcodes and i < len(instructions):
+                source.append("    if cache.stale: return " + str(i))
+        source.append("    return " + str(len(instructions)))
+
+        exec(compile("\n".join(source), "<block " + hex(pc) + ">", "exec"), namespace)
+
+        lastPC, lastOpcode, lastOperand = instructions[-1]
+        endPC = min(lastPC + instructionLengths[lastOpcode], 0x10000)
+        function = namespace["block"]
+        function.lastPC = lastPC
+        function.length = len(instructions)
+        function.idleCandidate = self._loopsToItself(pc, instructions)
+        block = (function, endPC)
+        self._blocks[pc] = block
+
+        for addr in range(pc, endPC): self._codeMap[addr] = 1
+        for page in range(pc >> 8, ((endPC - 1) >> 8) + 1):
+            if self._pageBlocks[page] is None:
+                self._pageBlocks[page] = set()
+                self._memory.addWriteHook(page, self._onWrite)
+            self._pageBlocks[page].add(pc)
+        return block
+
+    def _loopsToItself(self, pc, instructions):
+        '''
+        True if the block ends with a branch or JMP back to its start and doesn't write memory,
+        so it may be an idle loop (see CPU.runUntil)
+        '''
+        lastPC, lastOpcode, lastOperand = instructions[-1]
+        if lastOpcode == 0x4C: target = lastOperand
+        elif lastOpcode in branchOpcodes: target = (lastPC + 2 + lastOperand - (lastOperand & 0x80) * 2) & 0xFFFF
+        else: return False
+        if target != pc: return False
+        return not any(opcode in memoryWriteOpcodes or opcode in countingOpcodes for instructionPC, opcode, operand in instructions)
+
+    def _onWrite(self, addr, val):
+        if self._codeMap[addr]: self.invalidate(addr, addr + 1)
+
+    def _onBulkWrite(self, addrStart, addrEnd):
+        self.invalidate(addrStart, addrEnd)
+
+    def invalidate(self, addrStart, addrEnd):
+        '''
+        drops every block overlapping [addrStart, addrEnd)
+        '''
+        for page in range(addrStart >> 8, min((addrEnd - 1) >> 8, 0xFF) + 1):
+            starts = self._pageBlocks[page]
+            if starts is None: continue
+            for start in list(starts):
+                block = self._blocks.get(start)
+                if block is not None and start < addrEnd and addrStart < block[1]:
+                    self._drop(start, block[1])
+
+    def flush(self):
+        '''
+        drops all blocks, e.g. after the decode lookup table changed
+        '''
+        for start, (block, end) in list(self._blocks.items()):
+            self._drop(start, end)
+
+    def _drop(self, start, end):
+        del self._blocks[start]
+        self.stale = True
+        codeMap = self._codeMap
+        codeMap[start:end] = bytes(end - start)
+        for page in range(start >> 8, ((end - 1) >> 8) + 1):
+            starts = self._pageBlocks[page]
+            starts.discard(start)
+            if not starts:
+                self._pageBlocks[page] = None
+                self._memory.removeWriteHook(page, self._onWrite)
+                continue
+            # bytes also covered by a block still cached stay marked
+            for otherStart in starts:
+                otherEnd = self._blocks[otherStart][1]
+                overlapStart = max(start, otherStart)
+                overlapEnd = min(end, otherEnd)
+                if overlapStart < overlapEnd: codeMap[overlapStart:overlapEnd] = b"\x01" * (overlapEnd - overlapStart)
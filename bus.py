@@ -0,0 +1,175 @@
+from memory import Memory
+
+RAM = "ram"
+ROM = "rom"
+MIRROR = "mirror"
+DEVICE = "device"
+
+def _ignoreWrite(addr, val): pass
+
+class Bus(Memory):
+    '''
+    Memory with a 256-entry page table: every 256-byte page is RAM (the default), ROM,
+    a mirror of other pages or a device with its own read / write callbacks.
+    Use it wherever a Memory is expected: CPU(Bus()).
+
+    Accessors only dispatch when they have to: ROM and devices without read callback are read from the backing RAM,
+    so getByte and fetchByte stay Memory's until a device with a read callback or a mirror is mapped, and setByte
+    until anything but RAM is. The dispatching variants are closures over the page tables, bound at map time,
+    which access RAM pages directly and only call out for the other pages.
+    The bulk operations (setBytes, getBytes, fill, resetMemory) always access the backing RAM,
+    which is how ROM contents are loaded.
+    '''
+    def __init__(self, checked=True):
+        self._pageTypes = [RAM for i in range(256)]
+        self._pageReads = [None for i in range(256)]
+        """
+        page -> read(addr) returning the byte at addr, None for pages read straight from the backing RAM
+        """
+        self._pageWrites = [None for i in range(256)]
+        """
+        page -> write(addr, val), None for pages written straight to the backing RAM
+        """
+        self._mirrorOffsets = [None for i in range(256)]
+        """
+        page -> offset to the mirrored page's addresses, None for pages which aren't mirrors
+        """
+        self._pageFetches = [None for i in range(256)]
+        """
+        page -> fetch(addr) for op-code and operand fetches, None for pages fetched straight from the backing RAM
+        """
+        super().__init__(checked)
+
+    def pageType(self, page):
+        '''
+        returns RAM, ROM, MIRROR or DEVICE
+        '''
+        return self._pageTypes[page]
+
+    def mapRAM(self, firstPage, pageCount=1):
+        self._map(firstPage, pageCount, RAM, None, None)
+
+    def mapROM(self, firstPage, pageCount=1, data=None):
+        '''
+        makes the pages read only (writes are ignored). data, if given, is loaded at the start of firstPage.
+        '''
+        if data is not None:
+            assert(len(data) <= pageCount * 256)
+            self.setBytes(firstPage << 8, data)
+        self._map(firstPage, pageCount, ROM, None, _ignoreWrite)
+
+    def mapMirror(self, firstPage, pageCount, targetPage, targetPageCount=None):
+        '''
+        page firstPage + i mirrors page targetPage + i % targetPageCount (default: pageCount),
+        e.g. mapMirror(0x08, 0x18, 0x00, 0x08) repeats 2 KiB of RAM up to 0x1FFF.
+        Accesses go through the target page's mapping, so mirrors of ROM or devices work as well.
+        '''
+        if targetPageCount is None: targetPageCount = pageCount
+        for i in range(pageCount):
+            offset = ((targetPage + i % targetPageCount) - (firstPage + i)) << 8
+            read = lambda addr, offset=offset: self.getByte(addr + offset)
+            write = lambda addr, val, offset=offset: self.setByte(addr + offset, val)
+            fetch = lambda addr, offset=offset: self.fetchByte(addr + offset)
+            self._map(firstPage + i, 1, MIRROR, read, write, fetch)
+            self._mirrorOffsets[firstPage + i] = offset
+
+    def mapDevice(self, firstPage, pageCount, read=None, write=None):
+        '''
+        dispatches accesses to the pages to read(addr) -> byte and write(addr, val).
+        Without read, reads return the backing RAM; without write, writes are ignored.
+        '''
+        self._map(firstPage, pageCount, DEVICE, read, write if write is not None else _ignoreWrite)
+
+    def _map(self, firstPage, pageCount, pageType, read, write, fetch=None):
+        '''
+        fetch(addr), for op-code and operand fetches, defaults to read
+        '''
+        assert(firstPage >= 0 and pageCount >= 0 and firstPage + pageCount <= 256)
+        for page in range(firstPage, firstPage + pageCount):
+            self._pageTypes[page] = pageType
+            self._pageReads[page] = read
+            self._pageWrites[page] = write
+            self._mirrorOffsets[page] = None
+            self._pageFetches[page] = fetch if fetch is not None else read
+        self._bindGetByte()
+        self._bindSetByte()
+
+    def fork(self):
+        '''
+        returns a new Bus with a copy of the backing RAM and the same RAM, ROM and mirror pages.
+        Unlike Memory.fork this copies all 64 KiB. Hooks are not inherited.
+        Raises ValueError if a device is mapped: its state lives in the device, which the fork can't share.
+        '''
+        if DEVICE in self._pageTypes: raise ValueError("can't fork a Bus with device pages")
+        bus = Bus(self._checked)
+        bus._memory[:] = self._memory
+        for page, pageType in enumerate(self._pageTypes):
+            if pageType == ROM: bus._map(page, 1, ROM, None, _ignoreWrite)
+            elif pageType == MIRROR:
+                offset = self._mirrorOffsets[page]
+                bus.mapMirror(page, 1, page + (offset >> 8))
+        return bus
+
+    def _paged(self):
+        return any(pageType != RAM for pageType in self._pageTypes)
+
+    def _bindGetByte(self):
+        '''
+        swaps in dispatching getByte / fetchByte closures while any page is read through a callback
+        '''
+        memory = self._memory
+        reads = self._pageReads
+        fetches = self._pageFetches
+        readHooks = self._readHooks
+        if any(read is not None for read in reads):
+            if any(hooks is not None for hooks in readHooks):
+                def getByte(addr):
+                    read = reads[addr >> 8]
+                    val = memory[addr] if read is None else read(addr)
+                    hooks = readHooks[addr >> 8]
+                    if hooks is not None:
+                        for hook in hooks: hook(addr, val)
+                    return val
+            else:
+                def getByte(addr):
+                    read = reads[addr >> 8]
+                    if read is None: return memory[addr]
+                    return read(addr)
+            self.getByte = getByte
+        else: super()._bindGetByte()
+
+        if any(fetch is not None for fetch in fetches):
+            def fetchByte(addr):
+                fetch = fetches[addr >> 8]
+                if fetch is None: return memory[addr]
+                return fetch(addr)
+            self.fetchByte = fetchByte
+        elif "fetchByte" in self.__dict__: del self.fetchByte
+
+    def _bindSetByte(self):
+        '''
+        swaps in a dispatching setByte closure while any page isn't RAM
+        '''
+        if not self._paged(): return super()._bindSetByte()
+        memory = self._memory
+        writes = self._pageWrites
+        writeHooks = self._writeHooks
+        if self._checked or any(hooks is not None for hooks in writeHooks):
+            checked = self._checked
+            def setByte(addr: int, val: int):
+                if checked:
+                    assert(addr >= 0 and addr < 65536)
+                    assert(val >= 0 and val < 256)
+                    assert(type(val) == int and type(addr) == int)
+                write = writes[addr >> 8]
+                if write is None: memory[addr] = val
+                else: write(addr, val)
+                hooks = writeHooks[addr >> 8]
+                if hooks is not None:
+                    for hook in hooks: hook(addr, val)
+        else:
+            def setByte(addr: int, val: int):
+                write = writes[addr >> 8]
+                if write is None: memory[addr] = val
+                else: write(addr, val)
+        self.setByte = setByte
@@ -1,182 +1,139 @@
 import time
 
 from memory import Memory
-from execution import *
+from execution import buildDecodeLookupTable, buildFusedHandlers, defaultFusedPairs, fusable
+from flags import *
+from blockcache import BlockCache, instructionLengths
+from instrumentation import OpcodeHistogram
+from scheduler import Scheduler
 
 def toGhz(hz: int): return hz * 1000000000
 def toMhz(hz: int): return hz * 1000000
 def toKhz(hz: int): return hz * 1000
 
+class UnimplementedInstruction(Exception):
+    def __init__(self, opcode):
+        super().__init__("unimplemented instruction: " + hex(opcode))
+        self.opcode = opcode
+
+noBreakpoints = bytes(65536)
+nmiVector = 0xFFFA
+irqVector = 0xFFFE
+
+class StopCondition:
+    '''
+    Tells CPU.runUntil when to stop, in addition to its maxInstructions / maxCycles budget.
+    - trap: stop when an instruction leaves PC unchanged (JMP *, taken BNE *),
+      which is how test programs like 6502_functional_test.bin signal success or failure
+    - breakpoints: addresses to stop at, before the instruction there is executed
+    - brk: stop before executing a BRK (0x00)
+    - breakpointMap: instead of breakpoints, a 64 KiB bitmap indexed by PC, non-zero at breakpoints.
+      Pass a bytearray to change breakpoints between runs without building a new StopCondition (see debugger.Debugger)
+    - blocks: allow compiled blocks, if the CPU has a block cache
+    '''
+    def __init__(self, trap=True, breakpoints=(), brk=True, breakpointMap=None, blocks=True):
+        self.trap = trap
+        if breakpointMap is None:
+            breakpointMap = noBreakpoints
+            if breakpoints:
+                breakpointMap = bytearray(65536)
+                for addr in breakpoints: breakpointMap[addr] = 1
+        self.breakpointMap = breakpointMap
+        self.brk = brk
+        self.blocks = blocks
+
+class RunResult:
+    '''
+    Returned by CPU.runUntil.
+    reason is one of the STOP_* strings, pc is the PC the CPU stopped at.
+    '''
+    STOP_TRAP = "trap"
+    STOP_BREAKPOINT = "breakpoint"
+    STOP_BRK = "brk"
+    STOP_UNIMPLEMENTED = "unimplemented"
+    STOP_MAX_INSTRUCTIONS = "maxInstructions"
+    STOP_MAX_CYCLES = "maxCycles"
+    STOP_MAX_TIME = "maxTime"
+    IDLE = "idle"
+    """
+    not a stop reason: returned by runUntil's batch loops on an idle loop, which runUntil then fast-forwards
+    """
+
+    def __init__(self, reason, pc, instructions, cycles, wallTime):
+        self.reason = reason
+        self.pc = pc
+        self.instructions = instructions
+        self.cycles = cycles
+        self.wallTime = wallTime
+
+    def instructionsPerSecond(self):
+        return self.instructions / self.wallTime if self.wallTime > 0 else 0.0
+
+    def __str__(self):
+        return "stopped ({reason}) at {pc} after {instructions} instructions, {cycles} cycles, {wallTime:.3f}s ({ips:.0f} instructions/s)".format(
+            reason = self.reason, pc = hex(self.pc), instructions = self.instructions, cycles = self.cycles,
+            wallTime = self.wallTime, ips = self.instructionsPerSecond())
+
+class Snapshot:
+    '''
+    Returned by CPU.snapshot: registers, processor status, cycle counters and a copy of the 64 KiB memory image.
+    Devices mapped on a Bus keep their own state and are not part of it.
+    '''
+    def __init__(self, registers, clockCycle, instructionCycle, currentInstruction, memory):
+        self.registers = registers
+        """
+        (a, x, y, sp, pc, p)
+        """
+        self.clockCycle = clockCycle
+        self.instructionCycle = instructionCycle
+        self.currentInstruction = currentInstruction
+        self.memory = memory
+
 class CPU:
     '''
     CPU class :3
+    useBlockCache enables runBlock(), which executes cached and compiled straight-line blocks of instructions.
+    checked=False selects the "release" mode: getRegister, setRegister, setPC and setFlag are swapped
+    for variants without asserts. Combine it with Memory(checked=False) for the fastest execution,
+    keep both checked while developing op-codes.
     '''
-    def __init__(self, memory):
+    __slots__ = ("a", "x", "y", "sp", "pc", "_p", "_zn", "__dict__")
+    """
+    The registers are slots, so execute functions can read and write them as plain attributes (cpu.a = result8).
+    Everything else lives in __dict__, which also allows swapping in the unchecked accessors.
+    """
+
+    def __init__(self, memory, useBlockCache=False, checked=True):
         self._memory = memory
+        self._checked = checked
+        if not checked:
+            self.getRegister = self._getRegisterUnchecked
+            self.setRegister = self._setRegisterUnchecked
+            self.setPC = self._setPCUnchecked
+            self.setFlag = self._setFlagUnchecked
+
+        self._handlers = buildDecodeLookupTable(self, memory)
+        """
+        Maps op-codes to their handlers, generated from execution.opcodeTable.
+        """
+        self._decodeFunctionLookupTable = self._handlers
+        """
+        the dispatch table: _handlers, possibly wrapped (instrumentation, Profiler)
+        """
+        self._implementedOpcodes = frozenset(self._handlers)
+        self._fusedHandlers = buildFusedHandlers(self, memory, defaultFusedPairs)
+        """
+        op-code pair -> fused handler, used by compiled blocks (see fuseOpcodePairs)
+        """
 
-        self._decodeFunctionLookupTable = {
-            # NOP
-            0xEA: executeNOP(self),
-
-            # CLD
-            0xD8: executeCLD(self),
-
-            # Transfer
-            0xAA: executeTAX(self),
-            0xA8: executeTAY(self),
-            0xBA: executeTSX(self),
-            0x8A: executeTXA(self),
-            0x9A: executeTXS(self),
-            0x98: executeTYA(self),
-
-            # STACK
-            0x28: executeStackPull(self, memory, "Flags"),
-            0x68: executeStackPull(self, memory, "A"),
-            0x08: executeStackPush(self, memory, "Flags"),
-            0x48: executeStackPush(self, memory, "A"),
-
-            # BRANCH
-            0x90: executeBCC(self),
-            0xB0: executeBCS(self),
-            0xF0: executeBEQ(self),
-            0x30: executeBMI(self),
-            0xD0: executeBNE(self),
-            0x10: executeBPL(self),
-            0x50: executeBVC(self),
-            0x70: executeBVS(self),
-
-            # JMP
-            0x4C: executeJumpDirect(self),
-            0x6C: executeJumpIndirect(self, memory),
-
-            # CPX CPY
-            0xE0: executeCPRegImmediate(self, "X"),
-            0xC0: executeCPRegImmediate(self, "Y"),
-            0xE4: executeCPRegZeroPage(self, memory, "X"),
-            0xC4: executeCPRegZeroPage(self, memory, "Y"),
-            0xEC: executeCPRegAbsolute(self, memory, "X"),
-            0xCC: executeCPRegAbsolute(self, memory, "Y"),
-
-            #CMP
-            0xC9: executeCPRegImmediate(self, "A"),
-            0xC5: executeCPRegZeroPage(self, memory, "A"),
-            0xD5: executeCPRegZeroPageX(self, memory, "A"),
-            0xCD: executeCPRegAbsolute(self, memory, "A"),
-            0xDD: executeCPRegAbsoluteIndexed(self, memory, "A", "X"),
-            0xD9: executeCPRegAbsoluteIndexed(self, memory, "A", "Y"),
-
-            # STA
-            0x85: executeSTAZeroPage(self, memory),
-            0x95: executeSTAZeroPageX(self, memory),
-            0x8D: executeSTAAbsolute(self, memory),
-            0x9D: executeSTAAbsoluteIndexed(self, memory, "X"),
-            0x99: executeSTAAbsoluteIndexed(self, memory, "Y"),
-            0x81: executeSTAIndirectIndexed(self, memory, "X"),
-            0x91: executeSTAIndirectIndexed(self, memory, "Y"),
-
-            # STX
-            0x86: executeSTXZeroPage(self, memory),
-            0x96: executeSTXZeroPageY(self, memory),
-            0x8E: executeSTXAbsolute(self, memory),
-
-            # STY
-            0x84: executeSTYZeroPage(self, memory),
-            0x94: executeSTYZeroPageX(self, memory),
-            0x8C: executeSTYAbsolute(self, memory),
-
-            # Increment
-            0xE6: executeINCZeroPage(self, memory),
-            0xF6: executeINCZeroPageX(self, memory),
-            0xEE: executeINCAbsolute(self, memory),
-            0xFE: executeINCAbsoluteX(self, memory),
-
-            # Decrement
-            0xCA: executeDEX(self),
-            0x88: executeDEY(self),
-
-            # ADC TODO BCD
-            0x69: executeADCImm(self),
-            0x65: executeADCZeroPage(self, memory),
-            0x75: executeADCZeroPageX(self, memory),
-            0x6D: executeADCAbsolute(self, memory),
-            0x7D: executeADCAbsoluteIndexed(self, memory, "X"),
-            0x79: executeADCAbsoluteIndexed(self, memory, "Y"),
-            0x61: executeADCIndirectIndexed(self, memory, "X"),
-            0x71: executeADCIndirectIndexed(self, memory, "Y"),
-
-            # SBC TODO BCD TESTS
-            0xE9: executeSBCImm(self),
-            0xE5: executeSBCZeroPage(self, memory),
-            0xF5: executeSBCZeroPageX(self, memory),
-            0xED: executeSBCAbsolute(self, memory),
-            0xFD: executeSBCAbsoluteIndexed(self, memory, "X"),
-            0xF9: executeSBCAbsoluteIndexed(self, memory, "Y"),
-            0xE1: executeSBCIndirectIndexed(self, memory, "X"),
-            0xF1: executeSBCIndirectIndexed(self, memory, "Y"),
-
-            # LDA
-            0xA9: executeLDAImm(self),
-            0xA5: executeLDAZeroPage(self, memory),
-            0xB5: executeLDAZeroPageX(self, memory),
-            0xAD: executeLDAAbsolute(self, memory),
-            0xBD: executeLDAAbsoluteIndexed(self, memory, "X"),
-            0xB9: executeLDAAbsoluteIndexed(self, memory, "Y"),
-            0xA1: executeLDAIndirectIndexed(self, memory, "X"),
-            0xB1: executeLDAIndirectIndexed(self, memory, "Y"),
-
-            # LDX
-            0xA2: executeLDXImm(self),
-            0xA6: executeLDXZeroPage(self, memory),
-            0xB6: executeLDXZeroPageY(self, memory),
-            0xAE: executeLDXAbsolute(self, memory),
-            0xBE: executeLDXAbsoluteY(self, memory),
-
-            #LDY
-            0xA0: executeLDYImm(self),
-            0xA4: executeLDYZeroPage(self, memory),
-            0xB4: executeLDYZeroPageX(self, memory),
-            0xAC: executeLDYAbsolute(self, memory),
-            0xBC: executeLDYAbsoluteX(self, memory),
-
-            #ORA
-            0x09: executeORAIMM(self),
-            0x05: executeORAZeroPage(self, memory),
-            0x15: executeORAZeroPageX(self, memory),
-            0x0D: executeORAAbsolute(self, memory),
-            0x1D: executeORAAbsoluteIndexed(self, memory, "X"),
-            0x19: executeORAAbsoluteIndexed(self, memory, "Y"),
-            0x01: executeORAIndirectIndexed(self, memory, "X"),
-            0x11: executeORAIndirectIndexed(self, memory, "Y"),
-
-            #AND
-            0x29: executeANDIMM(self),
-            0x25: executeANDZeroPage(self, memory),
-            0x35: executeANDZeroPageX(self, memory),
-            0x2D: executeANDAbsolute(self, memory),
-            0x3D: executeANDAbsoluteIndexed(self, memory, "X"),
-            0x39: executeANDAbsoluteIndexed(self, memory, "Y"),
-            0x21: executeANDIndirectIndexed(self, memory, "X"),
-            0x31: executeANDIndirectIndexed(self, memory, "Y"),
-
-            #EOR
-            0x49: executeEORIMM(self),
-            0x45: executeEORZeroPage(self, memory),
-            0x55: executeEORZeroPageX(self, memory),
-            0x4D: executeEORAbsolute(self, memory),
-            0x5D: executeEORAbsoluteIndexed(self, memory, "X"),
-            0x59: executeEORAbsoluteIndexed(self, memory, "Y"),
-            0x41: executeEORIndirectIndexed(self, memory, "X"),
-            0x51: executeEORIndirectIndexed(self, memory, "Y"),
-        }
+        self._blockCache = BlockCache(self, memory) if useBlockCache else None
+        self._histogram = None
+        """
+        the OpcodeHistogram while instrumentation is enabled
+        """
+        self._plainDecodeLut = None
         """
-        Maps opcodes to execution functions.
-        Parameters are components needed to execute the function.
-        Parameters specify a register for some instructions to reduce redundant code.
-        - ADCImm requires the cpu registers, which is why it gets a reference to self (the cpu).
-        - ADCZeroPage additionally gets a reference to the memory because it operates on it.
-        - LDAAbsoluteIndexed additionally takes a String of the Register to index with (X or Y).
-        The functions are curried to allow for passing parameters:
-        - executeADCImm(self) -> return function execute.
+        the dispatch table to swap back in when instrumentation is disabled
         """
 
         self._clockCycle = 0
@@ -184,35 +141,55 @@ class CPU:
         self._clockHz = 100
         self._instructionCycle = 0
 
-        self._registers = {
-            "A": 0,
-            "X": 0,
-            "Y": 0,
-            "PC": 0,
-            "SP": 0
-        }
+        self.scheduler = Scheduler(self.getClockCycle)
         """
-        A, X, Y and SP are 8-Bit.
-        PC is 16-Bit.
+        events keyed on the clock cycle (see scheduler.py), dispatched by runUntil.
+        Like devices, pending events are not part of snapshots, and forks start out without any.
         """
+        self._idleSample = None
+        """
+        (state, instructions, cycles) after the last iteration of a possibly idle loop, see _isIdle
+        """
+        self._idleIteration = None
+        self._irqSources = set()
+        """
+        whatever currently asserts the IRQ line, see assertIRQ
+        """
+        self._nmiPending = False
 
-        self._flags = {
-            "carry": False,
-            "zero": False,
-            "interrupt disable": False,
-            "decimal mode": False,
-            "break command": False,
-            "overflow": False,
-            "negative": False
-        }
+        self.a = 0
+        self.x = 0
+        self.y = 0
+        self.sp = 0
+        self.pc = 0
         """
-        carry, zero, interrupt disable, decimal mode, break command, overflow, negative
+        a, x, y and sp are 8-Bit.
+        pc is 16-Bit.
+        getRegister / setRegister ("A", "X", "Y", "SP") and getPC / setPC are the checked accessors.
+        """
+
+        self._p = 0
+        """
+        processor status, all flags packed into one int. See flags.py for the bit layout.
+        Its Z and N bits are stale: handlers only store the result those flags depend on in _zn,
+        and p evaluates them when asked.
+        """
+        self._zn = 0x01
+        """
+        the last result Z and N follow, an index into flags.znFlags. Op-code handlers set it directly (cpu._zn = result8),
+        and update the other flags in _p (cpu._p |= CARRY).
         """
 
         self.currentInstruction = 0x00
+        """
+        the op-code last decoded by decodeInstruction (single steps). runUntil and compiled blocks decode
+        inline and don't update it.
+        """
 
     def __str__(self):
-        return "Registers: "+ str(self._registers) + "-\n" + str(self._flags) + "-\n"
+        flags = {flag: self.getFlag(flag) for flag in flagBits}
+        registers = {"A": self.a, "X": self.x, "Y": self.y, "PC": self.pc, "SP": self.sp}
+        return "Registers: "+ str(registers) + "-\n" + str(flags) + "-\n"
 
     def run(self):
         '''
@@ -223,16 +200,17 @@ class CPU:
         while True:
             cycleBeginTime = time.perf_counter()
 
-            self.fetchInstruction()
-            print("op-code: " + hex(self.currentInstruction))
-            print("next2: " + hex(self._memory.getByte(self.getPC() + 1)) + hex(self._memory.getByte(self.getPC() + 2)))
             print(self)
+            operand = self.decodeInstruction()
+            print("op-code: " + hex(self.currentInstruction))
+            print("operand: " + hex(operand))
 
-            self._decodeFunctionLookupTable[self.currentInstruction]()
+            self._decodeFunctionLookupTable[self.currentInstruction](operand)
 
             cycleEndTime = time.perf_counter()
             waitUntil = cycleBeginTime + self._clockCyclesThisCycle / self._clockHz
-            while time.perf_counter() < waitUntil: pass
+            # see throttle.py for running at a target clock without printing
+            time.sleep(max(0, waitUntil - time.perf_counter()))
 
             # debug shit
             timeTakenInstructionCycle = cycleEndTime - cycleBeginTime
@@ -240,7 +218,7 @@ class CPU:
             timeToWaitInstructionCycleNS = (waitUntil - cycleBeginTime) * 1000000
             timeClockCycleNS = timeTakenInstructionCycleNS / self._clockCyclesThisCycle
             print("time spent per instruction cycle is {n:.10f}us.".format(n = timeTakenInstructionCycleNS))
-            print("time to wait in busy loop is {n:.10f}us.".format(n = timeToWaitInstructionCycleNS))
+            print("time to wait is {n:.10f}us.".format(n = timeToWaitInstructionCycleNS))
             print("time per clock cycle is {n:.10f}us.\n".format(n = timeClockCycleNS))
             print(self)
 
@@ -255,17 +233,186 @@ class CPU:
 
         for i in range(len(program) // 3):
             cycleBeginTime = time.perf_counter()
-            self.fetchInstruction()
-            self._decodeFunctionLookupTable[self.currentInstruction]()
+            operand = self.decodeInstruction()
+            self._decodeFunctionLookupTable[self.currentInstruction](operand)
             self._clockCyclesThisCycle = 0
 
             timeTakenInstructionCycle = (time.perf_counter() - cycleBeginTime) * 1000000
             times.append(timeTakenInstructionCycle)
         return times
     
+    def runUntil(self, condition=None, maxInstructions=None, maxCycles=None):
+        '''
+        Runs silently until condition (a StopCondition, default: trap and BRK) is met, or one of the budgets is used up.
+        Run reset() before, if this is the first cycle.
+        Instructions run in uninterrupted batches up to the next scheduler event. Between batches, due events
+        are dispatched and pending interrupts are taken (see assertIRQ, nmi).
+        Uses compiled blocks if useBlockCache is set (and condition.blocks); they end before breakpoints,
+        but the budgets and events are only checked between blocks and may be overrun by one block.
+
+        Idle loops are fast-forwarded: once an iteration of a loop which doesn't write memory started and ended
+        with the same registers, every further iteration repeats it until an event or interrupt changes something.
+        The iterations up to the next event or the end of the budget are then credited in one step (cycles and
+        instructions exactly as if they had run). Detected are loops of one instruction (JMP *, BNE *) not stopped
+        by trap, and with the block cache, loops making up a single block (LDA $xx, BEQ loop).
+        Reads with side effects (read hooks, mapped devices) and instrumentation disable it.
+        Returns a RunResult.
+        '''
+        if condition is None: condition = StopCondition()
+        self._optimizeDecodeLut()
+
+        useBlocks = self._blockCache is not None and condition.blocks
+        if useBlocks: self._blockCache.setBreakpointMap(condition.breakpointMap)
+        runBatch = self._runBlocksUntil if useBlocks else self._runInstructionsUntil
+
+        self._clockCyclesThisCycle = 0
+        beginTime = time.perf_counter()
+        reason, instructions = self._runBatches(runBatch, condition, maxInstructions, maxCycles)
+        wallTime = time.perf_counter() - beginTime
+
+        cycles = self._clockCyclesThisCycle
+        self._clockCyclesThisCycle = 0
+        self._clockCycle += cycles
+        return RunResult(reason, self.pc, instructions, cycles, wallTime)
+
+    def _runBatches(self, runBatch, condition, maxInstructions, maxCycles, onIdle=None):
+        '''
+        runUntil's outer loop, shared with Tracer.run: runs runBatch(condition, instructionLimit, cycleLimit, fastForward),
+        returning (reason, instructions executed), in batches up to the next scheduler event, dispatches due events
+        and takes pending interrupts between batches, and fast-forwards idle loops (a batch returning RunResult.IDLE).
+        onIdle(iterations), if given, is called before that many iterations of _idleIteration are skipped.
+        Clock cycles accumulate in _clockCyclesThisCycle. Returns (reason, instructions executed)
+        '''
+        unlimited = 1 << 62
+        instructionLimit = unlimited if maxInstructions is None else maxInstructions
+        cycleLimit = unlimited if maxCycles is None else maxCycles
+        scheduler = self.scheduler
+        # fast-forwarding needs something to skip to, and reads without side effects
+        fastForward = (self._histogram is None and "getByte" not in self._memory.__dict__ and
+                       (maxInstructions is not None or maxCycles is not None or len(scheduler) > 0))
+
+        instructions = 0
+        while True:
+            if scheduler.nextCycle <= self._clockCycle + self._clockCyclesThisCycle: scheduler.runDue()
+            if self._nmiPending or self._irqSources: self._serviceInterrupts()
+
+            # the batch limits are in clock cycles since the start of this run, like _clockCyclesThisCycle
+            batchCycleLimit = min(cycleLimit, scheduler.nextCycle - self._clockCycle)
+            batchInstructionLimit = instructionLimit - instructions
+            # an asserted but masked IRQ is polled after every instruction, as any of them may clear the mask
+            if self._irqSources and self._p & INTERRUPT: batchInstructionLimit = 1
+            reason, executed = runBatch(condition, batchInstructionLimit, batchCycleLimit, fastForward)
+            instructions += executed
+
+            if reason == RunResult.IDLE:
+                # skip to the iteration after which the batch would have stopped
+                iterationCycles, iterationInstructions = self._idleIteration
+                iterations = max(0, min(-((self._clockCyclesThisCycle - batchCycleLimit) // iterationCycles),
+                                        -((executed - batchInstructionLimit) // iterationInstructions)))
+                if onIdle is not None: onIdle(iterations)
+                self._clockCyclesThisCycle += iterations * iterationCycles
+                instructions += iterations * iterationInstructions
+                reason = RunResult.STOP_MAX_CYCLES
+
+            if reason != RunResult.STOP_MAX_CYCLES and reason != RunResult.STOP_MAX_INSTRUCTIONS: return reason, instructions
+            # a batch limit, or the budget of the whole run?
+            if instructions >= instructionLimit: return RunResult.STOP_MAX_INSTRUCTIONS, instructions
+            if self._clockCyclesThisCycle >= cycleLimit: return RunResult.STOP_MAX_CYCLES, instructions
+
+    def _runInstructionsUntil(self, condition, instructionLimit, cycleLimit, fastForward=False):
+        '''
+        runUntil's loop, one instruction at a time. Clock cycles accumulate in _clockCyclesThisCycle.
+        With fastForward, returns RunResult.IDLE on an idle loop of one instruction.
+        Returns (reason, instructions executed)
+        '''
+        lut = self._decodeFunctionLookupTable
+        fetch = self._memory.fetchByte
+        lengths = instructionLengths
+        trap = condition.trap
+        breakpointMap = condition.breakpointMap
+        brk = condition.brk
+        instructions = 0
+        self._idleSample = None
+
+        try:
+            while True:
+                pc = self.pc
+                if breakpointMap[pc]: return RunResult.STOP_BREAKPOINT, instructions
+                opcode = fetch(pc)
+                if opcode == 0x00 and brk: return RunResult.STOP_BRK, instructions
+
+                # decode stage, see decodeInstruction
+                length = lengths[opcode]
+                if length == 2: operand = fetch((pc + 1) & 0xFFFF)
+                elif length == 3: operand = fetch((pc + 1) & 0xFFFF) | fetch((pc + 2) & 0xFFFF) << 8
+                else: operand = 0
+                self.pc = (pc + length) & 0xFFFF
+                lut[opcode](operand)
+                instructions += 1
+
+                if self.pc == pc:
+                    if trap: return RunResult.STOP_TRAP, instructions
+                    if fastForward and self._isIdle(pc, instructions, 1): return RunResult.IDLE, instructions
+                if instructions >= instructionLimit: return RunResult.STOP_MAX_INSTRUCTIONS, instructions
+                if self._clockCyclesThisCycle >= cycleLimit: return RunResult.STOP_MAX_CYCLES, instructions
+        except UnimplementedInstruction:
+            return RunResult.STOP_UNIMPLEMENTED, instructions
+
+    def _runBlocksUntil(self, condition, instructionLimit, cycleLimit, fastForward=False):
+        '''
+        runUntil's loop using the block cache. A trap can only be the last instruction of a block,
+        a breakpoint only the first. With fastForward, returns RunResult.IDLE on a block which is an idle loop.
+        Returns (reason, instructions executed)
+        '''
+        blockCache = self._blockCache
+        memory = self._memory
+        trap = condition.trap
+        breakpointMap = condition.breakpointMap
+        brk = condition.brk
+        instructions = 0
+        self._idleSample = None
+
+        while True:
+            pc = self.pc
+            if breakpointMap[pc]: return RunResult.STOP_BREAKPOINT, instructions
+            block = blockCache.getBlock(pc)
+            if block is None:
+                if memory.fetchByte(pc) == 0x00 and brk: return RunResult.STOP_BRK, instructions
+                return RunResult.STOP_UNIMPLEMENTED, instructions
+
+            blockCache.stale = False
+            executed = block()
+            instructions += executed
+
+            if trap and self.pc == block.lastPC and executed == block.length: return RunResult.STOP_TRAP, instructions
+            if instructions >= instructionLimit: return RunResult.STOP_MAX_INSTRUCTIONS, instructions
+            if self._clockCyclesThisCycle >= cycleLimit: return RunResult.STOP_MAX_CYCLES, instructions
+            if (fastForward and block.idleCandidate and self.pc == pc and executed == block.length and
+                self._isIdle(pc, instructions, executed)): return RunResult.IDLE, instructions
+
+    def _isIdle(self, pc, instructions, iterationInstructions):
+        '''
+        called after an iteration of a loop starting at pc, which doesn't write memory. True if the previous iteration
+        ended with the same registers: this one started and ended in the same state, and so will all following ones.
+        The cycles and instructions of an iteration are left in _idleIteration.
+        '''
+        state = (pc, self.a, self.x, self.y, self.sp, self._p, self._zn)
+        cycles = self._clockCyclesThisCycle
+        sample = self._idleSample
+        self._idleSample = (state, instructions, cycles)
+        if sample is None or sample[0] != state or instructions - sample[1] != iterationInstructions: return False
+        self._idleIteration = (cycles - sample[2], iterationInstructions)
+        return True
+
     def _optimizeDecodeLut(self):
+        if type(self._decodeFunctionLookupTable) == list: return
+
         def unimplemented(i):
-            def execute(): raise Exception("unimplemented instruction: " + hex(i))
+            length = instructionLengths[i]
+            def execute(operand):
+                # leave PC at the op-code
+                self.pc = (self.pc - length) & 0xFFFF
+                raise UnimplementedInstruction(i)
             return execute
 
         lutArr = [unimplemented(i) for i in range(256)]
@@ -275,41 +422,101 @@ class CPU:
 
         self._decodeFunctionLookupTable = lutArr
 
+    def enableInstrumentation(self):
+        '''
+        swaps in a dispatch table that counts executions and clock cycles per op-code (all 256 slots)
+        and returns the OpcodeHistogram it counts into. Disabled, nothing is counted and nothing is checked,
+        as the plain dispatch table is swapped back in.
+        '''
+        if self._histogram is not None: return self._histogram
+        self._optimizeDecodeLut()
+        self._histogram = OpcodeHistogram()
+        self._plainDecodeLut = self._decodeFunctionLookupTable
+        self._decodeFunctionLookupTable = self._histogram.instrument(self, self._plainDecodeLut)
+        # compiled blocks hold on to the handlers they were compiled with
+        if self._blockCache is not None: self._blockCache.flush()
+        return self._histogram
+
+    def disableInstrumentation(self):
+        '''
+        swaps the plain dispatch table back in and returns the OpcodeHistogram, or None if instrumentation wasn't enabled
+        '''
+        histogram = self._histogram
+        if histogram is None: return None
+        self._decodeFunctionLookupTable = self._plainDecodeLut
+        self._histogram = self._plainDecodeLut = None
+        if self._blockCache is not None: self._blockCache.flush()
+        return histogram
+
+    def fuseOpcodePairs(self, pairs):
+        '''
+        makes compiled blocks run each of the op-code pairs (first, second) in pairs with one fused handler
+        (a superinstruction, see execution.fusedSource) instead of two, with the same effect on registers, flags,
+        memory and clock cycles. Replaces the pairs fused so far (execution.defaultFusedPairs); pick them from
+        OpcodeHistogram.fusionCandidates. Pairs which can't be fused are left out; returns those that are.
+        Single instruction cycles, and blocks with a wrapped handler (instrumentation, Profiler), aren't fused.
+        '''
+        pairs = [tuple(pair) for pair in pairs if fusable(*pair)]
+        self._fusedHandlers = buildFusedHandlers(self, self._memory, pairs)
+        if self._blockCache is not None: self._blockCache.flush()
+        return pairs
+
     def runSingleInstructionCycle(self):
         '''
         Run reset() before, if this is the first cycle.
         Runs a single instruction cycle
         Returns the number of clock cycles used
+        Raises UnimplementedInstruction, with PC left at the op-code, for op-codes without a handler
+        Scheduler events and interrupts are only dispatched by runUntil.
         '''
-        self.fetchInstruction()
-        self._decodeFunctionLookupTable[self.currentInstruction]()
+        self._optimizeDecodeLut()
+        operand = self.decodeInstruction()
+        self._decodeFunctionLookupTable[self.currentInstruction](operand)
         clockCycles = self._clockCyclesThisCycle
         self._clockCyclesThisCycle = 0
+        self._clockCycle += clockCycles
         return clockCycles
+
+    def runBlock(self):
+        '''
+        Requires useBlockCache.
+        Runs the compiled block of instructions starting at PC,
+        or a single instruction cycle if no block can be built there (unimplemented op-code).
+        Returns a tuple of (instructions executed, clock cycles used)
+        '''
+        block = self._blockCache.getBlock(self.getPC())
+        if block is None: return 1, self.runSingleInstructionCycle()
+
+        self._blockCache.stale = False
+        instructions = block()
+        clockCycles = self._clockCyclesThisCycle
+        self._clockCyclesThisCycle = 0
+        self._clockCycle += clockCycles
+        return instructions, clockCycles
     
+    def decodeInstruction(self):
+        '''
+        The decode stage: fetches the op-code at PC into currentInstruction and its operand bytes,
+        advances PC past the instruction and returns the operand to call the op-code's handler with
+        (the operand byte, the little endian operand word of three byte instructions, 0 if there is none).
+        '''
+        fetch = self._memory.fetchByte
+        pc = self.pc
+        opcode = self.currentInstruction = fetch(pc)
+        length = instructionLengths[opcode]
+        if length == 2: operand = fetch((pc + 1) & 0xFFFF)
+        elif length == 3: operand = fetch((pc + 1) & 0xFFFF) | fetch((pc + 2) & 0xFFFF) << 8
+        else: operand = 0
+        self.pc = (pc + length) & 0xFFFF
+        return operand
+
     def fetchInstruction(self):
         '''
         loads the next instruction into currentInstruction
         '''
-        pc = self.getPC()
-        self.currentInstruction = self._memory.getByte(pc)
+        self.currentInstruction = self._memory.getByte(self.pc)
         return self
     
-    def fetchNext(self):
-        self.incrementPC().fetchInstruction()
-        return self._memory.getByte(self.currentInstruction)
-    
-    def fetchNext2(self):
-        self.incrementPC().fetchInstruction()
-        b0 = self.currentInstruction
-        self.incrementPC().fetchInstruction()
-        b1 = self.currentInstruction
-        return (b1 << 8) | b0
-    
-    def incrementPC(self):
-        self.setPC(self.getPC() + 1)
-        return self
-
     def reset(self):
         '''
         Performs the 6502 reset procedure:
@@ -322,9 +529,100 @@ class CPU:
         resetVectorHiByte = self._memory.getByte(0xFFFD)
         resetVector = resetVectorHiByte << 8 | resetVectorLoByte
         self.setPC(resetVector)
-        self.setRegister("SP", 0xFD)
+        self.sp = 0xFD
         self._clockCycle += 8
     
+    def snapshot(self):
+        '''
+        captures the CPU state and the whole memory image, see restore()
+        '''
+        return Snapshot((self.a, self.x, self.y, self.sp, self.pc, self.p),
+                        self._clockCycle, self._instructionCycle, self.currentInstruction, self._memory.snapshot())
+
+    def restore(self, snapshot):
+        '''
+        returns the CPU and its memory to the state captured by snapshot(), e.g. to rerun a scenario
+        from a checkpoint instead of replaying it from reset. A snapshot can be restored any number of times.
+        '''
+        self.a, self.x, self.y, self.sp, self.pc, self.p = snapshot.registers
+        self._clockCycle = snapshot.clockCycle
+        self._instructionCycle = snapshot.instructionCycle
+        self._clockCyclesThisCycle = 0
+        self.currentInstruction = snapshot.currentInstruction
+        self._memory.restore(snapshot.memory)
+
+    def fork(self):
+        '''
+        returns a new CPU with a copy of this CPU's state, running on a copy-on-write fork of its memory (Memory.fork).
+        Both can then run independently; forking the fork again is cheap, as pages are shared until written.
+        On a Bus the fork gets a copy of its RAM with the same mapping instead (Bus.fork).
+        '''
+        cpu = CPU(self._memory.fork(), useBlockCache=self._blockCache is not None, checked=self._checked)
+        cpu.a, cpu.x, cpu.y, cpu.sp, cpu.pc, cpu.p = self.a, self.x, self.y, self.sp, self.pc, self.p
+        cpu._clockCycle = self._clockCycle
+        cpu._instructionCycle = self._instructionCycle
+        cpu.currentInstruction = self.currentInstruction
+        if self._fusedHandlers.keys() != cpu._fusedHandlers.keys(): cpu.fuseOpcodePairs(self._fusedHandlers)
+        return cpu
+
+    def getClockCycle(self):
+        '''
+        clock cycles run since the CPU was created, including those of a run in progress. The scheduler's clock.
+        '''
+        return self._clockCycle + self._clockCyclesThisCycle
+
+    def assertIRQ(self, source=None):
+        '''
+        asserts the (level triggered) IRQ line on behalf of source, e.g. the device raising it.
+        The line stays asserted until every source released it. While it is asserted and the interrupt disable
+        flag is clear, runUntil takes the interrupt before the next instruction.
+        '''
+        self._irqSources.add(source)
+
+    def releaseIRQ(self, source=None):
+        self._irqSources.discard(source)
+
+    def nmi(self):
+        '''
+        signals a non maskable (edge triggered) interrupt, which runUntil takes before the next instruction
+        '''
+        self._nmiPending = True
+
+    def clearInterrupts(self):
+        '''
+        cancels all scheduled events, releases the IRQ line for every source and drops a pending NMI,
+        e.g. before reusing the CPU for an unrelated run. Neither restore() nor reset() does this.
+        '''
+        self.scheduler.clear()
+        self._irqSources.clear()
+        self._nmiPending = False
+
+    def interrupt(self, vector):
+        '''
+        The interrupt sequence: pushes PC and P (with the break flag clear), sets the interrupt disable flag
+        and jumps to the address stored at vector (nmiVector or irqVector). Takes 7 clock cycles.
+        '''
+        memory = self._memory
+        sp = self.sp
+        pc = self.pc
+        memory.setByte(0x0100 + sp, pc >> 8)
+        memory.setByte(0x0100 + ((sp + 0xFF) & 0xFF), pc & 0xFF)
+        memory.setByte(0x0100 + ((sp + 0xFE) & 0xFF), self.getByteFromFlags())
+        self.sp = (sp + 0xFD) & 0xFF
+        self._p |= INTERRUPT
+        self.pc = memory.getByte(vector) | memory.getByte(vector + 1) << 8
+        self._clockCyclesThisCycle += 7
+
+    def _serviceInterrupts(self):
+        '''
+        takes a pending NMI, or else the IRQ if it is asserted and not masked
+        '''
+        if self._nmiPending:
+            self._nmiPending = False
+            self.interrupt(nmiVector)
+        elif self._irqSources and not self._p & INTERRUPT:
+            self.interrupt(irqVector)
+
     def addClockCyclesThisCycle(self, n):
         '''
         clock cycles are necessary to determine the correct amount of time an instruction takes to execute
@@ -336,7 +634,7 @@ class CPU:
         X, Y, A, SP
         '''
         assert(reg in ("X", "Y", "A", "SP"))
-        return self._registers[reg]
+        return getattr(self, reg.lower())
     
     def setRegister(self, reg, val):
         '''
@@ -345,30 +643,56 @@ class CPU:
         assert(type(val) == int)
         assert(reg in ("X", "Y", "A", "SP"))
         assert(val >= 0 and val < 256)
-        self._registers[reg] = val
+        setattr(self, reg.lower(), val)
+
+    def _getRegisterUnchecked(self, reg): return getattr(self, reg.lower())
+    def _setRegisterUnchecked(self, reg, val): setattr(self, reg.lower(), val)
     
     def getPC(self):
-        return self._registers["PC"]
+        return self.pc
 
     def setPC(self, val):
         assert(type(val) == int)
         assert(val >= 0 and val < 65536)
-        self._registers["PC"] = val
+        self.pc = val
+        return self
+
+    def _setPCUnchecked(self, val):
+        self.pc = val
         return self
 
     
+    @property
+    def p(self):
+        '''
+        the processor status register, with Z and N evaluated from the last result
+        '''
+        return (self._p & ~ZN) | znFlags[self._zn]
+
+    @p.setter
+    def p(self, val):
+        self._p = val
+        self._zn = znResults[val & ZN]
+
     def getFlag(self, flag):
         '''
         carry, zero, interrupt disable, decimal mode, break command, overflow, negative
+        compatibility accessor for the packed status register p
         '''
-        return self._flags[flag]
+        return (self.p & flagBits[flag]) != 0
     
     def setFlag(self, flag, val):
         '''
         carry, zero, interrupt disable, decimal mode, break command, overflow, negative
+        compatibility accessor for the packed status register p
         '''
         assert(type(val) == bool)
-        self._flags[flag] = val
+        if val: self.p |= flagBits[flag]
+        else: self.p &= ~flagBits[flag]
+
+    def _setFlagUnchecked(self, flag, val):
+        if val: self.p |= flagBits[flag]
+        else: self.p &= ~flagBits[flag]
     
     def setFlagsFromByte(self, byte):
         '''
@@ -382,12 +706,8 @@ class CPU:
         b1 = Zero
         b0 = Carry
         '''
-        self.setFlag("negative", True if byte & 0b10000000 else False)
-        self.setFlag("overflow", True if byte & 0b01000000 else False)
-        self.setFlag("decimal mode", True if byte & 0b00001000 else False)
-        self.setFlag("interrupt disable", True if byte & 0b00000100 else False)
-        self.setFlag("zero", True if byte & 0b00000010 else False)
-        self.setFlag("carry", True if byte & 0b00000001 else False)
+        self._p = (self._p & (BREAK | UNUSED)) | (byte & ~(BREAK | UNUSED))
+        self._zn = znResults[byte & ZN]
     
     def getByteFromFlags(self):
         '''
@@ -401,43 +721,36 @@ class CPU:
         b1 = Zero
         b0 = Carry
         '''
-        byte = 0
-        byte = byte | (0b10000000 if self.getFlag("negative") else 0)
-        byte = byte | (0b01000000 if self.getFlag("overflow") else 0)
-        byte = byte | (0b00001000 if self.getFlag("decimal mode") else 0)
-        byte = byte | (0b00000100 if self.getFlag("interrupt disable") else 0)
-        byte = byte | (0b00000010 if self.getFlag("zero") else 0)
-        byte = byte | (0b00000001 if self.getFlag("carry") else 0)
-        return byte
+        return self.p & ~(BREAK | UNUSED)
     
     def resetFlags(self):
         """
         sets all flags to False
         """
-        for flagKey in self._flags.keys():
-            self._flags[flagKey] = False
+        self.p = 0
 
     def resetAllRegisters(self):
         """
         resets registers (including PC) and flags
         """
-        for registerKey in self._registers.keys():
-            if registerKey == "PC":
-                self._registers[registerKey] = 0
-            else:
-                self._registers[registerKey] = 0
-        for flagKey in self._flags.keys():
-            self._flags[flagKey] = False
+        self.a = self.x = self.y = self.sp = self.pc = 0
+        self.p = 0
 
 
 if __name__ == "__main__":
-    memory = Memory()
-    cpu = CPU(memory)
-    cpu.reset()
     test = []
     for i in range(15000):
         test.append(0xae)
         test.append(0x10)
         test.append(0x20)
-    result = cpu.runPerfTest(test)
-    print(sum(result) / len(result))
\ No newline at end of file
+
+    # checked (development) vs. unchecked (release) mode
+    averages = {}
+    for checked in (True, False):
+        memory = Memory(checked=checked)
+        cpu = CPU(memory, checked=checked)
+        cpu.reset()
+        result = cpu.runPerfTest(test)
+        averages[checked] = sum(result) / len(result)
+        print("{mode}: {n:.4f}us per instruction".format(mode = "checked" if checked else "unchecked", n = averages[checked]))
+    print("unchecked speedup: {n:.2f}x".format(n = averages[True] / averages[False]))
\ No newline at end of file
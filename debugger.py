@@ -0,0 +1,202 @@
+from cpu import RunResult, StopCondition
+
+everywhere = b"\x01" * 65536
+
+class Breakpoint:
+    '''
+    Stops before the instruction at addr. condition(cpu) -> bool, if given, is evaluated when PC reaches addr
+    and has to return True for the breakpoint to count as hit. The first ignoreCount hits don't stop.
+    '''
+    def __init__(self, addr, condition=None, ignoreCount=0):
+        self.addr = addr
+        self.condition = condition
+        self.ignoreCount = ignoreCount
+        self.hits = 0
+
+    def _check(self, cpu):
+        if self.condition is not None and not self.condition(cpu): return False
+        self.hits += 1
+        return self.hits > self.ignoreCount
+
+class Watchpoint:
+    '''
+    Stops after the instruction which read (read=True) or wrote (write=True) a byte in [addrStart, addrEnd).
+    condition(cpu, addr, val) -> bool and ignoreCount work like Breakpoint's.
+    addr and val of the access that stopped the run are kept in lastAddr and lastVal.
+    '''
+    def __init__(self, addrStart, addrEnd, read=False, write=True, condition=None, ignoreCount=0):
+        self.addrStart = addrStart
+        self.addrEnd = addrEnd
+        self.read = read
+        self.write = write
+        self.condition = condition
+        self.ignoreCount = ignoreCount
+        self.hits = 0
+        self.lastAddr = None
+        self.lastVal = None
+
+    def pages(self):
+        return range(self.addrStart >> 8, ((self.addrEnd - 1) >> 8) + 1)
+
+    def _check(self, cpu, addr, val):
+        if addr < self.addrStart or addr >= self.addrEnd: return False
+        if self.condition is not None and not self.condition(cpu, addr, val): return False
+        self.hits += 1
+        if self.hits <= self.ignoreCount: return False
+        self.lastAddr = addr
+        self.lastVal = val
+        return True
+
+class Debugger:
+    '''
+    Breakpoints and watchpoints for a CPU, used through Debugger.run instead of CPU.runUntil.
+
+    Breakpoints are indexed by a 64 KiB bitmap the run loops check before every instruction (one index operation,
+    also with the block cache, whose blocks end before breakpoints). Conditions are only evaluated when PC hits
+    the bitmap. Watchpoints are Memory read / write hooks on the pages they cover, so accesses to other pages
+    cost nothing. A watchpoint hit fills the run's bitmap, which stops the run before the next instruction.
+
+    Op-code and operand fetches (Memory.fetchByte) don't trigger read watchpoints. Runs with read watchpoints
+    don't use the block cache, as blocks only stop early after writes.
+    '''
+    def __init__(self, cpu):
+        self._cpu = cpu
+        self._memory = cpu._memory
+        self._breakpointMap = bytearray(65536)
+        self._runMap = bytearray(65536)
+        """
+        bitmap passed to the running StopCondition: _breakpointMap, or everywhere after a watchpoint hit
+        """
+        self._breakpoints = {}
+        """
+        addr -> list of Breakpoints
+        """
+        self._pageReadWatchpoints = [None for i in range(256)]
+        self._pageWriteWatchpoints = [None for i in range(256)]
+        """
+        page -> list of Watchpoints, None for unwatched pages
+        """
+        self._pendingHit = None
+        self.hit = None
+        """
+        the Breakpoint or Watchpoint which stopped the last run, None if it stopped for another reason
+        """
+
+    def addBreakpoint(self, addr, condition=None, ignoreCount=0):
+        '''
+        returns the new Breakpoint
+        '''
+        breakpoint = Breakpoint(addr, condition, ignoreCount)
+        self._breakpoints.setdefault(addr, []).append(breakpoint)
+        self._breakpointMap[addr] = 1
+        return breakpoint
+
+    def removeBreakpoint(self, breakpoint):
+        breakpoints = self._breakpoints[breakpoint.addr]
+        breakpoints.remove(breakpoint)
+        if not breakpoints:
+            del self._breakpoints[breakpoint.addr]
+            self._breakpointMap[breakpoint.addr] = 0
+
+    def addWatchpoint(self, addrStart, length=1, read=False, write=True, condition=None, ignoreCount=0):
+        '''
+        watches [addrStart, addrStart + length) and returns the new Watchpoint
+        '''
+        watchpoint = Watchpoint(addrStart, addrStart + length, read, write, condition, ignoreCount)
+        for page in watchpoint.pages():
+            if read: self._watch(self._pageReadWatchpoints, page, watchpoint, self._memory.addReadHook, self._onRead)
+            if write: self._watch(self._pageWriteWatchpoints, page, watchpoint, self._memory.addWriteHook, self._onWrite)
+        return watchpoint
+
+    def removeWatchpoint(self, watchpoint):
+        for page in watchpoint.pages():
+            if watchpoint.read: self._unwatch(self._pageReadWatchpoints, page, watchpoint, self._memory.removeReadHook, self._onRead)
+            if watchpoint.write: self._unwatch(self._pageWriteWatchpoints, page, watchpoint, self._memory.removeWriteHook, self._onWrite)
+
+    def _watch(self, pageWatchpoints, page, watchpoint, addHook, hook):
+        if pageWatchpoints[page] is None:
+            pageWatchpoints[page] = []
+            addHook(page, hook)
+        pageWatchpoints[page].append(watchpoint)
+
+    def _unwatch(self, pageWatchpoints, page, watchpoint, removeHook, hook):
+        pageWatchpoints[page].remove(watchpoint)
+        if not pageWatchpoints[page]:
+            pageWatchpoints[page] = None
+            removeHook(page, hook)
+
+    def _onRead(self, addr, val):
+        for watchpoint in self._pageReadWatchpoints[addr >> 8]:
+            if watchpoint._check(self._cpu, addr, val): self._stop(watchpoint)
+
+    def _onWrite(self, addr, val):
+        for watchpoint in self._pageWriteWatchpoints[addr >> 8]:
+            if watchpoint._check(self._cpu, addr, val): self._stop(watchpoint)
+
+    def _stop(self, watchpoint):
+        '''
+        stops the run after the current instruction
+        '''
+        if self._pendingHit is None: self._pendingHit = watchpoint
+        self._runMap[:] = everywhere
+        # a running block returns after the write
+        blockCache = self._cpu._blockCache
+        if blockCache is not None: blockCache.stale = True
+
+    def _checkBreakpoints(self, pc):
+        '''
+        evaluates the conditions of the breakpoints at pc, returns the first one hit or None
+        '''
+        hit = None
+        for breakpoint in self._breakpoints.get(pc, ()):
+            if breakpoint._check(self._cpu) and hit is None: hit = breakpoint
+        return hit
+
+    def run(self, maxInstructions=None, maxCycles=None, trap=True, brk=True):
+        '''
+        CPU.runUntil with breakpoints and watchpoints. Stops with RunResult.STOP_BREAKPOINT when one is hit,
+        which is then in self.hit. A run started at a breakpoint doesn't stop there again before executing it.
+        Returns a RunResult covering the whole run.
+        '''
+        cpu = self._cpu
+        unlimited = 1 << 62
+        instructionsLeft = unlimited if maxInstructions is None else maxInstructions
+        cyclesLeft = unlimited if maxCycles is None else maxCycles
+        blocks = not any(self._pageReadWatchpoints)
+        condition = StopCondition(trap, brk=brk, breakpointMap=self._runMap, blocks=blocks)
+        stepCondition = StopCondition(trap, brk=brk, blocks=False)
+        instructions = cycles = 0
+        wallTime = 0.0
+        self.hit = None
+        self._pendingHit = None
+        # step over the breakpoint we are standing on
+        step = self._breakpointMap[cpu.pc]
+
+        while True:
+            self._runMap[:] = self._breakpointMap
+            if step: result = cpu.runUntil(stepCondition, 1, cyclesLeft)
+            else: result = cpu.runUntil(condition, instructionsLeft, cyclesLeft)
+            instructions += result.instructions
+            cycles += result.cycles
+            wallTime += result.wallTime
+            instructionsLeft -= result.instructions
+            cyclesLeft -= result.cycles
+            reason = result.reason
+
+            if self._pendingHit is not None:
+                self.hit = self._pendingHit
+                self._pendingHit = None
+                self._runMap[:] = self._breakpointMap
+                return RunResult(RunResult.STOP_BREAKPOINT, cpu.pc, instructions, cycles, wallTime)
+            if reason == RunResult.STOP_BREAKPOINT:
+                self.hit = self._checkBreakpoints(cpu.pc)
+                if self.hit is not None: return RunResult(reason, cpu.pc, instructions, cycles, wallTime)
+                # condition not met: execute the instruction and go on
+                step = True
+                continue
+            if step and reason == RunResult.STOP_MAX_INSTRUCTIONS:
+                if cyclesLeft <= 0: reason = RunResult.STOP_MAX_CYCLES
+                elif instructionsLeft > 0:
+                    step = False
+                    continue
+            return RunResult(reason, cpu.pc, instructions, cycles, wallTime)
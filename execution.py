@@ -1,1134 +1,421 @@
-
-def Load2ByteAddrIndexed(cpu, reg):
+'''
+Op-code handlers, generated from a declarative table.
+
+Every row of opcodeTable is (op-code, operation, addressing mode, base clock cycles, page-cross penalty).
+At import, each row is turned into the python source of one straight-line handler: the addressing mode's
+address computation from the pre-decoded operand, followed by the operation and the clock cycles.
+The source is compiled once into a factory taking (cpu, memory), so each CPU gets closures over its own
+registers and memory without any further calls per instruction, apart from memory.getByte / setByte for data.
+
+Adding an op-code is adding a row, plus a template in operations if the operation is new.
+print(handlerSource(*row)) shows the source generated for a row.
+'''
+import flags
+from flags import *
+
+addressingModes = {
+    # mode:       (instruction length, handler parameter, source computing addr, base address for the page-cross check or None)
+    "implied":    (1, "operand", [], None),
+    "immediate":  (2, "val", [], None),
+    "relative":   (2, "offset", [], None),
+    "zeroPage":   (2, "addr", [], None),
+    "zeroPageX":  (2, "operand", ["addr = (operand + cpu.x) & 0xFF"], None),
+    "zeroPageY":  (2, "operand", ["addr = (operand + cpu.y) & 0xFF"], None),
+    "absolute":   (3, "addr", [], None),
+    "absoluteX":  (3, "operand", ["addr = (operand + cpu.x) & 0xFFFF"], "operand"),
+    "absoluteY":  (3, "operand", ["addr = (operand + cpu.y) & 0xFFFF"], "operand"),
+    "indirectX":  (2, "operand", ["pointer = (operand + cpu.x) & 0xFF",
+                                  "addr = memory.getByte(pointer) | memory.getByte((pointer + 1) & 0xFF) << 8"], None),
+    "indirectY":  (2, "operand", ["base = memory.getByte(operand) | memory.getByte((operand + 1) & 0xFF) << 8",
+                                  "addr = (base + cpu.y) & 0xFFFF"], "base"),
+    # JMP ($xxFF) reads the high byte from $xx00, like the NMOS 6502
+    "indirect":   (3, "operand", ["addr = memory.getByte(operand) | memory.getByte((operand & 0xFF00) | ((operand + 1) & 0xFF)) << 8"], None),
+}
+"""
+Handlers are called by the decode stage (see CPU.decodeInstruction) as handler(operand), with PC already
+advanced past the instruction. operand is the instruction's operand byte, or its little endian operand word
+for three byte instructions, and 0 for implied ones. For the zero page and absolute modes that is the
+effective address, so these handlers name their parameter addr and fetch nothing themselves.
+"""
+
+def loadInto(register):
+    return ["cpu." + register + " = val", "cpu._zn = val"]
+
+def logic(operator):
+    return ["val = cpu.a " + operator + " val", "cpu.a = val", "cpu._zn = val"]
+
+def compareWith(register):
+    return ["reg = cpu." + register,
+            "cpu._zn = (reg - val) & 0xFF",
+            "if reg >= val: cpu._p |= CARRY",
+            "else: cpu._p &= ~CARRY"]
+
+def transfer(origin, destination, setsFlags=True):
+    return ["val = cpu." + origin, "cpu." + destination + " = val"] + (["cpu._zn = val"] if setsFlags else [])
+
+def decrement(register):
+    return ["val = (cpu." + register + " + 0xFF) & 0xFF", "cpu." + register + " = val", "cpu._zn = val"]
+
+def branch(condition):
+    return [condition]
+
+# ADC / SBC: result and N, Z, C, V come from one lookup in the (binary or decimal) table, see flags.py.
+# Binary SBC is ADC of the inverted operand; decimal mode Z and N don't follow the result.
+addWithCarry = [
+    "p = cpu._p",
+    "if p & DECIMAL:",
+    "    entry = flags.adcDecimalTable[(p & CARRY) << 16 | cpu.a << 8 | val]",
+    "    cpu._zn = znResults[(entry >> 8) & ZN]",
+    "else:",
+    "    entry = flags.adcTable[(p & CARRY) << 16 | cpu.a << 8 | val]",
+    "    cpu._zn = entry & 0xFF",
+    "cpu.a = entry & 0xFF",
+    "cpu._p = (p & ~ZNCV) | (entry >> 8)"
+]
+subtractWithBorrow = [
+    "p = cpu._p",
+    "if p & DECIMAL:",
+    "    entry = flags.sbcDecimalTable[(p & CARRY) << 16 | cpu.a << 8 | val]",
+    "    cpu._zn = znResults[(entry >> 8) & ZN]",
+    "else:",
+    "    entry = flags.adcTable[(p & CARRY) << 16 | cpu.a << 8 | (val ^ 0xFF)]",
+    "    cpu._zn = entry & 0xFF",
+    "cpu.a = entry & 0xFF",
+    "cpu._p = (p & ~ZNCV) | (entry >> 8)"
+]
+
+READ = "read"
+WRITE = "write"
+MODIFY = "modify"
+IMPLIED = "implied"
+BRANCH = "branch"
+JUMP = "jump"
+
+operations = {
+    # operation: (kind, source)
+    # READ gets the operand in val, WRITE stores val to addr, MODIFY reads addr into val and writes val back,
+    # BRANCH is a condition, JUMP sets cpu.pc itself.
+    "LDA": (READ, loadInto("a")),
+    "LDX": (READ, loadInto("x")),
+    "LDY": (READ, loadInto("y")),
+    "ADC": (READ, addWithCarry),
+    "SBC": (READ, subtractWithBorrow),
+    "AND": (READ, logic("&")),
+    "ORA": (READ, logic("|")),
+    "EOR": (READ, logic("^")),
+    "CMP": (READ, compareWith("a")),
+    "CPX": (READ, compareWith("x")),
+    "CPY": (READ, compareWith("y")),
+
+    "STA": (WRITE, ["val = cpu.a"]),
+    "STX": (WRITE, ["val = cpu.x"]),
+    "STY": (WRITE, ["val = cpu.y"]),
+
+    "INC": (MODIFY, ["val = (val + 1) & 0xFF", "cpu._zn = val"]),
+
+    "NOP": (IMPLIED, []),
+    "CLD": (IMPLIED, ["cpu._p &= ~DECIMAL"]),
+    "CLI": (IMPLIED, ["cpu._p &= ~INTERRUPT"]),
+    "SEI": (IMPLIED, ["cpu._p |= INTERRUPT"]),
+    "TAX": (IMPLIED, transfer("a", "x")),
+    "TAY": (IMPLIED, transfer("a", "y")),
+    "TSX": (IMPLIED, transfer("sp", "x")),
+    "TXA": (IMPLIED, transfer("x", "a")),
+    "TYA": (IMPLIED, transfer("y", "a")),
+    "TXS": (IMPLIED, transfer("x", "sp", setsFlags=False)),
+    "DEX": (IMPLIED, decrement("x")),
+    "DEY": (IMPLIED, decrement("y")),
+    "PHA": (IMPLIED, ["sp = cpu.sp",
+                      "memory.setByte(0x0100 + sp, cpu.a)",
+                      "cpu.sp = (sp + 0xFF) & 0xFF"]),
+    "PHP": (IMPLIED, ["sp = cpu.sp",
+                      "memory.setByte(0x0100 + sp, ((cpu._p & ~ZN) | znFlags[cpu._zn]) & ~(BREAK | UNUSED))",
+                      "cpu.sp = (sp + 0xFF) & 0xFF"]),
+    "PLA": (IMPLIED, ["sp = (cpu.sp + 1) & 0xFF",
+                      "val = memory.getByte(0x0100 + sp)",
+                      "cpu.sp = sp"] + loadInto("a")),
+    "PLP": (IMPLIED, ["sp = (cpu.sp + 1) & 0xFF",
+                      "val = memory.getByte(0x0100 + sp)",
+                      "cpu.sp = sp",
+                      "cpu._p = (cpu._p & (BREAK | UNUSED)) | (val & ~(BREAK | UNUSED))",
+                      "cpu._zn = znResults[val & ZN]"]),
+
+    # Z and N are read straight from the last result (see flags.znResults): Z if its low byte is 0, N if bit 7 or 8 is set
+    "BCC": (BRANCH, branch("not cpu._p & CARRY")),
+    "BCS": (BRANCH, branch("cpu._p & CARRY")),
+    "BEQ": (BRANCH, branch("not cpu._zn & 0xFF")),
+    "BMI": (BRANCH, branch("cpu._zn & 0x180")),
+    "BNE": (BRANCH, branch("cpu._zn & 0xFF")),
+    "BPL": (BRANCH, branch("not cpu._zn & 0x180")),
+    "BVC": (BRANCH, branch("not cpu._p & OVERFLOW")),
+    "BVS": (BRANCH, branch("cpu._p & OVERFLOW")),
+
+    "JMP": (JUMP, ["cpu.pc = addr"]),
+    # pushes the address of the last byte of the JSR, high byte first
+    "JSR": (JUMP, ["returnAddr = (cpu.pc + 0xFFFF) & 0xFFFF",
+                   "sp = cpu.sp",
+                   "memory.setByte(0x0100 + sp, returnAddr >> 8)",
+                   "memory.setByte(0x0100 + ((sp + 0xFF) & 0xFF), returnAddr & 0xFF)",
+                   "cpu.sp = (sp + 0xFE) & 0xFF",
+                   "cpu.pc = addr"]),
+    "RTS": (JUMP, ["sp = cpu.sp",
+                   "addr = memory.getByte(0x0100 + ((sp + 1) & 0xFF)) | memory.getByte(0x0100 + ((sp + 2) & 0xFF)) << 8",
+                   "cpu.sp = (sp + 2) & 0xFF",
+                   "cpu.pc = (addr + 1) & 0xFFFF"]),
+    # pulls P, then PC, as pushed by an interrupt (see CPU.interrupt)
+    "RTI": (JUMP, ["sp = cpu.sp",
+                   "val = memory.getByte(0x0100 + ((sp + 1) & 0xFF))",
+                   "cpu._p = (cpu._p & (BREAK | UNUSED)) | (val & ~(BREAK | UNUSED))",
+                   "cpu._zn = znResults[val & ZN]",
+                   "cpu.pc = memory.getByte(0x0100 + ((sp + 2) & 0xFF)) | memory.getByte(0x0100 + ((sp + 3) & 0xFF)) << 8",
+                   "cpu.sp = (sp + 3) & 0xFF"]),
+}
+
+def group(operation, cycles, modes=("immediate", "zeroPage", "zeroPageX", "absolute", "absoluteX", "absoluteY", "indirectX", "indirectY")):
     '''
-    loads 2 bytes, and returns a tuple. Takes index register.
-    (boundaryCrossed, addrIndexed)
+    rows for the classic aaabbbcc group one op-codes (ORA, AND, EOR, ADC, STA, LDA, CMP, SBC), which use
+    the same addressing modes at the same positions. cycles lists the base cycles per mode in that order;
+    indexed modes, except for stores, take one more cycle when indexing crosses a page.
     '''
-    addr = cpu.fetchNext2()
-    addrIndexed = (addr + cpu.getRegister(reg)) & 0xFFFF
-    return addr // 256 != addrIndexed // 256, addrIndexed
-
-# NOP
-def executeNOP(cpu): return lambda: cpu.incrementPC().addClockCyclesThisCycle(2)
-
-# Transfer
-def transfer(origin, destination, cpu):
-    reg = cpu.getRegister(origin)
-    cpu.setRegister(destination, reg)
-    cpu.incrementPC().addClockCyclesThisCycle(2)
-    setDecIncFlags(reg, cpu)
-
-def executeTAX(cpu): return lambda: transfer("A",  "X",  cpu)
-def executeTAY(cpu): return lambda: transfer("A",  "Y",  cpu)
-def executeTSX(cpu): return lambda: transfer("SP", "X",  cpu)
-def executeTXA(cpu): return lambda: transfer("X",  "A",  cpu)
-def executeTYA(cpu): return lambda: transfer("Y",  "A",  cpu)
-def executeTXS(cpu):
-    def execute():
-        x = cpu.getRegister("X")
-        cpu.setRegister("SP", x)
-        cpu.incrementPC().addClockCyclesThisCycle(2)
-    return execute
-
-# CLD
-def executeCLD(cpu):
-    def execute():
-        cpu.setFlag("decimal mode", False)
-        cpu.addClockCyclesThisCycle(2)
-        cpu.incrementPC()
-
-    return execute
-
-# BRANCH
-def executeBranch(branch, cpu):
-    cpu.incrementPC().fetchInstruction()
-
-    if branch:
-        pcBefore = cpu.getPC()
-        offset = cpu.currentInstruction - 256 if cpu.currentInstruction > 127 else cpu.currentInstruction
-        pcAfter = (pcBefore + offset + 1) & 0xFFFF
-        cpu.setPC(pcAfter)
-
-        if pcBefore // 256 != pcAfter // 256:
-            cpu.addClockCyclesThisCycle(4)
-        else:
-            cpu.addClockCyclesThisCycle(3)
+    aaa = ["ORA", "AND", "EOR", "ADC", "STA", "LDA", "CMP", "SBC"].index(operation)
+    bbbOf = {"indirectX": 0, "zeroPage": 1, "immediate": 2, "absolute": 3, "indirectY": 4, "zeroPageX": 5, "absoluteY": 6, "absoluteX": 7}
+    penalty = operation != "STA"
+    return [(aaa << 5 | bbbOf[mode] << 2 | 0b01, operation, mode, modeCycles, penalty and mode in ("absoluteX", "absoluteY", "indirectY"))
+            for mode, modeCycles in zip(modes, cycles)]
+
+opcodeTable = [
+    # (op-code, operation, addressing mode, base cycles, page-cross penalty)
+    (0xEA, "NOP", "implied", 2, False),
+    (0xD8, "CLD", "implied", 2, False),
+    (0x58, "CLI", "implied", 2, False),
+    (0x78, "SEI", "implied", 2, False),
+
+    # Transfer
+    (0xAA, "TAX", "implied", 2, False),
+    (0xA8, "TAY", "implied", 2, False),
+    (0xBA, "TSX", "implied", 2, False),
+    (0x8A, "TXA", "implied", 2, False),
+    (0x9A, "TXS", "implied", 2, False),
+    (0x98, "TYA", "implied", 2, False),
+
+    # Stack
+    (0x48, "PHA", "implied", 4, False),
+    (0x08, "PHP", "implied", 4, False),
+    (0x68, "PLA", "implied", 4, False),
+    (0x28, "PLP", "implied", 4, False),
+
+    # Branch: one more cycle if taken, two if the target is on another page than the next instruction
+    (0x90, "BCC", "relative", 2, True),
+    (0xB0, "BCS", "relative", 2, True),
+    (0xF0, "BEQ", "relative", 2, True),
+    (0x30, "BMI", "relative", 2, True),
+    (0xD0, "BNE", "relative", 2, True),
+    (0x10, "BPL", "relative", 2, True),
+    (0x50, "BVC", "relative", 2, True),
+    (0x70, "BVS", "relative", 2, True),
+
+    # JMP, JSR, RTS, RTI
+    (0x4C, "JMP", "absolute", 3, False),
+    (0x6C, "JMP", "indirect", 5, False),
+    (0x20, "JSR", "absolute", 6, False),
+    (0x60, "RTS", "implied", 6, False),
+    (0x40, "RTI", "implied", 6, False),
+
+    # CPX CPY
+    (0xE0, "CPX", "immediate", 2, False),
+    (0xE4, "CPX", "zeroPage", 3, False),
+    (0xEC, "CPX", "absolute", 4, False),
+    (0xC0, "CPY", "immediate", 2, False),
+    (0xC4, "CPY", "zeroPage", 3, False),
+    (0xCC, "CPY", "absolute", 4, False),
+
+    # STX STY
+    (0x86, "STX", "zeroPage", 3, False),
+    (0x96, "STX", "zeroPageY", 4, False),
+    (0x8E, "STX", "absolute", 4, False),
+    (0x84, "STY", "zeroPage", 3, False),
+    (0x94, "STY", "zeroPageX", 4, False),
+    (0x8C, "STY", "absolute", 4, False),
+
+    # Increment and decrement
+    (0xE6, "INC", "zeroPage", 5, False),
+    (0xF6, "INC", "zeroPageX", 6, False),
+    (0xEE, "INC", "absolute", 6, False),
+    (0xFE, "INC", "absoluteX", 7, False),
+    (0xCA, "DEX", "implied", 2, False),
+    (0x88, "DEY", "implied", 2, False),
+
+    # LDX LDY
+    (0xA2, "LDX", "immediate", 2, False),
+    (0xA6, "LDX", "zeroPage", 3, False),
+    (0xB6, "LDX", "zeroPageY", 4, False),
+    (0xAE, "LDX", "absolute", 4, False),
+    (0xBE, "LDX", "absoluteY", 4, True),
+    (0xA0, "LDY", "immediate", 2, False),
+    (0xA4, "LDY", "zeroPage", 3, False),
+    (0xB4, "LDY", "zeroPageX", 4, False),
+    (0xAC, "LDY", "absolute", 4, False),
+    (0xBC, "LDY", "absoluteX", 4, True),
+]
+# group one: immediate, zeroPage, zeroPageX, absolute, absoluteX, absoluteY, indirectX, indirectY
+opcodeTable += group("ORA", [2, 3, 4, 4, 4, 4, 6, 5])
+opcodeTable += group("AND", [2, 3, 4, 4, 4, 4, 6, 5])
+opcodeTable += group("EOR", [2, 3, 4, 4, 4, 4, 6, 5])
+opcodeTable += group("ADC", [2, 3, 4, 4, 4, 4, 6, 5])
+opcodeTable += group("SBC", [2, 3, 4, 4, 4, 4, 6, 5])
+opcodeTable += group("LDA", [2, 3, 4, 4, 4, 4, 6, 5])
+# CMP (indirect,X) and (indirect),Y aren't implemented yet
+opcodeTable += group("CMP", [2, 3, 4, 4, 4, 4], ("immediate", "zeroPage", "zeroPageX", "absolute", "absoluteX", "absoluteY"))
+opcodeTable += group("STA", [3, 4, 4, 5, 5, 6, 6], ("zeroPage", "zeroPageX", "absolute", "absoluteX", "absoluteY", "indirectX", "indirectY"))
+
+def handlerLines(opcode, operation, mode, cycles, pageCrossPenalty, extraCycles=0):
+    '''
+    returns (parameter, lines, cycle count) of the handler body for one opcodeTable row. The lines of branches
+    add their clock cycles themselves, the others leave adding the cycle count (an expression) to the caller.
+    extraCycles are added on top, to account for a fused instruction in the same addition.
+    '''
+    length, parameter, addressing, pageBase = addressingModes[mode]
+    kind, body = operations[operation]
+    lines = []
+    # the page-cross penalty is added as a bool
+    cycleCount = str(cycles + extraCycles)
+    if pageCrossPenalty and pageBase is not None: cycleCount += " + (" + pageBase + " >> 8 != addr >> 8)"
+
+    if kind == BRANCH:
+        lines += ["if " + body[0] + ":",
+                  "    nextPC = cpu.pc",
+                  "    addr = (nextPC + offset - (offset & 0x80) * 2) & 0xFFFF",
+                  "    cpu.pc = addr",
+                  "    cpu._clockCyclesThisCycle += " + str(cycles + extraCycles + 1) + (" + (nextPC >> 8 != addr >> 8)" if pageCrossPenalty else ""),
+                  "else:",
+                  "    cpu._clockCyclesThisCycle += " + str(cycles + extraCycles)]
+        return parameter, lines, None
+
+    lines += addressing
+    if kind == READ:
+        if mode != "immediate": lines.append("val = memory.getByte(addr)")
+        lines += body
+    elif kind == WRITE:
+        lines += body
+        lines.append("memory.setByte(addr, val)")
+    elif kind == MODIFY:
+        lines.append("val = memory.getByte(addr)")
+        lines += body
+        lines.append("memory.setByte(addr, val)")
     else:
-        cpu.incrementPC().addClockCyclesThisCycle(2)
+        lines += body
+    return parameter, lines, cycleCount
 
-def executeBCC(cpu): return lambda: executeBranch(not cpu.getFlag("carry"),    cpu)
-def executeBCS(cpu): return lambda:     executeBranch(cpu.getFlag("carry"),    cpu)
-def executeBEQ(cpu): return lambda:     executeBranch(cpu.getFlag("zero"),     cpu)
-def executeBMI(cpu): return lambda:     executeBranch(cpu.getFlag("negative"), cpu)
-def executeBNE(cpu): return lambda: executeBranch(not cpu.getFlag("zero"),     cpu)
-def executeBPL(cpu): return lambda: executeBranch(not cpu.getFlag("negative"), cpu)
-def executeBVC(cpu): return lambda: executeBranch(not cpu.getFlag("overflow"), cpu)
-def executeBVS(cpu): return lambda:     executeBranch(cpu.getFlag("overflow"), cpu)
-
-# JMP
-def executeJumpDirect(cpu): return lambda: cpu.setPC(cpu.fetchNext2()).addClockCyclesThisCycle(3)
-def executeJumpIndirect(cpu, memory):
-    def execute():
-        addr = cpu.fetchNext2()
-        lookupAddr = cpu.currentInstruction
-        lookupAddrNext = (lookupAddr + 1) & 0xFF
-        addrLo = memory.getByte(lookupAddr)
-        addrHi = memory.getByte(lookupAddrNext)
-        result16 = addrHi << 8 | addrLo
-        cpu.setPC(result16).addClockCyclesThisCycle(5)
-    return execute
-
-def executeStackPull(cpu, memory, reg):
+def handlerSource(opcode, operation, mode, cycles, pageCrossPenalty):
     '''
-    reg = A or Flags
+    returns the source of the factory make(cpu, memory) -> handler for one opcodeTable row
     '''
-    def execute():
-        sp = cpu.getRegister("SP")
-        addr = 0x0100 + sp
-        operand = memory.getByte(addr)
-
-        if reg == "Flags": cpu.setFlagsFromByte(operand)
-        elif reg == "A":
-            cpu.setRegister("A", operand)
-            setZNFlags(operand, cpu)
-
-        spNew = (sp + 1) & 0xFF
-        cpu.setRegister("SP", spNew)
-        
-        cpu.incrementPC().addClockCyclesThisCycle(4)
-    return execute
-
-def executeStackPush(cpu, memory, reg):
+    parameter, lines, cycleCount = handlerLines(opcode, operation, mode, cycles, pageCrossPenalty)
+    if cycleCount is not None: lines.append("cpu._clockCyclesThisCycle += " + cycleCount)
+
+    name = operation + "_" + mode
+    return "\n".join(["def make(cpu, memory):",
+                      "    def " + name + "(" + parameter + "):"] +
+                     ["        " + line for line in lines] +
+                     ["    return " + name])
+
+def compileFactory(source, filename):
+    namespace = {"flags": flags}
+    namespace.update({name: getattr(flags, name) for name in ("CARRY", "INTERRUPT", "DECIMAL", "OVERFLOW", "BREAK", "UNUSED", "ZN", "ZNCV", "znFlags", "znResults")})
+    exec(compile(source, filename, "exec"), namespace)
+    return namespace["make"]
+
+def buildFactory(row):
+    return compileFactory(handlerSource(*row), "<op-code " + format(row[0], "02X") + " " + row[1] + " " + row[2] + ">")
+
+handlerFactories = {row[0]: buildFactory(row) for row in opcodeTable}
+"""
+op-code -> make(cpu, memory) returning the handler, compiled at import
+"""
+
+def buildDecodeLookupTable(cpu, memory):
     '''
-    reg = A or Flags
+    returns a dict mapping every implemented op-code to its handler for cpu and memory
     '''
-    def execute():
-        sp = cpu.getRegister("SP")
-        addr = 0x0100 + sp
-
-        if reg == "Flags": 
-            flagByte = cpu.getByteFromFlags()
-            memory.setByte(addr, flagByte)
-        elif reg == "A":
-            a = cpu.getRegister("A")
-            memory.setByte(addr, a)
-
-        spNew = (sp + 0xFF) & 0xFF
-        cpu.setRegister("SP", spNew)
-        
-        cpu.incrementPC().addClockCyclesThisCycle(4)
-    return execute
-
-# CPX and CPY TODO tests
-def setCPRegFlags(cpu, regOperand, operand):
-    result = (regOperand - operand) & 0xFF
-    cpu.setFlag("carry", regOperand >= operand)
-    cpu.setFlag("zero", result == 0)
-    cpu.setFlag("negative", (result & 0b10000000) != 0)
-
-def executeCPRegImmediate(cpu, reg):
-    def execute():
-        cpu.incrementPC()
-        operand = cpu.currentInstruction
-        regOperand = cpu.getRegister(reg)
-
-        setCPRegFlags(cpu, regOperand, operand)
-
-        cpu.incrementPC().addClockCyclesThisCycle(2)
-    return execute
-
-def executeCPRegZeroPage(cpu, memory, reg):
-    def execute():
-        cpu.incrementPC()
-        operand = memory.getByte(cpu.currentInstruction)
-        regOperand = cpu.getRegister(reg)
-
-        setCPRegFlags(cpu, regOperand, operand)
-
-        cpu.incrementPC().addClockCyclesThisCycle(3)
-    return execute
-
-def executeCPRegZeroPageX(cpu, memory, reg):
-    def execute():
-        cpu.incrementPC()
-        addr = cpu.currentInstruction
-        addrOffset = (addr + cpu.getRegister(reg)) & 0xFF
-        operand = memory.getByte(addrOffset)
-        regOperand = cpu.getRegister(reg)
-
-        setCPRegFlags(cpu, regOperand, operand)
-
-        cpu.incrementPC().addClockCyclesThisCycle(3)
-    return execute
-
-def executeCPRegAbsolute(cpu, memory, reg):
-    def execute():
-        addr = cpu.fetchNext2()
-        operand = memory.getByte(addr)
-        regOperand = cpu.getRegister(reg)
-
-        setCPRegFlags(cpu, regOperand, operand)
-
-        cpu.incrementPC().addClockCyclesThisCycle(4)
-    return execute
-
-def executeCPRegAbsoluteIndexed(cpu, memory, opReg, indexReg):
-    def execute():
-        boundaryCrossed, addr = Load2ByteAddrIndexed(cpu, indexReg)
-        operand = memory.getByte(addr)
-        reg = cpu.getRegister(opReg)
-
-        setCPRegFlags(cpu, reg, operand)
-
-        if boundaryCrossed: cpu.addClockCyclesThisCycle(1)
-        cpu.incrementPC().addClockCyclesThisCycle(4)
-    return execute
-
-def executeCPRegIndirectIndexed(cpu, memory, opReg, indexReg):
-    def executeX():
-        lookupAddr = (cpu.fetchNext() + cpu.getRegister("X")) & 0xFF
-        lookupAddrNext = (lookupAddr + 1) & 0xFF
-        addrLo = memory.getByte(lookupAddr)
-        addrHi = memory.getByte(lookupAddrNext)
-        addr = (addrHi << 8) | addrLo
-        operand = memory.getByte(addr)
-        reg = cpu.getRegister(opReg)
-
-        setCPRegFlags(cpu, reg, operand)
-
-        cpu.incrementPC().addClockCyclesThisCycle(6)
-    
-    def executeY():
-        cpu.incrementPC().fetchInstruction()
-        lookupAddr = (cpu.currentInstruction) & 0xFF
-        lookupAddrNext = (lookupAddr + 1) & 0xFF
-        addrLo = memory.getByte(lookupAddr)
-        addrHi = memory.getByte(lookupAddrNext)
-        addr = (addrHi << 8) | addrLo
-        addrOffset = (addr + cpu.getRegister("Y")) & 0xFFFF
-        reg = cpu.getRegister(opReg)
-
-        setCPRegFlags(cpu, reg, operand)
-
-        if addr // 256 != addrOffset // 256: cpu.addClockCyclesThisCycle(1)
-        cpu.incrementPC().addClockCyclesThisCycle(5)
-    return executeX if indexReg == "X" else executeY
-
-# STA TODO tests
-def executeSTAZeroPage(cpu, memory):
-    def execute():
-        cpu.incrementPC().fetchInstruction()
-        addr = cpu.currentInstruction
-        a = cpu.getRegister("A")
-
-        memory.setByte(addr, a)
-
-        cpu.incrementPC().addClockCyclesThisCycle(3)
-    return execute
-
-def executeSTAZeroPageX(cpu, memory):
-    def execute():
-        cpu.incrementPC().cpu.fetchInstruction()
-        addr = (cpu.currentInstruction + cpu.getRegister("X")) &0xFF
-        a = cpu.getRegister("A")
-
-        memory.setByte(addr, a)
-
-        cpu.incrementPC().addClockCyclesThisCycle(4)
-    return execute
-
-def executeSTAAbsolute(cpu, memory):
-    def execute():
-        addr = cpu.fetchNext2()
-        a = cpu.getRegister("A")
-
-        memory.setByte(addr, a)
-
-        cpu.incrementPC().addClockCyclesThisCycle(4)
-    return execute
-
-def executeSTAAbsoluteIndexed(cpu, memory, register):
-    def execute():
-        addr = (cpu.fetchNext2() + cpu.getRegister(register)) & 0xFFFF
-        a = cpu.getRegister("A")
-
-        memory.setByte(addr, a)
-
-        cpu.incrementPC().addClockCyclesThisCycle(5)
-    return execute
-
-def executeSTAIndirectIndexed(cpu, memory, register):
-    def executeX():
-        cpu.incrementPC().fetchInstruction()
-        lookupAddr = (cpu.currentInstruction + cpu.getRegister("X")) & 0xFF
-        lookupAddrNext = (lookupAddr + 1) & 0xFF
-        addrLo = memory.getByte(lookupAddr)
-        addrHi = memory.getByte(lookupAddrNext)
-        addr = addrHi << 8 | addrLo
-
-        a = cpu.getRegister("A")
-        memory.setByte(addr, a)
-
-        cpu.incrementPC().addClockCyclesThisCycle(6)
-    
-    def executeY():
-        cpu.incrementPC().fetchInstruction()
-        lookupAddr = cpu.currentInstruction
-        lookupAddrNext = (lookupAddr + 1) & 0xFF
-        addrLo = memory.getByte(lookupAddr)
-        addrHi = memory.getByte(lookupAddrNext)
-        addr = (addrHi << 8) | addrLo
-        addrOffset = (addr + cpu.getRegister("Y")) & 0xFFFF
-
-        a = cpu.getRegister("A")
-        memory.setByte(addrOffset, a)
-
-        cpu.incrementPC().addClockCyclesThisCycle(6)
-    return executeX if register == "X" else executeY
-
-# STX
-def executeSTXZeroPage(cpu, memory):
-    def execute():
-        cpu.incrementPC().fetchInstruction()
-        addr = cpu.currentInstruction
-        result8 = memory.getByte(addr)
-        cpu.setRegister("X", result8)
-        cpu.incrementPC().addClockCyclesThisCycle(3)
-    return execute
-
-def executeSTXZeroPageY(cpu, memory):
-    def execute():
-        cpu.incrementPC().fetchInstruction()
-        addr = (cpu.currentInstruction + cpu.getRegister("Y")) &0xFF
-        result8 = memory.getByte(addr)
-        cpu.setRegister("X", result8)
-        cpu.incrementPC().addClockCyclesThisCycle(4)
-    return execute
-
-def executeSTXAbsolute(cpu, memory):
-    def execute():
-        addr = cpu.fetchNext2()
-        result8 = memory.getByte(addr)
-        cpu.setRegister("X", result8)
-        cpu.incrementPC().addClockCyclesThisCycle(4)
-    return execute
-
-# STY
-def executeSTYZeroPage(cpu, memory):
-    def execute():
-        cpu.incrementPC().fetchInstruction()
-        addr = cpu.currentInstruction
-        result8 = memory.getByte(addr)
-        cpu.setRegister("Y", result8)
-        cpu.incrementPC().addClockCyclesThisCycle(3)
-    return execute
-
-def executeSTYZeroPageX(cpu, memory):
-    def execute():
-        cpu.incrementPC().fetchInstruction()
-        addr = (cpu.currentInstruction + cpu.getRegister("X")) & 0xFF
-        result8 = memory.getByte(addr)
-        cpu.setRegister("Y", result8)
-        cpu.incrementPC().addClockCyclesThisCycle(4)
-    return execute
-
-def executeSTYAbsolute(cpu, memory):
-    def execute():
-        addr = cpu.fetchNext2()
-        result8 = memory.getByte(addr)
-        cpu.setRegister("Y", result8)
-        cpu.incrementPC().addClockCyclesThisCycle(4)
-    return execute
-
-# increment TODO tests
-def setDecIncFlags(val, cpu):
-    cpu.setFlag("zero", val == 0)
-    cpu.setFlag("negative", val > 127)
-
-def executeINCZeroPage(cpu, memory):
-    def execute():
-        cpu.incrementPC().fetchInstruction()
-        addr = cpu.currentInstruction
-        result8 = (memory.getByte(addr) + 1) & 0xFF
-        memory.setByte(addr, result8)
-
-        setDecIncFlags(result8, cpu)
-        cpu.incrementPC().addClockCyclesThisCycle(5)
-    return execute
-
-def executeINCZeroPageX(cpu, memory):
-    def execute():
-        cpu.incrementPC().fetchInstruction()
-        addr = (cpu.currentInstruction + cpu.getRegister("X")) & 0xFF
-        result8 = (memory.getByte(addr) + 1) & 0xFF
-        memory.setByte(addr, result8)
-
-        setDecIncFlags(result8, cpu)
-        cpu.incrementPC().addClockCyclesThisCycle(6)
-    return execute
-
-def executeINCAbsolute(cpu, memory):
-    def execute():
-        addr = cpu.fetchNext2()
-        result8 = (memory.getByte(addr) + 1) & 0xFF
-        memory.setByte(addr, result8)
-
-        setDecIncFlags(result8, cpu)
-        cpu.incrementPC().addClockCyclesThisCycle(6)
-    return execute
-
-def executeINCAbsoluteX(cpu, memory):
-    def execute():
-        addr = (cpu.fetchNext2() + cpu.getRegister("X")) & 0xFFFF
-        result8 = (memory.getByte(addr) + 1) & 0xFF
-        memory.setByte(addr, result8)
-
-        setDecIncFlags(result8, cpu)
-        cpu.incrementPC().addClockCyclesThisCycle(7)
-    return execute
-
-# decrement TODO tests
-def executeDEX(cpu):
-    def execute():
-        x = cpu.getRegister("X")
-        xDec = (x + 0xFF) & 0xFF
-        cpu.setRegister("X", xDec)
-        setDecIncFlags(xDec, cpu)
-        cpu.incrementPC().addClockCyclesThisCycle(2)
-    return execute
-
-def executeDEY(cpu):
-    def execute():
-        y = cpu.getRegister("Y")
-        yDec = (y + 0xFF) & 0xFF
-        cpu.setRegister("Y", yDec)
-        setDecIncFlags(yDec, cpu)
-        cpu.incrementPC().addClockCyclesThisCycle(2)
-    return execute
-
-# ADC TODO refactor
-def setADCFlags(cpu, result16, result8, a, operand):
-    cpu.setFlag("carry", result16 > 0xFF)
-    same_sign = (a & 0x80) == (operand & 0x80)
-    sign_changed = (a & 0x80) != (result8 & 0x80)
-    overflow = same_sign and sign_changed
-    cpu.setFlag("overflow", overflow != 0)
-    cpu.setFlag("zero", result8 == 0)
-    cpu.setFlag("negative", result8 & 0x80 != 0)
-
-def executeADCImm(cpu):
-    def execute():
-        cpu.incrementPC().fetchInstruction()
-        operand = cpu.currentInstruction
-        carry_in = 1 if cpu.getFlag("carry") else 0
-        a = cpu.getRegister("A")
-
-        result16 = a + operand + carry_in
-        result8 = result16 &0xFF
-        cpu.setRegister("A", result8)
-
-        setADCFlags(cpu, result16, result8, a, operand)
-        cpu.incrementPC().addClockCyclesThisCycle(2)
-    return execute
-
-def executeADCZeroPage(cpu, memory):
-    def execute():
-        cpu.incrementPC().fetchInstruction()
-        operand = memory.getByte(cpu.currentInstruction)
-        carry_in = 1 if cpu.getFlag("carry") else 0
-        a = cpu.getRegister("A")
-
-        result16 = a + operand + carry_in
-        result8 = result16 &0xFF
-        cpu.setRegister("A", result8)
-
-        setADCFlags(cpu, result16, result8, a, operand)
-        cpu.incrementPC().addClockCyclesThisCycle(3)
-    return execute
-
-def executeADCZeroPageX(cpu, memory):
-    def execute():
-        cpu.incrementPC().fetchInstruction()
-        addr = cpu.currentInstruction
-        addrOffset = (addr + cpu.getRegister("X")) & 0xFF
-        operand = memory.getByte(addrOffset)
-        carry_in = 1 if cpu.getFlag("carry") else 0
-        a = cpu.getRegister("A")
-        result16 = a + operand + carry_in
-        result8 = result16 &0xFF
-        cpu.setRegister("A", result8)
-        setADCFlags(cpu, result16, result8, a, operand)
-        cpu.incrementPC().addClockCyclesThisCycle(4)
-    return execute
-
-def executeADCAbsolute(cpu, memory):
-    def execute():
-        operand = memory.getByte(cpu.fetchNext2())
-        carry_in = 1 if cpu.getFlag("carry") else 0
-        a = cpu.getRegister("A")
-
-        result16 = a + operand + carry_in
-        result8 = result16 &0xFF
-        cpu.setRegister("A", result8)
+    return {opcode: make(cpu, memory) for opcode, make in handlerFactories.items()}
 
-        setADCFlags(cpu, result16, result8, a, operand)
-        cpu.incrementPC().addClockCyclesThisCycle(4)
-    return execute
 
-def executeADCAbsoluteIndexed(cpu, memory, offsetRegister):
-    def execute():
-        addr = cpu.fetchNext2()
-        addrOffset = (addr + cpu.getRegister(offsetRegister)) & 0xFFFF
+# Superinstructions: a pair of op-codes which often run one after the other, fused into a single handler
+# handler(operand0, operand1), which compiled blocks call instead of the two handlers (see BlockCache).
 
-        operand = memory.getByte(addrOffset)
-        carry_in = 1 if cpu.getFlag("carry") else 0
-        a = cpu.getRegister("A")
+opcodeRows = {row[0]: row for row in opcodeTable}
 
-        result16 = a + operand + carry_in
-        result8 = result16 &0xFF
-        cpu.setRegister("A", result8)
+defaultFusedPairs = [
+    (0xCA, 0xD0), (0x88, 0xD0),                     # DEX BNE, DEY BNE
+    (0xA9, 0x85), (0xA9, 0x8D), (0xA5, 0x85),       # LDA STA
+    (0xAD, 0x8D), (0xBD, 0x9D), (0xB1, 0x91),
+    (0xC9, 0xF0), (0xC9, 0xD0), (0xC5, 0xF0), (0xC5, 0xD0), # CMP BEQ, CMP BNE
+    (0xE6, 0xD0),                                   # INC zp BNE
+]
+"""
+the pairs CPUs fuse unless told otherwise (CPU.fuseOpcodePairs), picked from op-code pair counts
+(OpcodeHistogram.fusionCandidates) of typical loops
+"""
 
-        setADCFlags(cpu, result16, result8, a, operand)
+def writesMemory(operation):
+    return operations[operation][0] in (WRITE, MODIFY) or operation in ("PHA", "PHP", "JSR")
 
-        # add one cycle if indexing resulted in page flip
-        if addrOffset // 256 != addr // 256: cpu.addClockCyclesThisCycle(1)
-        cpu.incrementPC().addClockCyclesThisCycle(4)
-    return execute
-
-def executeADCIndirectIndexed(cpu, memory, offsetRegister):
-    def executeX():
-        cpu.incrementPC().fetchInstruction()
-        lookupAddr = (cpu.currentInstruction + cpu.getRegister("X")) & 0xFF
-        lookupAddrNext = (lookupAddr + 1) & 0xFF
-        addrLo = memory.getByte(lookupAddr)
-        addrHi = memory.getByte(lookupAddrNext)
-        addr = addrHi << 8 | addrLo
-
-        operand = memory.getByte(addr)
-        carry_in = 1 if cpu.getFlag("carry") else 0
-        a = cpu.getRegister("A")
-
-        result16 = a + operand + carry_in
-        result8 = result16 &0xFF
-        cpu.setRegister("A", result8)
-
-        setADCFlags(cpu, result16, result8, a, operand)
-
-        cpu.incrementPC().addClockCyclesThisCycle(6)
-    
-    def executeY():
-        cpu.incrementPC().fetchInstruction()
-        lookupAddr = cpu.currentInstruction
-        lookupAddrNext = (lookupAddr + 1) & 0xFF
-        addrLo = memory.getByte(lookupAddr)
-        addrHi = memory.getByte(lookupAddrNext)
-        addr = (addrHi << 8) | addrLo
-        addrOffset = (addr + cpu.getRegister("Y")) & 0xFFFF
-
-        operand = memory.getByte(addrOffset)
-        carry_in = 1 if cpu.getFlag("carry") else 0
-        a = cpu.getRegister("A")
-
-        result16 = a + operand + carry_in
-        result8 = result16 &0xFF
-        cpu.setRegister("A", result8)
-
-        setADCFlags(cpu, result16, result8, a, operand)
-
-        # add one cycle if indexing resulted in page flip
-        if addr // 256 != addrOffset // 256: cpu.addClockCyclesThisCycle(1)
-        cpu.incrementPC().addClockCyclesThisCycle(5)
-    return executeX if offsetRegister == "X" else executeY
-
-# TODO SBC tests Refactor
-def executeSBCImm(cpu):
-    def execute():
-        cpu.incrementPC().fetchInstruction()
-        operand = cpu.currentInstruction
-        nOperand = (~operand + 1) & 0xFF
-        borrow_in = 0 if cpu.getFlag("carry") else 1
-        a = cpu.getRegister("A")
-
-        result16 = a + nOperand - borrow_in
-        result8 = result16 & 0xFF
-        cpu.setRegister("A", result8)
-
-        setADCFlags(cpu, result16, result8, a, ~operand)
-        cpu.incrementPC().addClockCyclesThisCycle(2)
-    return execute
-
-def executeSBCZeroPage(cpu, memory):
-    def execute():
-        cpu.incrementPC().fetchInstruction()
-        operand = memory.getByte(cpu.currentInstruction)
-        nOperand = (~operand + 1) & 0xFF
-        borrow_in = 0 if cpu.getFlag("carry") else 1
-        a = cpu.getRegister("A")
-
-        result16 = a + nOperand - borrow_in
-        result8 = result16 & 0xFF
-        cpu.setRegister("A", result8)
-
-        setADCFlags(cpu, result16, result8, a, ~operand)
-        cpu.incrementPC().addClockCyclesThisCycle(3)
-    return execute
-
-def executeSBCZeroPageX(cpu, memory):
-    def execute():
-        cpu.incrementPC().fetchInstruction()
-        addr = cpu.currentInstruction
-        addrOffset = (addr + cpu.getRegister("X")) & 0xFF
-        operand = memory.getByte(addrOffset)
-        nOperand = (~operand + 1) & 0xFF
-        borrow_in = 0 if cpu.getFlag("carry") else 1
-        a = cpu.getRegister("A")
-
-        result16 = a + nOperand - borrow_in
-        result8 = result16 & 0xFF
-        cpu.setRegister("A", result8)
-
-        setADCFlags(cpu, result16, result8, a, ~operand)
-        cpu.incrementPC().addClockCyclesThisCycle(4)
-    return execute
-
-def executeSBCAbsolute(cpu, memory):
-    def execute():
-        operand = memory.getByte(cpu.fetchNext2())
-        nOperand = (~operand + 1) & 0xFF
-        borrow_in = 0 if cpu.getFlag("carry") else 1
-        a = cpu.getRegister("A")
-
-        result16 = a + nOperand - borrow_in
-        result8 = result16 & 0xFF
-        cpu.setRegister("A", result8)
-
-        setADCFlags(cpu, result16, result8, a, ~operand)
-        cpu.incrementPC().addClockCyclesThisCycle(4)
-    return execute
-
-def executeSBCAbsoluteIndexed(cpu, memory, offsetRegister):
-    def execute():
-        addr = cpu.fetchNext2()
-        addrOffset = (addr + cpu.getRegister(offsetRegister)) & 0xFFFF
-
-        operand = memory.getByte(addrOffset)
-        nOperand = (~operand + 1) & 0xFF
-        borrow_in = 0 if cpu.getFlag("carry") else 1
-        a = cpu.getRegister("A")
-
-        result16 = a + nOperand - borrow_in
-        result8 = result16 & 0xFF
-        cpu.setRegister("A", result8)
-
-        setADCFlags(cpu, result16, result8, a, ~operand)
-
-        # add one cycle if indexing resulted in page flip
-        if addrOffset // 256 != addr // 256: cpu.addClockCyclesThisCycle(1)
-        cpu.incrementPC().addClockCyclesThisCycle(4)
-    return execute
-
-def executeSBCIndirectIndexed(cpu, memory, offsetRegister):
-    def executeX():
-        cpu.incrementPC().fetchInstruction()
-        lookupAddr = (cpu.currentInstruction + cpu.getRegister("X")) & 0xFF
-        lookupAddrNext = (lookupAddr + 1) & 0xFF
-        addrLo = memory.getByte(lookupAddr)
-        AddrHi = memory.getByte(lookupAddrNext)
-        addr = AddrHi << 8 | addrLo
-
-        operand = memory.getByte(addr)
-        nOperand = (~operand + 1) & 0xFF
-        borrow_in = 0 if cpu.getFlag("carry") else 1
-        a = cpu.getRegister("A")
-
-        result16 = a + nOperand - borrow_in
-        result8 = result16 & 0xFF
-        cpu.setRegister("A", result8)
-
-        setADCFlags(cpu, result16, result8, a, ~operand)
-
-        cpu.incrementPC().addClockCyclesThisCycle(6)
-    
-    def executeY():
-        cpu.incrementPC().fetchInstruction()
-        addr = cpu.currentInstruction
-        addrLo = memory.getByte(addr)
-        addrHi = memory.getByte((addr + 1) & 0xFF)
-        addr = (addrHi << 8) | addrLo
-        addrOffset = (addr + cpu.getRegister("Y")) & 0xFFFF
-
-        operand = memory.getByte(addrOffset)
-        nOperand = (~operand + 1) & 0xFF
-        borrow_in = 0 if cpu.getFlag("carry") else 1
-        a = cpu.getRegister("A")
-
-        result16 = a + nOperand - borrow_in
-        result8 = result16 & 0xFF
-        cpu.setRegister("A", result8)
-
-        setADCFlags(cpu, result16, result8, a, ~operand)
-
-        # add one cycle if indexing resulted in page flip
-        if addr // 256 != addrOffset // 256: cpu.addClockCyclesThisCycle(1)
-        cpu.incrementPC().addClockCyclesThisCycle(5)
-    return executeX if offsetRegister == "X" else executeY
-
-# LDA TODO refactor
-def setZNFlags(result, cpu):
-    cpu.setFlag("zero",     result ==  0)
-    cpu.setFlag("negative", result > 127)
-
-def executeLDAImm(cpu):
-    def execute():
-        cpu.incrementPC().fetchInstruction()
-
-        result8 = cpu.currentInstruction
-        cpu.setRegister("A", result8)
-
-        setZNFlags(result8, cpu)
-
-        cpu.incrementPC().addClockCyclesThisCycle(2)
-    return execute
-
-def executeLDAZeroPage(cpu, memory):
-    def execute():
-        cpu.incrementPC().fetchInstruction()
-
-        result8 = memory.getByte(cpu.currentInstruction)
-        cpu.setRegister("A", result8)
-
-        setZNFlags(result8, cpu)
-
-        cpu.incrementPC().addClockCyclesThisCycle(3)
-    return execute
-
-def executeLDAZeroPageX(cpu, memory):
-    def execute():
-        cpu.incrementPC().fetchInstruction()
-        addr = cpu.currentInstruction
-        addrOffset = (addr + cpu.getRegister("X")) & 0xFF
-        operand = memory.getByte(addrOffset)
-        cpu.setRegister("A", operand)
-        setZNFlags(operand, cpu)
-        cpu.incrementPC().addClockCyclesThisCycle(4)
-    return execute
-
-def executeLDAAbsolute(cpu, memory):
-    def execute():
-        addr = cpu.fetchNext2()
-        result8 = memory.getByte(addr)
-        cpu.setRegister("A", result8)
-        setZNFlags(result8, cpu)
-        cpu.incrementPC().addClockCyclesThisCycle(4)
-    return execute
-
-def executeLDAAbsoluteIndexed(cpu, memory, offsetRegister):
-    def execute():
-        addr = cpu.fetchNext2()
-        addrOffset = (addr + cpu.getRegister(offsetRegister)) & 0xFFFF
-        result8 = memory.getByte(addrOffset)
-        cpu.setRegister("A", result8)
-
-        setZNFlags(result8, cpu)
-
-        if addrOffset // 256 != addr // 256: cpu.addClockCyclesThisCycle(1)
-        cpu.incrementPC().addClockCyclesThisCycle(4)
-    return execute
-
-def executeLDAIndirectIndexed(cpu, memory, offsetRegister):
-    def executeX():
-        cpu.incrementPC().fetchInstruction()
-        addr = cpu.currentInstruction
-        addrOffset = (cpu.currentInstruction + cpu.getRegister("X")) & 0xFFFF
-        addrOffsetNext = (addrOffset + 1) & 0xFFFF
-        addrLo = memory.getByte(addroffset)
-        addrHi = memory.getByte(addrOffsetNext)
-        addr = addrHi << 8 | addrLo
-        result8 = memory.getByte(addr)
-        cpu.setRegister("A", result8)
-        setZNFlags(result8, cpu)
-        cpu.incrementPC().addClockCyclesThisCycle(6)
-    
-    def executeY():
-        cpu.incrementPC().fetchInstruction()
-        addr = cpu.currentInstruction
-        addrLo = memory.getByte(addr)
-        addrHi = memory.getByte((addr + 1) & 0xFF)
-        addr = addrHi << 8 | addrLo
-        addrOffset = (addr + cpu.getRegister("Y")) & 0xFFFF
-        result8 = memory.getByte(addrOffset)
-        cpu.setRegister("A", result8)
-
-        setZNFlags(result8, cpu)
-
-        if addr // 256 != addrOffset // 256: cpu.addClockCyclesThisCycle(1)
-        cpu.incrementPC().addClockCyclesThisCycle(5)
-    return executeX if offsetRegister == "X" else executeY
-
-# LDX
-def executeLDXImm(cpu):
-    def execute():
-        cpu.incrementPC().fetchInstruction()
-        newXValue = cpu.currentInstruction
-        cpu.setRegister("X", newXValue)
-        setZNFlags(newXValue, cpu)
-        cpu.incrementPC().addClockCyclesThisCycle(2)
-    return execute
-
-def executeLDXZeroPage(cpu, memory):
-    def execute():
-        cpu.incrementPC().fetchInstruction()
-        addr = cpu.currentInstruction
-        x = memory.getByte(addr)
-        cpu.setRegister("X", x)
-        setZNFlags(x, cpu)
-        cpu.incrementPC().addClockCyclesThisCycle(3)
-    return execute
-
-def executeLDXZeroPageY(cpu, memory):
-    def execute():
-        cpu.incrementPC().fetchInstruction()
-        addr = cpu.currentInstruction
-        addrOffset = (addr + cpu.getRegister("Y")) & 0xFF
-        x = memory.getByte(addrOffset)
-        cpu.setRegister("X", x)
-        setZNFlags(x, cpu)
-        cpu.incrementPC().addClockCyclesThisCycle(4)
-    return execute
-
-def executeLDXAbsolute(cpu, memory):
-    def execute():
-        addr = cpu.fetchNext2()
-        x = memory.getByte(addr)
-        cpu.setRegister("X", x)
-        setZNFlags(x, cpu)
-        cpu.incrementPC().addClockCyclesThisCycle(4)
-    return execute
-
-def executeLDXAbsoluteY(cpu, memory):
-    def execute():
-        addr = cpu.fetchNext2()
-        addrOffset = (addr + cpu.getRegister("Y")) & 0xFFFF
-        x = memory.getByte(addrOffset)
-        cpu.setRegister("X", x)
-        setZNFlags(x, cpu)
-        if addr // 256 != addrOffset // 256: cpu.addClockCyclesThisCycle(1)
-        cpu.incrementPC().addClockCyclesThisCycle(4)
-    return execute
-
-# LDY
-def executeLDYImm(cpu):
-    def execute():
-        cpu.incrementPC().fetchInstruction()
-        y = cpu.currentInstruction
-        cpu.setRegister("Y", y)
-        setZNFlags(y, cpu)
-        cpu.incrementPC().addClockCyclesThisCycle(2)
-    return execute
-
-def executeLDYZeroPage(cpu, memory):
-    def execute():
-        cpu.incrementPC().fetchInstruction()
-        addr = cpu.currentInstruction
-        y = memory.getByte(addr)
-        cpu.setRegister("Y", y)
-        setZNFlags(y, cpu)
-        cpu.incrementPC().addClockCyclesThisCycle(3)
-    return execute
-
-def executeLDYZeroPageX(cpu, memory):
-    def execute():
-        cpu.incrementPC().fetchInstruction()
-        addr = cpu.currentInstruction
-        addrOffset = (addr + cpu.getRegister("X")) & 0xFF
-        y = memory.getByte(addrOffset)
-        cpu.setRegister("Y", y)
-        setZNFlags(y, cpu)
-        cpu.incrementPC().addClockCyclesThisCycle(4)
-    return execute
-
-def executeLDYAbsolute(cpu, memory):
-    def execute():
-        addr = cpu.fetchNext2()
-        y = memory.getByte(addr)
-        cpu.setRegister("Y", y)
-        setZNFlags(y, cpu)
-        cpu.incrementPC().addClockCyclesThisCycle(4)
-    return execute
-
-def executeLDYAbsoluteX(cpu, memory):
-    def execute():
-        addr = cpu.fetchNext2()
-        addrOffset = (addr + cpu.getRegister("X")) & 0xFFFF
-        y = memory.getByte(addrOffset)
-        cpu.setRegister("Y", y)
-        setZNFlags(y, cpu)
-        if addr // 256 != addrOffset // 256: cpu.addClockCyclesThisCycle(1)
-        cpu.incrementPC().addClockCyclesThisCycle(4)
-    return execute
-
-# Logical
-# ORA
-def executeORAIMM(cpu):
-    def execute():
-        cpu.incrementPC().fetchInstruction()
-        operand = cpu.currentInstruction
-        a = cpu.getRegister("A")
-        result8 = a | operand
-        cpu.setRegister("A", result8)
-        setZNFlags(result8, cpu)
-        cpu.incrementPC().addClockCyclesThisCycle(2)
-    return execute
-
-def executeORAZeroPage(cpu, memory):
-    def execute():
-        cpu.incrementPC().fetchInstruction()
-        operand = memory.getByte(cpu.currentInstruction)
-        a = cpu.getRegister("A")
-        result8 = a | operand
-        cpu.setRegister("A", result8)
-        setZNFlags(result8, cpu)
-        cpu.incrementPC().addClockCyclesThisCycle(3)
-    return execute
-
-def executeORAZeroPageX(cpu, memory):
-    def execute():
-        cpu.incrementPC().fetchInstruction()
-        addr = cpu.currentInstruction
-        addrOffset = (cpu.currentInstruction + cpu.getRegister("X")) & 0xFF
-        operand = memory.getByte(addrOffset)
-        a = cpu.getRegister("A")
-        result8 = a | operand
-        cpu.setRegister("A", result8)
-        setZNFlags(result8, cpu)
-        cpu.incrementPC().addClockCyclesThisCycle(4)
-    return execute
-
-def executeORAAbsolute(cpu, memory):
-    def execute():
-        addr = cpu.fetchNext2()
-        operand = memory.getByte(addr)
-        a = cpu.getRegister("A")
-        result8 = a | operand
-        cpu.setRegister("A", result8)
-        setZNFlags(result8, cpu)
-        cpu.incrementPC().addClockCyclesThisCycle(4)
-    return execute
-
-def executeORAAbsoluteIndexed(cpu, memory, offsetRegister):
-    def execute():
-        addr = cpu.fetchNext2()
-        addrOffset = (addr + cpu.getRegister(offsetRegister)) & 0xFFFF
-        operand = memory.getByte(addrOffset)
-        a = cpu.getRegister("A")
-        result8 = a | operand
-        cpu.setRegister("A", result8)
-        setZNFlags(result8, cpu)
-        if addrOffset // 256 != addr // 256: cpu.addClockCyclesThisCycle(1)
-        cpu.incrementPC().addClockCyclesThisCycle(4)
-    return execute
-
-def executeORAIndirectIndexed(cpu, memory, offsetRegister):
-    def executeX():
-        cpu.incrementPC().fetchInstruction()
-        lookupAddr = (cpu.currentInstruction + cpu.getRegister("X")) & 0xFF
-        lookupAddrNext = (lookupAddr + 1) & 0xFF
-        addrLo = memory.getByte(lookupAddr)
-        addrHi = memory.getByte(lookupAddrNext)
-        addr = addrHi << 8 | addrLo
-        operand = memory.getByte(addr)
-        a = cpu.getRegister("A")
-        result8 = a | operand
-        cpu.setRegister("A", result8)
-        setZNFlags(result8, cpu)
-        cpu.incrementPC().addClockCyclesThisCycle(6)
-    def executeY():
-        cpu.incrementPC().fetchInstruction()
-        addrLo = memory.getByte(cpu.currentInstruction)
-        addrHi = memory.getByte(cpu.currentInstruction + 1)
-        addr = addrHi << 8 | addrLo
-        addrOffset = (addr + cpu.getRegister("Y")) & 0xFFFF
-        operand = memory.getByte(addrOffset)
-        a = cpu.getRegister("A")
-        result8 = a | operand
-        cpu.setRegister("A", result8)
-        setZNFlags(result8, cpu)
-        if addr // 256 != addrOffset // 256: cpu.addClockCyclesThisCycle(1)
-        cpu.incrementPC().addClockCyclesThisCycle(5)
-    return executeX if offsetRegister == "X" else executeY
-# EOR
-def executeEORIMM(cpu):
-    def execute():
-        cpu.incrementPC().fetchInstruction()
-        operand = cpu.currentInstruction
-        a = cpu.getRegister("A")
-        result8 = a ^ operand
-        cpu.setRegister("A", result8)
-        setZNFlags(result8, cpu)
-        cpu.incrementPC().addClockCyclesThisCycle(2)
-    return execute
-
-def executeEORZeroPage(cpu, memory):
-    def execute():
-        cpu.incrementPC().fetchInstruction()
-        operand = memory.getByte(cpu.currentInstruction)
-        a = cpu.getRegister("A")
-        result8 = a ^ operand
-        cpu.setRegister("A", result8)
-        setZNFlags(result8, cpu)
-        cpu.incrementPC().addClockCyclesThisCycle(3)
-    return execute
-
-def executeEORZeroPageX(cpu, memory):
-    def execute():
-        cpu.incrementPC().fetchInstruction()
-        addr = cpu.currentInstruction
-        addrOffset = (cpu.currentInstruction + cpu.getRegister("X")) & 0xFF
-        operand = memory.getByte(addrOffset)
-        a = cpu.getRegister("A")
-        result8 = a ^ operand
-        cpu.setRegister("A", result8)
-        setZNFlags(result8, cpu)
-        cpu.incrementPC().addClockCyclesThisCycle(4)
-    return execute
-
-def executeEORAbsolute(cpu, memory):
-    def execute():
-        addr = cpu.fetchNext2()
-        operand = memory.getByte(addr)
-        a = cpu.getRegister("A")
-        result8 = a ^ operand
-        cpu.setRegister("A", result8)
-        setZNFlags(result8, cpu)
-        cpu.incrementPC().addClockCyclesThisCycle(4)
-    return execute
-
-def executeEORAbsoluteIndexed(cpu, memory, offsetRegister):
-    def execute():
-        addr = cpu.fetchNext2()
-        addrOffset = (addr + cpu.getRegister(offsetRegister)) & 0xFFFF
-        operand = memory.getByte(addrOffset)
-        a = cpu.getRegister("A")
-        result8 = a ^ operand
-        cpu.setRegister("A", result8)
-        setZNFlags(result8, cpu)
-        if addrOffset // 256 != addr // 256: cpu.addClockCyclesThisCycle(1)
-        cpu.incrementPC().addClockCyclesThisCycle(4)
-    return execute
-
-def executeEORIndirectIndexed(cpu, memory, offsetRegister):
-    def executeX():
-        cpu.incrementPC().fetchInstruction()
-        lookupAddr = (cpu.currentInstruction + cpu.getRegister("X")) & 0xFF
-        lookupAddrNext = (lookupAddr + 1) & 0xFF
-        addrLo = memory.getByte(lookupAddr)
-        addrHi = memory.getByte(lookupAddrNext)
-        addr = addrHi << 8 | addrLo
-        operand = memory.getByte(addr)
-        a = cpu.getRegister("A")
-        result8 = a ^ operand
-        cpu.setRegister("A", result8)
-        setZNFlags(result8, cpu)
-        cpu.incrementPC().addClockCyclesThisCycle(6)
-    def executeY():
-        cpu.incrementPC().fetchInstruction()
-        addrLo = memory.getByte(cpu.currentInstruction)
-        addrHi = memory.getByte(cpu.currentInstruction + 1)
-        addr = addrHi << 8 | addrLo
-        addrOffset = (addr + cpu.getRegister("Y")) & 0xFFFF
-        operand = memory.getByte(addrOffset)
-        a = cpu.getRegister("A")
-        result8 = a ^ operand
-        cpu.setRegister("A", result8)
-        setZNFlags(result8, cpu)
-        if addr // 256 != addrOffset // 256: cpu.addClockCyclesThisCycle(1)
-        cpu.incrementPC().addClockCyclesThisCycle(5)
-    return executeX if offsetRegister == "X" else executeY
-# AND
-def executeANDIMM(cpu):
-    def execute():
-        cpu.incrementPC().fetchInstruction()
-        operand = cpu.currentInstruction
-        a = cpu.getRegister("A")
-        result8 = a & operand
-        cpu.setRegister("A", result8)
-        setZNFlags(result8, cpu)
-        cpu.incrementPC().addClockCyclesThisCycle(2)
-    return execute
-
-def executeANDZeroPage(cpu, memory):
-    def execute():
-        cpu.incrementPC().fetchInstruction()
-        operand = memory.getByte(cpu.currentInstruction)
-        a = cpu.getRegister("A")
-        result8 = a & operand
-        cpu.setRegister("A", result8)
-        setZNFlags(result8, cpu)
-        cpu.incrementPC().addClockCyclesThisCycle(3)
-    return execute
-
-def executeANDZeroPageX(cpu, memory):
-    def execute():
-        cpu.incrementPC().fetchInstruction()
-        addr = cpu.currentInstruction
-        addrOffset = (cpu.currentInstruction + cpu.getRegister("X")) & 0xFF
-        operand = memory.getByte(addrOffset)
-        a = cpu.getRegister("A")
-        result8 = a & operand
-        cpu.setRegister("A", result8)
-        setZNFlags(result8, cpu)
-        cpu.incrementPC().addClockCyclesThisCycle(4)
-    return execute
-
-def executeANDAbsolute(cpu, memory):
-    def execute():
-        addr = cpu.fetchNext2()
-        operand = memory.getByte(addr)
-        a = cpu.getRegister("A")
-        result8 = a & operand
-        cpu.setRegister("A", result8)
-        setZNFlags(result8, cpu)
-        cpu.incrementPC().addClockCyclesThisCycle(4)
-    return execute
-
-def executeANDAbsoluteIndexed(cpu, memory, offsetRegister):
-    def execute():
-        addr = cpu.fetchNext2()
-        addrOffset = (addr + cpu.getRegister(offsetRegister)) & 0xFFFF
-        operand = memory.getByte(addrOffset)
-        a = cpu.getRegister("A")
-        result8 = a & operand
-        cpu.setRegister("A", result8)
-        setZNFlags(result8, cpu)
-        if addrOffset // 256 != addr // 256: cpu.addClockCyclesThisCycle(1)
-        cpu.incrementPC().addClockCyclesThisCycle(4)
-    return execute
+def fusable(first, second):
+    '''
+    True if the op-code pair (first, second) can be fused: both are implemented and the first one
+    doesn't change control flow. JSR, RTS and RTI aren't fused, so their handlers can still be wrapped (see Profiler).
+    '''
+    if first not in opcodeRows or second not in opcodeRows: return False
+    if operations[opcodeRows[first][1]][0] in (BRANCH, JUMP): return False
+    return opcodeRows[second][1] not in ("JSR", "RTS", "RTI")
 
-def executeANDIndirectIndexed(cpu, memory, offsetRegister):
-    def executeX():
-        cpu.incrementPC().fetchInstruction()
-        lookupAddr = (cpu.currentInstruction + cpu.getRegister("X")) & 0xFF
-        lookupAddrNext = (lookupAddr + 1) & 0xFF
-        addrLo = memory.getByte(lookupAddr)
-        addrHi = memory.getByte(lookupAddrNext)
-        addr = addrHi << 8 | addrLo
-        operand = memory.getByte(addr)
-        a = cpu.getRegister("A")
-        result8 = a & operand
-        cpu.setRegister("A", result8)
-        setZNFlags(result8, cpu)
-        cpu.incrementPC().addClockCyclesThisCycle(6)
-    def executeY():
-        cpu.incrementPC().fetchInstruction()
-        addrLo = memory.getByte(cpu.currentInstruction)
-        addrHi = memory.getByte(cpu.currentInstruction + 1)
-        addr = addrHi << 8 | addrLo
-        addrOffset = (addr + cpu.getRegister("Y")) & 0xFFFF
-        operand = memory.getByte(addrOffset)
-        a = cpu.getRegister("A")
-        result8 = a & operand
-        cpu.setRegister("A", result8)
-        setZNFlags(result8, cpu)
-        if addr // 256 != addrOffset // 256: cpu.addClockCyclesThisCycle(1)
-        cpu.incrementPC().addClockCyclesThisCycle(5)
-    return executeX if offsetRegister == "X" else executeY
\ No newline at end of file
+def fusedSource(first, second):
+    '''
+    returns the source of the factory make(cpu, memory) -> fused handler for the op-code pair (first, second).
+    The fused handler is called with PC after the pair, unless the first op-code writes memory: then PC is
+    after the first instruction, and the handler returns True without running the second one if the write
+    invalidated the running block (its write hooks see the same PC as without fusion).
+    '''
+    firstRow = opcodeRows[first]
+    secondRow = opcodeRows[second]
+    parameter0, lines0, cycles0 = handlerLines(*firstRow)
+    lines = [parameter0 + " = operand0"] + lines0
+    extraCycles = 0
+    if writesMemory(firstRow[1]):
+        lines += ["cpu._clockCyclesThisCycle += " + cycles0,
+                  "if cpu._blockCache.stale: return True",
+                  "cpu.pc = (cpu.pc + " + str(addressingModes[secondRow[2]][0]) + ") & 0xFFFF"]
+    elif cycles0.isdigit(): extraCycles = int(cycles0)
+    # the page-cross penalty refers to locals the second handler reuses
+    else: lines.append("cpu._clockCyclesThisCycle += " + cycles0)
+
+    parameter1, lines1, cycles1 = handlerLines(*secondRow, extraCycles=extraCycles)
+    lines += [parameter1 + " = operand1"] + lines1
+    if cycles1 is not None: lines.append("cpu._clockCyclesThisCycle += " + cycles1)
+
+    name = firstRow[1] + "_" + firstRow[2] + "_" + secondRow[1] + "_" + secondRow[2]
+    return "\n".join(["def make(cpu, memory):",
+                      "    def " + name + "(operand0, operand1):"] +
+                     ["        " + line for line in lines] +
+                     ["    return " + name])
+
+fusedFactories = {}
+"""
+(first, second) -> make(cpu, memory) returning the fused handler, compiled on first use
+"""
+
+def buildFusedHandlers(cpu, memory, pairs):
+    '''
+    returns a dict mapping each fusable op-code pair in pairs to its fused handler for cpu and memory.
+    Handlers get writesFirst, telling whether the first op-code writes memory (see fusedSource).
+    '''
+    handlers = {}
+    for pair in pairs:
+        if not fusable(*pair): continue
+        make = fusedFactories.get(pair)
+        if make is None:
+            make = fusedFactories[pair] = compileFactory(fusedSource(*pair), "<op-codes " + format(pair[0], "02X") + " " + format(pair[1], "02X") + ">")
+        handler = make(cpu, memory)
+        handler.writesFirst = writesMemory(opcodeRows[pair[0]][1])
+        handlers[pair] = handler
+    return handlers
@@ -0,0 +1,159 @@
+'''
+Layout of the processor status register (P), which the CPU keeps packed into a single int,
+and precomputed flag-result tables, so op-code handlers can update it in one step.
+Z and N are evaluated lazily: the CPU keeps the last result (cpu._zn, an index into znFlags) instead of the bits,
+see CPU.p.
+b7 = Negative
+b6 = Overflow
+b5 unused
+b4 = Break
+b3 = Decimal
+b2 = Interrupt
+b1 = Zero
+b0 = Carry
+
+Tables and their memory budget:
+- znFlags           256 entries, list              ~2 KiB  built at import
+- compareTable      64K entries, bytearray         64 KiB  built on first use
+- adcTable         128K entries, array('H')       256 KiB  built on first use
+- adcDecimalTable  128K entries, array('H')       256 KiB  built on first use
+- sbcDecimalTable  128K entries, array('H')       256 KiB  built on first use
+The big tables are built lazily by the module __getattr__ the first time they are accessed as flags.<name>
+(about 0.1s each), so importing this module stays cheap. Binary SBC has no table of its own,
+it is ADC of the inverted operand.
+'''
+from array import array
+
+CARRY     = 0b00000001
+ZERO      = 0b00000010
+INTERRUPT = 0b00000100
+DECIMAL   = 0b00001000
+BREAK     = 0b00010000
+UNUSED    = 0b00100000
+OVERFLOW  = 0b01000000
+NEGATIVE  = 0b10000000
+
+ZN   = ZERO | NEGATIVE
+ZNC  = ZERO | NEGATIVE | CARRY
+ZNCV = ZERO | NEGATIVE | CARRY | OVERFLOW
+
+flagBits = {
+    "carry": CARRY,
+    "zero": ZERO,
+    "interrupt disable": INTERRUPT,
+    "decimal mode": DECIMAL,
+    "break command": BREAK,
+    "overflow": OVERFLOW,
+    "negative": NEGATIVE
+}
+"""
+Maps the flag names used by CPU.getFlag / CPU.setFlag to their bit in P.
+"""
+
+znFlags = [(ZERO if val == 0 else 0) | (val & NEGATIVE) for val in range(256)] + [ZERO | NEGATIVE]
+"""
+Zero and negative flag bits of an 8-bit result: p = (cpu._p & ~ZN) | znFlags[cpu._zn].
+Entry 0x100 has both bits set, which no result has, but PLP can.
+"""
+
+znResults = [0x01 for i in range(ZN + 1)]
+znResults[ZERO] = 0x00
+znResults[NEGATIVE] = 0x80
+znResults[ZN] = 0x100
+"""
+Inverse of znFlags, a result with the given Z and N bits: cpu._zn = znResults[p & ZN]
+"""
+
+def tableIndex(carry, a, operand):
+    '''
+    index into adcTable, adcDecimalTable and sbcDecimalTable. carry is 0 or 1 (p & CARRY).
+    Each entry holds result8 | flags << 8, flags being the N, Z, C and V bits of P.
+    '''
+    return carry << 16 | a << 8 | operand
+
+def buildCompareTable():
+    '''
+    compareTable[reg << 8 | operand] = N, Z and C bits of CMP / CPX / CPY
+    '''
+    table = bytearray(65536)
+    for reg in range(256):
+        for operand in range(256):
+            carry = CARRY if reg >= operand else 0
+            table[reg << 8 | operand] = znFlags[(reg - operand) & 0xFF] | carry
+    return table
+
+def buildADCTable():
+    table = array("H", bytes(2 * 131072))
+    for carry in range(2):
+        for a in range(256):
+            for operand in range(256):
+                result16 = a + operand + carry
+                result8 = result16 & 0xFF
+                # overflow if both operands have the same sign and the result's sign differs
+                overflow = ((a ^ result8) & ~(a ^ operand) & 0x80) >> 1
+                flags = znFlags[result8] | (CARRY if result16 > 0xFF else 0) | overflow
+                table[tableIndex(carry, a, operand)] = result8 | flags << 8
+    return table
+
+def buildADCDecimalTable():
+    '''
+    NMOS 6502 decimal mode: Z comes from the binary sum, N and V from the intermediate result after the low nibble
+    adjustment, C from the fully adjusted result.
+    '''
+    table = array("H", bytes(2 * 131072))
+    for carry in range(2):
+        for a in range(256):
+            for operand in range(256):
+                lo = (a & 0x0F) + (operand & 0x0F) + carry
+                if lo >= 0x0A: lo = ((lo + 0x06) & 0x0F) + 0x10
+                result = (a & 0xF0) + (operand & 0xF0) + lo
+                # sign of the intermediate result
+                signed = (a & 0xF0) - ((a & 0x80) << 1) + (operand & 0xF0) - ((operand & 0x80) << 1) + lo
+                if result >= 0xA0: result += 0x60
+
+                flags = ZERO if (a + operand + carry) & 0xFF == 0 else 0
+                flags |= signed & NEGATIVE
+                flags |= OVERFLOW if signed < -128 or signed > 127 else 0
+                flags |= CARRY if result >= 0x100 else 0
+                table[tableIndex(carry, a, operand)] = (result & 0xFF) | flags << 8
+    return table
+
+def buildSBCDecimalTable():
+    '''
+    NMOS 6502 decimal mode: all flags are the same as in binary mode, only the result is BCD adjusted.
+    '''
+    adc = lazyTable("adcTable")
+    table = array("H", bytes(2 * 131072))
+    for carry in range(2):
+        for a in range(256):
+            for operand in range(256):
+                flags = adc[tableIndex(carry, a, operand ^ 0xFF)] & 0xFF00
+                lo = (a & 0x0F) - (operand & 0x0F) + carry - 1
+                if lo < 0: lo = ((lo - 0x06) & 0x0F) - 0x10
+                result = (a & 0xF0) - (operand & 0xF0) + lo
+                if result < 0: result -= 0x60
+                table[tableIndex(carry, a, operand)] = (result & 0xFF) | flags
+    return table
+
+lazyTables = {
+    "compareTable": buildCompareTable,
+    "adcTable": buildADCTable,
+    "adcDecimalTable": buildADCDecimalTable,
+    "sbcDecimalTable": buildSBCDecimalTable
+}
+
+def lazyTable(name):
+    '''
+    returns the table name, building it if necessary. For use inside this module, where __getattr__ isn't consulted.
+    '''
+    return globals()[name] if name in globals() else __getattr__(name)
+
+def __getattr__(name):
+    '''
+    builds a lazy table on first access and stores it as a module global, so later accesses are plain lookups
+    '''
+    build = lazyTables.get(name)
+    if build is None: raise AttributeError("module 'flags' has no attribute " + repr(name))
+    table = build()
+    globals()[name] = table
+    return table
@@ -0,0 +1,31 @@
+'''
+Opt-in hex dump tool, e.g. for inspecting program images:
+python hexdump.py testProgram/6502_functional_test.bin [output file]
+'''
+import sys
+
+def hexdump(data, base=0, width=16):
+    '''
+    yields one line per width bytes: address, hex bytes and printable ASCII
+    '''
+    for offset in range(0, len(data), width):
+        chunk = bytes(data[offset:offset + width])
+        text = "".join(chr(b) if 0x20 <= b < 0x7F else "." for b in chunk)
+        yield "{addr:04x}: {hex:<{hexWidth}} {text}".format(
+            addr = base + offset, hex = chunk.hex(" "), hexWidth = width * 3 - 1, text = text)
+
+def dumpFile(path, output, base=0):
+    with open(path, "rb") as file:
+        data = file.read()
+    for line in hexdump(data, base):
+        output.write(line + "\n")
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python hexdump.py <binary> [output file]")
+        sys.exit(2)
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], "w") as output:
+            dumpFile(sys.argv[1], output)
+    else:
+        dumpFile(sys.argv[1], sys.stdout)
@@ -0,0 +1,81 @@
+from array import array
+
+import execution
+
+class OpcodeHistogram:
+    '''
+    Executions and accumulated clock cycles per op-code, filled by the instrumented dispatch table
+    CPU.enableInstrumentation swaps in. counts and cycles are flat arrays indexed by op-code.
+    pairs counts how often each op-code ran right after another one, indexed by previous op-code << 8 | op-code.
+    '''
+    def __init__(self):
+        self.counts = array("Q", bytes(8 * 256))
+        self.cycles = array("Q", bytes(8 * 256))
+        self.pairs = array("Q", bytes(8 * 65536))
+        self._previous = [None]
+        """
+        the op-code executed last, as a cell shared with the instrumented handlers
+        """
+
+    def instrument(self, cpu, lut):
+        '''
+        returns a copy of the (list) dispatch table lut whose handlers also count into this histogram
+        '''
+        counts = self.counts
+        cycles = self.cycles
+        pairs = self.pairs
+        previous = self._previous
+
+        def wrap(opcode, handler):
+            def execute(operand):
+                before = cpu._clockCyclesThisCycle
+                handler(operand)
+                counts[opcode] += 1
+                cycles[opcode] += cpu._clockCyclesThisCycle - before
+                if previous[0] is not None: pairs[previous[0] << 8 | opcode] += 1
+                previous[0] = opcode
+            return execute
+
+        return [wrap(opcode, handler) for opcode, handler in enumerate(lut)]
+
+    def clear(self):
+        for opcode in range(256):
+            self.counts[opcode] = 0
+            self.cycles[opcode] = 0
+        # in place: the instrumented handlers hold on to the array
+        self.pairs[:] = array("Q", bytes(8 * 65536))
+        self._previous[0] = None
+
+    def report(self):
+        '''
+        returns (opcode, executions, cycles, share of all cycles) for every executed op-code, most expensive first
+        '''
+        totalCycles = sum(self.cycles) or 1
+        rows = [(opcode, self.counts[opcode], self.cycles[opcode], self.cycles[opcode] / totalCycles)
+                for opcode in range(256) if self.counts[opcode]]
+        rows.sort(key=lambda row: row[2], reverse=True)
+        return rows
+
+    def pairReport(self, count=None):
+        '''
+        returns (first op-code, second op-code, executions) for the count (default: all) most frequent op-code pairs
+        '''
+        pairs = self.pairs
+        rows = [(pair >> 8, pair & 0xFF, pairs[pair]) for pair in range(65536) if pairs[pair]]
+        rows.sort(key=lambda row: row[2], reverse=True)
+        return rows[:count]
+
+    def fusionCandidates(self, count=16):
+        '''
+        returns the count most frequent op-code pairs which can be fused (execution.fusable),
+        ready for CPU.fuseOpcodePairs
+        '''
+        return [(first, second) for first, second, executions in self.pairReport()
+                if execution.fusable(first, second)][:count]
+
+    def __str__(self):
+        lines = ["opcode  executions      cycles  cycles/exec   share"]
+        for opcode, count, cycles, share in self.report():
+            lines.append("  {opcode:02X}    {count:>10} {cycles:>11} {perExecution:>12.2f} {share:>6.1%}".format(
+                opcode = opcode, count = count, cycles = cycles, perExecution = cycles / count, share = share))
+        return "\n".join(lines)
@@ -0,0 +1,142 @@
+import mmap
+import os
+
+class ImageFormatError(ValueError):
+    '''
+    raised for malformed Intel HEX / S-record files and images that don't fit into 64 KiB
+    '''
+    def __init__(self, path, lineNumber, message):
+        super().__init__("{path}:{line}: {message}".format(path = path, line = lineNumber, message = message))
+        self.path = path
+        self.lineNumber = lineNumber
+
+class Image:
+    '''
+    A parsed program image: a list of (address, bytes) segments and the entry point, if the file names one.
+    Adjacent records are merged, so loading an image is one Memory.setBytes per contiguous segment.
+    '''
+    def __init__(self, segments=None, entry=None):
+        self.segments = segments if segments is not None else []
+        self.entry = entry
+
+    def _add(self, addr, data, path, lineNumber):
+        if addr + len(data) > 0x10000:
+            raise ImageFormatError(path, lineNumber, "data at {addr} does not fit into 64 KiB".format(addr = hex(addr)))
+        if self.segments:
+            lastAddr, lastData = self.segments[-1]
+            if lastAddr + len(lastData) == addr:
+                lastData += data
+                return
+        self.segments.append((addr, bytearray(data)))
+
+    def loadInto(self, memory):
+        '''
+        copies every segment into memory. Returns the list of (addrStart, addrEnd) ranges written.
+        '''
+        ranges = []
+        for addr, data in self.segments:
+            memory.setBytes(addr, data)
+            ranges.append((addr, addr + len(data)))
+        return ranges
+
+def loadBinary(memory, path, base=0, useMmap=False):
+    '''
+    copies the raw contents of path to memory at base in a single Memory.setBytes.
+    useMmap maps the file instead of reading it into a bytes object first.
+    Returns (addrStart, addrEnd).
+    '''
+    with open(path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        if base + size > 0x10000:
+            raise ImageFormatError(path, 0, "{size} bytes at {base} do not fit into 64 KiB".format(size = size, base = hex(base)))
+        if not useMmap or size == 0:
+            memory.setBytes(base, file.read())
+        else:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                # the view has to be released before the map can be closed
+                with memoryview(mapped) as view:
+                    memory.setBytes(base, view)
+    return base, base + size
+
+def _hexBytes(text, path, lineNumber):
+    try:
+        return bytes.fromhex(text)
+    except ValueError:
+        raise ImageFormatError(path, lineNumber, "invalid hex digits")
+
+def parseIntelHex(path):
+    '''
+    parses an Intel HEX file into an Image.
+    Supports data (00), end of file (01), extended segment / linear address (02 / 04)
+    and start address (03 / 05) records.
+    '''
+    image = Image()
+    offset = 0
+    with open(path, "r") as file:
+        for lineNumber, line in enumerate(file, 1):
+            line = line.strip()
+            if not line: continue
+            if line[0] != ":": raise ImageFormatError(path, lineNumber, "record does not start with ':'")
+
+            record = _hexBytes(line[1:], path, lineNumber)
+            if len(record) < 5 or len(record) != record[0] + 5:
+                raise ImageFormatError(path, lineNumber, "record length mismatch")
+            if sum(record) & 0xFF != 0:
+                raise ImageFormatError(path, lineNumber, "checksum mismatch")
+
+            recordType = record[3]
+            data = record[4:-1]
+            if recordType == 0x00: image._add(offset + (record[1] << 8 | record[2]), data, path, lineNumber)
+            elif recordType == 0x01: break
+            elif recordType == 0x02: offset = int.from_bytes(data, "big") << 4
+            elif recordType == 0x04: offset = int.from_bytes(data, "big") << 16
+            elif recordType in (0x03, 0x05): image.entry = int.from_bytes(data, "big") & 0xFFFF
+            else: raise ImageFormatError(path, lineNumber, "unknown record type " + hex(recordType))
+    return image
+
+sRecordAddressLengths = {"0": 2, "1": 2, "2": 3, "3": 4, "5": 2, "6": 3, "7": 4, "8": 3, "9": 2}
+"""
+Maps the S-record type to the length of its address field in bytes.
+"""
+
+def parseSRecord(path):
+    '''
+    parses a Motorola S-record file (S19 / S28 / S37) into an Image.
+    Header (S0) and count (S5 / S6) records are ignored, S7 / S8 / S9 set the entry point.
+    '''
+    image = Image()
+    with open(path, "r") as file:
+        for lineNumber, line in enumerate(file, 1):
+            line = line.strip()
+            if not line: continue
+            if line[0] != "S" or line[1:2] not in sRecordAddressLengths:
+                raise ImageFormatError(path, lineNumber, "not an S-record")
+
+            recordType = line[1]
+            record = _hexBytes(line[2:], path, lineNumber)
+            if len(record) < 1 or len(record) != record[0] + 1:
+                raise ImageFormatError(path, lineNumber, "record length mismatch")
+            if sum(record) & 0xFF != 0xFF:
+                raise ImageFormatError(path, lineNumber, "checksum mismatch")
+
+            addressLength = sRecordAddressLengths[recordType]
+            addr = int.from_bytes(record[1:1 + addressLength], "big")
+            if recordType in "123": image._add(addr, record[1 + addressLength:-1], path, lineNumber)
+            elif recordType in "789": image.entry = addr & 0xFFFF
+    return image
+
+def load(memory, path, base=0, useMmap=False):
+    '''
+    loads path into memory, picking the format by extension:
+    .hex / .ihx are Intel HEX, .s19 / .s28 / .s37 / .srec / .mot are S-records and anything else is a raw binary
+    loaded at base. Returns the Image that was loaded (entry is None for raw binaries).
+    '''
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".hex", ".ihx"): image = parseIntelHex(path)
+    elif extension in (".s19", ".s28", ".s37", ".srec", ".mot"): image = parseSRecord(path)
+    else:
+        addrStart, addrEnd = loadBinary(memory, path, base, useMmap)
+        return Image([(addrStart, memory.getBytes(addrStart, addrEnd - addrStart))])
+
+    image.loadInto(memory)
+    return image
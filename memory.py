@@ -1,25 +1,194 @@
+zeroImage = bytes(65536)
+zeroPage = bytes(256)
+
 class Memory:
-    def __init__(self):
+    '''
+    64 KiB of memory backed by a bytearray.
+    checked enables the range and type checks of setByte and the bulk operations (setBytes, getBytes, fill).
+    Leave it on while developing. With checked=False ("release" mode) setByte is swapped for an unchecked variant:
+    out of range values still raise (ValueError, IndexError), but negative addresses silently wrap around.
+    '''
+    def __init__(self, checked=True):
+        self._checked = checked
+        self._memory = bytearray(65536)
+        self._view = memoryview(self._memory)
+        """
+        Keeping a view exported also pins the size of _memory: a slice assignment that would grow it raises BufferError.
+        """
+        self._writeHooks = [None for i in range(256)]
+        """
+        Maps each 256-byte page to a list of functions hook(addr, val) called after setByte writes to that page.
+        None for pages without hooks, so unhooked pages only cost a single list lookup.
+        """
+        self._readHooks = [None for i in range(256)]
+        """
+        Like _writeHooks, functions hook(addr, val) called after getByte read from the page.
+        getByte is only swapped for the hooked variant while any read hook is registered.
+        """
+        self._bulkWriteHooks = []
+        """
+        Functions hook(addrStart, addrEnd) called after setBytes, fill or resetMemory overwrote a whole range.
+        """
+        self._bindGetByte()
+        self._bindSetByte()
         self.resetMemory()
-    
+
     def getByte(self, addr):
         return self._memory[addr]
-    
+
+    def fetchByte(self, addr):
+        '''
+        getByte for op-code and operand fetches, which don't call read hooks
+        '''
+        return self._memory[addr]
+
+    def _getByteHooked(self, addr):
+        '''
+        getByte variant which is swapped in while any read hook is registered
+        '''
+        val = type(self).getByte(self, addr)
+        hooks = self._readHooks[addr >> 8]
+        if hooks is not None:
+            for hook in hooks: hook(addr, val)
+        return val
+
     def setByte(self, addr: int, val: int):
         assert(addr >= 0 and addr < 65536)
         assert(val >= 0 and val < 256)
         assert(type(val) == int and type(addr) == int)
         self._memory[addr] = val
-    
+
+    def _setByteUnchecked(self, addr: int, val: int):
+        self._memory[addr] = val
+
+    def _setByteHooked(self, addr: int, val: int):
+        '''
+        setByte variant which is swapped in while any write hook is registered
+        '''
+        if self._checked: Memory.setByte(self, addr, val)
+        else: self._memory[addr] = val
+        hooks = self._writeHooks[addr >> 8]
+        if hooks is not None:
+            for hook in hooks: hook(addr, val)
+
     def setBytes(self, addrStart, valArray):
-        assert(type(addrStart) == int)
-        for val in valArray:
+        '''
+        copies valArray (bytes, bytearray or a list of ints) to addrStart in one slice assignment
+        '''
+        addrEnd = addrStart + len(valArray)
+        if self._checked:
+            self._checkRange(addrStart, addrEnd)
+            # bytes and bytearray can't hold anything but bytes
+            if type(valArray) not in (bytes, bytearray, memoryview):
+                for val in valArray:
+                    assert(type(val) == int)
+                    assert(val >= 0 and val < 256)
+
+        self._memory[addrStart:addrEnd] = valArray
+        self._notifyBulkWrite(addrStart, addrEnd)
+
+    def getBytes(self, addrStart, length):
+        '''
+        returns a bytes copy of length bytes starting at addrStart
+        '''
+        if self._checked: self._checkRange(addrStart, addrStart + length)
+        return self._view[addrStart:addrStart + length].tobytes()
+
+    def fill(self, addrStart, length, val):
+        '''
+        sets length bytes starting at addrStart to val
+        '''
+        if self._checked:
+            self._checkRange(addrStart, addrStart + length)
+            assert(type(val) == int)
             assert(val >= 0 and val < 256)
-            assert(type(val == int))
 
-        for i in range(len(valArray)):
-            self._memory[i + addrStart] = valArray[i]
-    
+        self._memory[addrStart:addrStart + length] = bytes((val,)) * length
+        self._notifyBulkWrite(addrStart, addrStart + length)
+
+    def snapshot(self):
+        '''
+        returns a bytes copy of all 64 KiB
+        '''
+        return bytes(self._memory)
+
+    def restore(self, image):
+        '''
+        overwrites all 64 KiB with image (as returned by snapshot) in one copy.
+        Bulk write hooks are only notified if the contents actually changed, so restoring
+        into unchanged memory keeps e.g. compiled blocks.
+        '''
+        if self._memory == image: return
+        self._memory[:] = image
+        self._notifyBulkWrite(0, 65536)
+
+    def fork(self):
+        '''
+        returns a ForkedMemory starting out with the current contents. Forks of that fork share its pages,
+        so take many forks from one fork rather than from this Memory, which copies all 64 KiB every time.
+        '''
+        return ForkedMemory([bytes(self._view[addr:addr + 256]) for addr in range(0, 65536, 256)], self._checked)
+
+    def _checkRange(self, addrStart, addrEnd):
+        assert(type(addrStart) == int and type(addrEnd) == int)
+        assert(addrStart >= 0 and addrStart <= addrEnd and addrEnd <= 65536)
+
+    def addWriteHook(self, page, hook):
+        '''
+        registers hook(addr, val) to be called after every setByte into page (addr >> 8)
+        '''
+        if self._writeHooks[page] is None: self._writeHooks[page] = []
+        self._writeHooks[page].append(hook)
+        self._bindSetByte()
+
+    def removeWriteHook(self, page, hook):
+        hooks = self._writeHooks[page]
+        hooks.remove(hook)
+        if not hooks: self._writeHooks[page] = None
+        self._bindSetByte()
+
+    def addReadHook(self, page, hook):
+        '''
+        registers hook(addr, val) to be called after every getByte from page (addr >> 8).
+        Op-code and operand fetches (fetchByte) and the bulk operations (getBytes, snapshot) don't call read hooks.
+        '''
+        if self._readHooks[page] is None: self._readHooks[page] = []
+        self._readHooks[page].append(hook)
+        self._bindGetByte()
+
+    def removeReadHook(self, page, hook):
+        hooks = self._readHooks[page]
+        hooks.remove(hook)
+        if not hooks: self._readHooks[page] = None
+        self._bindGetByte()
+
+    def _bindGetByte(self):
+        '''
+        swaps in the hooked getByte while read hooks are registered
+        '''
+        if any(hooks is not None for hooks in self._readHooks): self.getByte = self._getByteHooked
+        elif "getByte" in self.__dict__: del self.getByte
+
+    def _bindSetByte(self):
+        '''
+        swaps in the cheapest setByte variant for the current mode and hooks
+        '''
+        if any(hooks is not None for hooks in self._writeHooks): self.setByte = self._setByteHooked
+        elif not self._checked: self.setByte = self._setByteUnchecked
+        elif "setByte" in self.__dict__: del self.setByte
+
+    def addBulkWriteHook(self, hook):
+        '''
+        registers hook(addrStart, addrEnd) to be called after setBytes, fill or resetMemory
+        '''
+        self._bulkWriteHooks.append(hook)
+
+    def removeBulkWriteHook(self, hook):
+        self._bulkWriteHooks.remove(hook)
+
+    def _notifyBulkWrite(self, addrStart, addrEnd):
+        for hook in self._bulkWriteHooks: hook(addrStart, addrEnd)
+
     def resetMemory(self):
         '''
         sets all bytes to zero and loads reset vector
@@ -34,4 +203,125 @@ class Memory:
         '''
         sets all bytes to zero
         '''
-        self._memory = [0 for i in range(65536)]
\ No newline at end of file
+        self._memory[:] = zeroImage
+        self._notifyBulkWrite(0, 65536)
+
+class ForkedMemory(Memory):
+    '''
+    Copy-on-write memory made of 256 pages. Pages are shared (immutable bytes) with the memory this was forked from
+    and with its own forks, until the first write copies the page into a private bytearray.
+    Memory use therefore grows with the pages written, not with the number of forks.
+    Hooks (read, write and bulk write) are not inherited by forks. Use CPU.fork() to get a CPU with its own registers on a fork.
+    '''
+    def __init__(self, pages, checked=True):
+        self._checked = checked
+        self._pages = pages
+        """
+        page -> bytes (shared) or bytearray (written since it was last shared)
+        """
+        self._dirty = bytearray(256)
+        """
+        1 for every page written since this fork was created
+        """
+        self._writeHooks = [None for i in range(256)]
+        self._readHooks = [None for i in range(256)]
+        self._bulkWriteHooks = []
+        self._bindGetByte()
+        self._bindSetByte()
+
+    def fork(self):
+        # share our written pages from now on, our next write to them copies them again
+        pages = self._pages
+        for page, data in enumerate(pages):
+            if type(data) is bytearray: pages[page] = bytes(data)
+        return ForkedMemory(list(pages), self._checked)
+
+    def dirtyPages(self):
+        '''
+        returns the pages written since this fork was created
+        '''
+        return [page for page in range(256) if self._dirty[page]]
+
+    def _ownPage(self, page):
+        '''
+        returns a writable copy of page, copying it on the first write
+        '''
+        data = self._pages[page]
+        if type(data) is bytes:
+            data = self._pages[page] = bytearray(data)
+            self._dirty[page] = 1
+        return data
+
+    def getByte(self, addr):
+        return self._pages[addr >> 8][addr & 0xFF]
+
+    def fetchByte(self, addr):
+        return self._pages[addr >> 8][addr & 0xFF]
+
+    def setByte(self, addr: int, val: int):
+        assert(addr >= 0 and addr < 65536)
+        assert(val >= 0 and val < 256)
+        assert(type(val) == int and type(addr) == int)
+        self._setByteUnchecked(addr, val)
+
+    def _setByteUnchecked(self, addr: int, val: int):
+        data = self._pages[addr >> 8]
+        if type(data) is bytes: data = self._ownPage(addr >> 8)
+        data[addr & 0xFF] = val
+
+    def _setByteHooked(self, addr: int, val: int):
+        if self._checked: ForkedMemory.setByte(self, addr, val)
+        else: self._setByteUnchecked(addr, val)
+        hooks = self._writeHooks[addr >> 8]
+        if hooks is not None:
+            for hook in hooks: hook(addr, val)
+
+    def setBytes(self, addrStart, valArray):
+        addrEnd = addrStart + len(valArray)
+        if self._checked:
+            self._checkRange(addrStart, addrEnd)
+            if type(valArray) not in (bytes, bytearray, memoryview):
+                for val in valArray:
+                    assert(type(val) == int)
+                    assert(val >= 0 and val < 256)
+
+        addr = addrStart
+        while addr < addrEnd:
+            page = addr >> 8
+            length = min(addrEnd, (page + 1) << 8) - addr
+            self._ownPage(page)[addr & 0xFF:(addr & 0xFF) + length] = valArray[addr - addrStart:addr - addrStart + length]
+            addr += length
+        self._notifyBulkWrite(addrStart, addrEnd)
+
+    def getBytes(self, addrStart, length):
+        if self._checked: self._checkRange(addrStart, addrStart + length)
+        if length == 0: return b""
+        # join only the pages the range touches
+        firstPage = addrStart >> 8
+        data = b"".join(self._pages[firstPage:((addrStart + length - 1) >> 8) + 1])
+        offset = addrStart & 0xFF
+        return bytes(data[offset:offset + length])
+
+    def fill(self, addrStart, length, val):
+        if self._checked:
+            self._checkRange(addrStart, addrStart + length)
+            assert(type(val) == int)
+            assert(val >= 0 and val < 256)
+        self.setBytes(addrStart, bytes((val,)) * length)
+
+    def snapshot(self):
+        return b"".join(self._pages)
+
+    def restore(self, image):
+        if self.snapshot() == image: return
+        for page in range(256):
+            data = image[page << 8:(page + 1) << 8]
+            if self._pages[page] != data:
+                self._pages[page] = bytes(data)
+                self._dirty[page] = 1
+        self._notifyBulkWrite(0, 65536)
+
+    def zeroMemory(self):
+        self._pages = [zeroPage for i in range(256)]
+        self._dirty = bytearray(b"\x01" * 256)
+        self._notifyBulkWrite(0, 65536)
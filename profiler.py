@@ -0,0 +1,249 @@
+'''
+Sampling profiler: finds the 6502 routines a program spends its time in.
+
+python profiler.py image.bin [--labels labels.txt] [--start 0x400] [--every N | --interval S] [--collapsed out.txt]
+
+Samples are taken every N instructions (deterministic, the default) or every S seconds of wall-clock time.
+Each sample records the PC and the JSR call stack, which is tracked by wrapping the JSR and RTS handlers while
+profiling. The flat profile attributes samples to the label at or below the sampled address; the collapsed stacks
+("outer;inner;leaf count" per line) can be fed to flame graph tools such as flamegraph.pl or speedscope.
+
+Label files are VICE / ca65 -Ln style ("al C:1234 .label" or "al 001234 .label");
+"label = $1234" assignments are accepted as well.
+'''
+import argparse
+import re
+import sys
+import threading
+from bisect import bisect_right
+
+from cpu import CPU, RunResult, StopCondition
+from loader import load
+from memory import Memory
+
+viceLabel = re.compile(r"^al\s+(?:[A-Za-z]:)?([0-9A-Fa-f]+)\s+\.?(\S+)")
+assignmentLabel = re.compile(r"^([A-Za-z_@.][\w@.]*)\s*(?:=|\bequ\b)\s*\$([0-9A-Fa-f]+)", re.IGNORECASE)
+
+class SymbolTable:
+    '''
+    Maps addresses to the nearest label at or below them, through a sorted index searched with bisect.
+    Addresses below the first label are named by their hex value.
+    '''
+    def __init__(self, labels=()):
+        byAddress = {}
+        for addr, name in labels:
+            # the first label at an address wins
+            byAddress.setdefault(addr & 0xFFFF, name)
+        self._addresses = sorted(byAddress)
+        self._names = [byAddress[addr] for addr in self._addresses]
+
+    @classmethod
+    def fromFile(cls, path):
+        labels = []
+        with open(path) as file:
+            for line in file:
+                line = line.strip()
+                match = viceLabel.match(line)
+                if match is not None:
+                    labels.append((int(match.group(1), 16), match.group(2)))
+                    continue
+                match = assignmentLabel.match(line)
+                if match is not None: labels.append((int(match.group(2), 16), match.group(1)))
+        return cls(labels)
+
+    def __len__(self):
+        return len(self._addresses)
+
+    def lookup(self, addr):
+        '''
+        returns the name of the label at or below addr
+        '''
+        i = bisect_right(self._addresses, addr) - 1
+        if i < 0: return "${addr:04X}".format(addr = addr)
+        return self._names[i]
+
+class Profiler:
+    '''
+    Profiles the CPU through Profiler.run. every samples once every that many instructions;
+    pass every=None and interval to sample from a background thread every interval seconds instead
+    (the thread only gets to run when the interpreter switches threads, see sys.setswitchinterval).
+
+    samples maps (call stack, pc) to a sample count; the call stack is the tuple of JSR target addresses.
+    '''
+    def __init__(self, cpu, symbols=None, every=1009, interval=0.001):
+        self._cpu = cpu
+        self.symbols = symbols if symbols is not None else SymbolTable()
+        # a prime, so that sampling doesn't lock step with loops
+        self.every = every
+        self.interval = interval
+        self.samples = {}
+        self._callStack = []
+        """
+        (JSR target, SP after the JSR) per active subroutine
+        """
+
+    def _trackCalls(self):
+        '''
+        wraps the JSR and RTS handlers to keep _callStack. Returns the dispatch table to restore afterwards.
+        '''
+        cpu = self._cpu
+        cpu._optimizeDecodeLut()
+        plainLut = cpu._decodeFunctionLookupTable
+        lut = list(plainLut)
+        jsr = plainLut[0x20]
+        rts = plainLut[0x60]
+        callStack = self._callStack
+
+        def executeJSR(operand):
+            jsr(operand)
+            # frames at or above the new SP were left without RTS (e.g. return address pulled off the stack)
+            while callStack and callStack[-1][1] <= cpu.sp: callStack.pop()
+            callStack.append((cpu.pc, cpu.sp))
+
+        def executeRTS(operand):
+            rts(operand)
+            while callStack and callStack[-1][1] < cpu.sp: callStack.pop()
+
+        lut[0x20] = executeJSR
+        lut[0x60] = executeRTS
+        cpu._decodeFunctionLookupTable = lut
+        # compiled blocks hold on to the handlers they were compiled with
+        if cpu._blockCache is not None: cpu._blockCache.flush()
+        return plainLut
+
+    def _sample(self):
+        key = (tuple(frame[0] for frame in self._callStack), self._cpu.pc)
+        self.samples[key] = self.samples.get(key, 0) + 1
+
+    def run(self, condition=None, maxInstructions=None, maxCycles=None):
+        '''
+        CPU.runUntil with sampling. Returns a RunResult covering the whole run.
+        Sampling every N instructions runs the CPU in slices of N instructions, so with the block cache
+        samples fall on block boundaries.
+        '''
+        cpu = self._cpu
+        plainLut = self._trackCalls()
+        try:
+            if self.every is None: return self._runTimed(condition, maxInstructions, maxCycles)
+            return self._runSliced(condition, maxInstructions, maxCycles)
+        finally:
+            cpu._decodeFunctionLookupTable = plainLut
+            if cpu._blockCache is not None: cpu._blockCache.flush()
+
+    def _runSliced(self, condition, maxInstructions, maxCycles):
+        cpu = self._cpu
+        unlimited = 1 << 62
+        instructionsLeft = unlimited if maxInstructions is None else maxInstructions
+        cyclesLeft = unlimited if maxCycles is None else maxCycles
+        instructions = cycles = 0
+        wallTime = 0.0
+
+        while True:
+            result = cpu.runUntil(condition, min(self.every, instructionsLeft), cyclesLeft)
+            instructions += result.instructions
+            cycles += result.cycles
+            wallTime += result.wallTime
+            instructionsLeft -= result.instructions
+            cyclesLeft -= result.cycles
+            self._sample()
+
+            reason = result.reason
+            if reason == RunResult.STOP_MAX_INSTRUCTIONS and instructionsLeft > 0: continue
+            if reason == RunResult.STOP_MAX_CYCLES and cyclesLeft > 0: continue
+            return RunResult(reason, cpu.pc, instructions, cycles, wallTime)
+
+    def _runTimed(self, condition, maxInstructions, maxCycles):
+        stopEvent = threading.Event()
+
+        def sampleLoop():
+            while not stopEvent.wait(self.interval): self._sample()
+
+        thread = threading.Thread(target=sampleLoop, name="6502 profiler", daemon=True)
+        thread.start()
+        try:
+            return self._cpu.runUntil(condition, maxInstructions, maxCycles)
+        finally:
+            stopEvent.set()
+            thread.join()
+
+    def sampleCount(self):
+        return sum(self.samples.values())
+
+    def flatProfile(self):
+        '''
+        returns (symbol, self samples, self share, total samples) per symbol, most self samples first.
+        Self samples were taken inside the symbol, total samples also count the subroutines it called.
+        '''
+        lookup = self.symbols.lookup
+        selfSamples = {}
+        totalSamples = {}
+        for (callStack, pc), count in self.samples.items():
+            leaf = lookup(pc)
+            selfSamples[leaf] = selfSamples.get(leaf, 0) + count
+            # count recursion only once
+            for symbol in set(lookup(addr) for addr in callStack) | {leaf}:
+                totalSamples[symbol] = totalSamples.get(symbol, 0) + count
+
+        allSamples = self.sampleCount() or 1
+        rows = [(symbol, selfSamples.get(symbol, 0), selfSamples.get(symbol, 0) / allSamples, total)
+                for symbol, total in totalSamples.items()]
+        rows.sort(key=lambda row: (row[1], row[3]), reverse=True)
+        return rows
+
+    def collapsedStacks(self):
+        '''
+        returns the samples as "outer;inner;leaf count" lines, the input format of flame graph tools
+        '''
+        lookup = self.symbols.lookup
+        stacks = {}
+        for (callStack, pc), count in self.samples.items():
+            frames = [lookup(addr) for addr in callStack]
+            leaf = lookup(pc)
+            # samples taken in the body of the innermost subroutine
+            if not frames or frames[-1] != leaf: frames.append(leaf)
+            key = ";".join(frames)
+            stacks[key] = stacks.get(key, 0) + count
+        return ["{stack} {count}".format(stack = stack, count = count) for stack, count in sorted(stacks.items())]
+
+    def formatFlatProfile(self, limit=None):
+        lines = ["  self%     self    total  symbol"]
+        for symbol, selfCount, share, total in self.flatProfile()[:limit]:
+            lines.append("{share:>7.1%} {selfCount:>8} {total:>8}  {symbol}".format(
+                share = share, selfCount = selfCount, total = total, symbol = symbol))
+        return "\n".join(lines)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="sampling profiler for 6502 programs")
+    parser.add_argument("image", help="program image (raw binary, Intel HEX or S-record)")
+    parser.add_argument("--base", type=lambda value: int(value, 0), default=0, help="load address of raw binaries")
+    parser.add_argument("--start", type=lambda value: int(value, 0), help="start address (default: entry point or reset vector)")
+    parser.add_argument("--labels", help="VICE / ca65 label file")
+    parser.add_argument("--every", type=int, default=1009, help="sample every N instructions")
+    parser.add_argument("--interval", type=float, help="sample every S seconds of wall-clock time instead")
+    parser.add_argument("--max-instructions", type=int, default=10000000)
+    parser.add_argument("--blocks", action="store_true", help="use the block cache")
+    parser.add_argument("--limit", type=int, default=30, help="rows of the flat profile to print")
+    parser.add_argument("--collapsed", help="write collapsed stacks to this file")
+    args = parser.parse_args(argv)
+
+    memory = Memory(checked=False)
+    cpu = CPU(memory, useBlockCache=args.blocks, checked=False)
+    image = load(memory, args.image, args.base)
+    cpu.reset()
+    start = args.start if args.start is not None else image.entry
+    if start is not None: cpu.setPC(start)
+
+    symbols = SymbolTable.fromFile(args.labels) if args.labels else None
+    if args.interval is not None: profiler = Profiler(cpu, symbols, every=None, interval=args.interval)
+    else: profiler = Profiler(cpu, symbols, every=args.every)
+    result = profiler.run(StopCondition(trap=True, brk=True), args.max_instructions)
+
+    print(result)
+    print("{samples} samples".format(samples = profiler.sampleCount()))
+    print(profiler.formatFlatProfile(args.limit))
+    if args.collapsed:
+        with open(args.collapsed, "w") as file: file.write("\n".join(profiler.collapsedStacks()) + "\n")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,172 @@
+'''
+Runs a manifest of test programs across a process pool:
+
+python regress.py testProgram/manifest.json [--workers N] [--blocks] [--output results.json]
+
+The manifest is JSON, paths are relative to it and numbers may be written as strings ("0x3469"):
+{
+    "jobs": [
+        {
+            "name": "functional test",
+            "image": "6502_functional_test.bin",
+            "base": "0x0000",
+            "start": "0x3300",
+            "success": {"reason": "trap", "pc": "0x3469"},
+            "maxInstructions": 100000000
+        }
+    ]
+}
+image is loaded with loader.load (raw binaries at base, Intel HEX and S-records at their own addresses).
+start defaults to the image's entry point, then to the reset vector. success.reason is a RunResult.STOP_* string,
+success.pc and success.memory ({"addr": value}) are optional further checks.
+Each worker process keeps one CPU / Memory pair and restores a pristine snapshot of it between jobs.
+'''
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from cpu import CPU, StopCondition
+from loader import load
+from memory import Memory
+
+def toInt(value):
+    return int(value, 0) if type(value) == str else value
+
+class Job:
+    '''
+    One manifest entry, with paths resolved and numbers parsed.
+    '''
+    def __init__(self, name, image, base=0, start=None, success=None, maxInstructions=None, maxCycles=None):
+        success = success if success is not None else {"reason": "trap"}
+        self.name = name
+        self.image = image
+        self.base = toInt(base)
+        self.start = toInt(start)
+        self.successReason = success.get("reason", "trap")
+        self.successPC = toInt(success.get("pc"))
+        self.successMemory = {toInt(addr): toInt(value) for addr, value in success.get("memory", {}).items()}
+        self.maxInstructions = toInt(maxInstructions)
+        self.maxCycles = toInt(maxCycles)
+
+def loadManifest(path):
+    '''
+    returns the list of Jobs in the manifest at path
+    '''
+    with open(path) as file: manifest = json.load(file)
+    directory = os.path.dirname(os.path.abspath(path))
+    jobs = []
+    for entry in manifest["jobs"]:
+        entry = dict(entry)
+        entry["image"] = os.path.join(directory, entry["image"])
+        jobs.append(Job(**entry))
+    return jobs
+
+class JobResult:
+    def __init__(self, name, passed, reason=None, pc=None, instructions=0, cycles=0, wallTime=0.0, error=None):
+        self.name = name
+        self.passed = passed
+        self.reason = reason
+        self.pc = pc
+        self.instructions = instructions
+        self.cycles = cycles
+        self.wallTime = wallTime
+        self.error = error
+
+    def __str__(self):
+        status = "PASS" if self.passed else "FAIL"
+        if self.error is not None: return "{status} {name}: {error}".format(status = status, name = self.name, error = self.error)
+        return "{status} {name}: stopped ({reason}) at {pc} after {instructions} instructions, {cycles} cycles, {wallTime:.3f}s".format(
+            status = status, name = self.name, reason = self.reason, pc = hex(self.pc),
+            instructions = self.instructions, cycles = self.cycles, wallTime = self.wallTime)
+
+workerMachine = None
+"""
+(cpu, pristine snapshot) of the current worker process, set up by initWorker
+"""
+
+def initWorker(useBlockCache=False):
+    global workerMachine
+    memory = Memory(checked=False)
+    cpu = CPU(memory, useBlockCache=useBlockCache, checked=False)
+    workerMachine = (cpu, cpu.snapshot())
+
+def runJob(job):
+    '''
+    runs job on the worker's CPU and returns a JobResult. Never raises, errors fail the job.
+    '''
+    if workerMachine is None: initWorker()
+    cpu, pristine = workerMachine
+    beginTime = time.perf_counter()
+    try:
+        cpu.restore(pristine)
+        # interrupts and events of the previous job aren't part of the snapshot
+        cpu.clearInterrupts()
+        image = load(cpu._memory, job.image, job.base)
+        cpu.reset()
+        start = job.start if job.start is not None else image.entry
+        if start is not None: cpu.setPC(start)
+
+        result = cpu.runUntil(StopCondition(trap=True, brk=True), job.maxInstructions, job.maxCycles)
+    except Exception as error:
+        return JobResult(job.name, False, wallTime=time.perf_counter() - beginTime, error=repr(error))
+
+    passed = result.reason == job.successReason
+    if job.successPC is not None: passed = passed and result.pc == job.successPC
+    for addr, value in job.successMemory.items():
+        passed = passed and cpu._memory.getByte(addr) == value
+    return JobResult(job.name, passed, result.reason, result.pc, result.instructions, result.cycles, time.perf_counter() - beginTime)
+
+class Summary:
+    def __init__(self, results, elapsed):
+        self.results = results
+        self.elapsed = elapsed
+        self.passed = sum(1 for result in results if result.passed)
+        self.failed = len(results) - self.passed
+        self.cycles = sum(result.cycles for result in results)
+        self.cpuTime = sum(result.wallTime for result in results)
+
+    def __str__(self):
+        return "{passed} passed, {failed} failed, {cycles} cycles, {cpuTime:.2f}s in jobs, {elapsed:.2f}s elapsed".format(
+            passed = self.passed, failed = self.failed, cycles = self.cycles, cpuTime = self.cpuTime, elapsed = self.elapsed)
+
+    def toJSON(self):
+        return {
+            "passed": self.passed,
+            "failed": self.failed,
+            "cycles": self.cycles,
+            "elapsed": self.elapsed,
+            "results": [vars(result) for result in self.results]
+        }
+
+def runJobs(jobs, workers=None, useBlockCache=False, log=None):
+    '''
+    fans jobs out over a ProcessPoolExecutor with workers processes (default: one per CPU core).
+    Returns a Summary, with results in manifest order.
+    '''
+    beginTime = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=initWorker, initargs=(useBlockCache,)) as executor:
+        for result in executor.map(runJob, jobs):
+            results.append(result)
+            if log is not None: log(result)
+    return Summary(results, time.perf_counter() - beginTime)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="run a manifest of 6502 test programs in parallel")
+    parser.add_argument("manifest")
+    parser.add_argument("--workers", type=int, help="worker processes (default: one per CPU core)")
+    parser.add_argument("--blocks", action="store_true", help="use the block cache")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    summary = runJobs(loadManifest(args.manifest), args.workers, args.blocks, log=print)
+    print(summary)
+    if args.output:
+        with open(args.output, "w") as file: json.dump(summary.toJSON(), file, indent=2)
+    return 0 if summary.failed == 0 else 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,27 +1,22 @@
-from cpu import CPU
+from cpu import CPU, StopCondition, RunResult
 from memory import Memory
+from loader import load
 import os
+import sys
 DIR = os.path.dirname(os.path.abspath(__file__))
 
+# the functional test signals success by trapping (JMP *) here, any other trap is a failed test
+SUCCESS_TRAP = 0x3469
+
 memory = Memory()
 cpu = CPU(memory)
 
+load(memory, os.path.join(DIR, "testProgram", "6502_functional_test.bin"))
+cpu.reset()
 
-with open(os.path.join(DIR, "testProgram", "6502_functional_test.bin"), "rb") as file:
-    bin_arr = []
-    byte = file.read(1)
-    while byte:
-        bin_arr.append(int.from_bytes(byte))
-        byte = file.read(1)
-
-    with open(os.path.join(DIR, "testProgram", "bindecoded"), "w") as file:
-        for i in range(len(bin_arr)):
-            file.write(hex(i) + ": " + hex(bin_arr[i]) + ", ")
-            if i % 10 == 0: file.write("\n")
-    memory.setBytes(0x00, bin_arr)
-    cpu.reset()
-    
-    print("\n")
-    cpu.setPC(0x3300)
-    cpu.run()
-
+print("\n")
+cpu.setPC(0x3300)
+result = cpu.runUntil(StopCondition(trap=True, brk=True))
+print(result)
+print(cpu)
+sys.exit(0 if result.reason == RunResult.STOP_TRAP and result.pc == SUCCESS_TRAP else 1)
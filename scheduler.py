@@ -0,0 +1,106 @@
+import heapq
+
+never = 1 << 62
+"""
+nextCycle while nothing is scheduled
+"""
+
+class Event:
+    '''
+    Returned by Scheduler.at / Scheduler.after. callback(cycle) is called with the cycle it was scheduled for,
+    so periodic events can reschedule themselves without drifting: scheduler.at(cycle + period, tick).
+    '''
+    def __init__(self, cycle, callback):
+        self.cycle = cycle
+        self.callback = callback
+        """
+        None once the event was cancelled or has fired
+        """
+
+    def pending(self):
+        return self.callback is not None
+
+class Scheduler:
+    '''
+    Events keyed on the absolute clock cycle (CPU.getClockCycle), kept in a heap.
+    Peripherals schedule callbacks (timers, VBLANK, asserting IRQ / NMI) instead of being polled:
+    CPU.runUntil only compares the clock against nextCycle, runs instructions in uninterrupted batches
+    up to it and calls runDue in between. Events therefore fire at the first instruction boundary
+    (with the block cache: block boundary) at or after their cycle. Events due on the same cycle fire in
+    the order they were scheduled.
+    Cancelled events stay in the heap until they reach its top, so cancelling is O(1).
+    '''
+    def __init__(self, clock):
+        self._clock = clock
+        """
+        function returning the current clock cycle
+        """
+        self._heap = []
+        """
+        (cycle, sequence number, Event)
+        """
+        self._sequence = 0
+        self._pending = 0
+        self.nextCycle = never
+        """
+        the cycle of the earliest pending event, never if there is none
+        """
+
+    def at(self, cycle, callback):
+        '''
+        schedules callback(cycle) for the absolute clock cycle cycle and returns the Event
+        '''
+        event = Event(cycle, callback)
+        heapq.heappush(self._heap, (cycle, self._sequence, event))
+        self._sequence += 1
+        self._pending += 1
+        if cycle < self.nextCycle: self.nextCycle = cycle
+        return event
+
+    def after(self, cycles, callback):
+        '''
+        schedules callback(cycle) cycles clock cycles from now and returns the Event
+        '''
+        return self.at(self._clock() + cycles, callback)
+
+    def cancel(self, event):
+        if event.callback is None: return
+        event.callback = None
+        self._pending -= 1
+        self._dropCancelled()
+
+    def runDue(self, now=None):
+        '''
+        calls the callbacks of all events due at now (default: the current clock cycle), earliest first.
+        Events they schedule for now or earlier fire in the same call. Returns the number of events fired.
+        '''
+        if now is None: now = self._clock()
+        heap = self._heap
+        fired = 0
+        while heap and heap[0][0] <= now:
+            cycle, sequence, event = heapq.heappop(heap)
+            callback = event.callback
+            if callback is None: continue
+            event.callback = None
+            self._pending -= 1
+            fired += 1
+            callback(cycle)
+        self._dropCancelled()
+        return fired
+
+    def clear(self):
+        '''
+        cancels all pending events
+        '''
+        for cycle, sequence, event in self._heap: event.callback = None
+        self._heap = []
+        self._pending = 0
+        self.nextCycle = never
+
+    def _dropCancelled(self):
+        heap = self._heap
+        while heap and heap[0][2].callback is None: heapq.heappop(heap)
+        self.nextCycle = heap[0][0] if heap else never
+
+    def __len__(self):
+        return self._pending
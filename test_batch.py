@@ -0,0 +1,137 @@
+import random
+
+from batch import BatchCPU
+from cpu import CPU, RunResult, irqVector
+from memory import Memory
+
+# LDY #0, LDA #0, loop: EOR ($10),Y, ADC $2000,Y, DEY, BNE loop, STA $30, JMP $100E
+checksumProgram = [0xA0, 0x00, 0xA9, 0x00, 0x51, 0x10, 0x79, 0x00, 0x20, 0x88, 0xD0, 0xF8, 0x85, 0x30, 0x4C, 0x0E, 0x10]
+
+def makeCpus(n, program):
+    rng = random.Random(n)
+    cpus = []
+    for i in range(n):
+        memory = Memory(checked=False)
+        cpu = CPU(memory, checked=False)
+        cpu.reset()
+        memory.setBytes(0x1000, program)
+        memory.setBytes(0x10, [0x00, 0x21])
+        memory.setBytes(0x2000, bytes(rng.randrange(256) for i in range(512)))
+        # binary and decimal mode, carry set and clear
+        cpu.p = rng.choice([0x00, 0x01, 0x08, 0x09])
+        cpus.append(cpu)
+    return cpus
+
+def testMatchesCPU():
+    cpus = makeCpus(16, checksumProgram)
+    batch = BatchCPU.fromCPUs(cpus)
+    reasons = batch.runUntil(5000)
+    assert(reasons == [RunResult.STOP_TRAP] * 16)
+
+    for lane, cpu in enumerate(cpus):
+        result = cpu.runUntil(maxInstructions=5000)
+        laneCpu = batch.toCPU(lane)
+        assert((laneCpu.a, laneCpu.x, laneCpu.y, laneCpu.sp, laneCpu.pc, laneCpu.p) == (cpu.a, cpu.x, cpu.y, cpu.sp, cpu.pc, cpu.p))
+        assert(batch.cycles[lane] == result.cycles)
+        assert(batch.instructions[lane] == result.instructions)
+        assert(batch.getBytes(lane, 0, 65536) == cpu._memory.snapshot())
+
+# LDX #8, loop: JSR step, DEX, BNE loop, JMP $1009; step: LDA $2000,X, EOR $30, STA $30, RTS
+subroutineProgram = [0xA2, 0x08, 0x20, 0x0C, 0x10, 0xCA, 0xD0, 0xFA, 0xEA, 0x4C, 0x09, 0x10,
+                     0xBD, 0x00, 0x20, 0x45, 0x30, 0x85, 0x30, 0x60]
+
+def runAgainstCPUs(program):
+    cpus = makeCpus(8, program)
+    batch = BatchCPU.fromCPUs(cpus)
+    reasons = batch.runUntil(5000)
+    for lane, cpu in enumerate(cpus):
+        result = cpu.runUntil(maxInstructions=5000)
+        assert(reasons[lane] == result.reason)
+        laneCpu = batch.toCPU(lane)
+        assert((laneCpu.a, laneCpu.x, laneCpu.y, laneCpu.sp, laneCpu.pc, laneCpu.p) == (cpu.a, cpu.x, cpu.y, cpu.sp, cpu.pc, cpu.p))
+        assert(batch.cycles[lane] == result.cycles)
+        assert(batch.getBytes(lane, 0, 65536) == cpu._memory.snapshot())
+    return batch
+
+def testSubroutines():
+    batch = runAgainstCPUs(subroutineProgram)
+    assert(batch.stopReasons == [RunResult.STOP_TRAP] * 8)
+    assert(list(batch.sp) == [0xFD] * 8)
+
+def testInterrupts():
+    # SEI, CLI, LDA #1, loop: JMP loop; IRQ handler: INC $40, RTI
+    cpus = makeCpus(4, [0x78, 0x58, 0xA9, 0x01, 0x4C, 0x04, 0x10])
+    for cpu in cpus:
+        cpu._memory.setBytes(0x1100, [0xE6, 0x40, 0x40])
+        cpu._memory.setBytes(0xFFFE, [0x00, 0x11])
+    batch = BatchCPU.fromCPUs(cpus)
+    batch.runUntil(3)
+    # the odd lanes take an IRQ
+    batch.interrupt(irqVector, lanes=[1, 3])
+    assert(list(batch.pc) == [0x1004, 0x1100, 0x1004, 0x1100])
+    reasons = batch.runUntil(100)
+    assert(reasons == [RunResult.STOP_TRAP] * 4)
+
+    for lane, cpu in enumerate(cpus):
+        cycles = cpu.runUntil(maxInstructions=3).cycles
+        if lane % 2:
+            cpu.interrupt(irqVector)
+            cycles += 7
+        cycles += cpu.runUntil(maxInstructions=100).cycles
+        laneCpu = batch.toCPU(lane)
+        assert((laneCpu.a, laneCpu.sp, laneCpu.pc, laneCpu.p) == (cpu.a, cpu.sp, cpu.pc, cpu.p))
+        assert(batch.getBytes(lane, 0, 65536) == cpu._memory.snapshot())
+        assert(batch.cycles[lane] == cycles)
+        assert(batch.memory[lane, 0x40] == lane % 2)
+        assert(not laneCpu.getFlag("interrupt disable"))
+
+def testDivergingBranches():
+    batch = BatchCPU(4)
+    batch.reset()
+    # LDA $2000, BMI negative, LDX #1, JMP $100A, negative: LDX #2, JMP $100A
+    batch.setBytes(0x1000, [0xAD, 0x00, 0x20, 0x30, 0x05, 0xA2, 0x01, 0x4C, 0x0C, 0x10, 0xA2, 0x02, 0x4C, 0x0C, 0x10])
+    batch.setBytes(0x2000, [0x80], lanes=[1, 3])
+
+    cycles = batch.runSingleInstructionCycle()
+    assert(list(cycles) == [4, 4, 4, 4])
+    # only the masked lanes run
+    cycles = batch.runSingleInstructionCycle(mask=batch.a != 0)
+    assert(list(cycles) == [0, 3, 0, 3])
+    assert(list(batch.pc) == [0x1003, 0x100A, 0x1003, 0x100A])
+
+    batch.runUntil(100)
+    assert(list(batch.x) == [1, 2, 1, 2])
+    assert(list(batch.pc) == [0x100C, 0x100C, 0x100C, 0x100C])
+
+def testSameOpcodesAsCPU():
+    batch = BatchCPU(1)
+    implemented = {opcode for opcode in range(256) if batch._handlers[opcode] is not None}
+    assert(implemented == CPU(Memory())._implementedOpcodes)
+
+def testUnimplementedStopsLane():
+    batch = BatchCPU(2)
+    batch.reset()
+    # NOP, then an unimplemented op-code in lane 1 only
+    batch.setBytes(0x1000, [0xEA, 0xEA, 0x4C, 0x02, 0x10])
+    batch.setBytes(0x1001, [0x02], lanes=[1])
+    reasons = batch.runUntil(100)
+    assert(reasons == [RunResult.STOP_TRAP, RunResult.STOP_UNIMPLEMENTED])
+    assert(list(batch.pc) == [0x1002, 0x1001])
+    assert(list(batch.instructions) == [3, 1])
+
+tests = [
+    testMatchesCPU,
+    testSubroutines,
+    testInterrupts,
+    testDivergingBranches,
+    testSameOpcodesAsCPU,
+    testUnimplementedStopsLane
+]
+
+def testAll():
+    for test in tests:
+        test()
+        print("test passed: " + test.__name__)
+
+if __name__ == "__main__":
+    testAll()
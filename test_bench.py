@@ -0,0 +1,42 @@
+import json
+
+from bench import addressingMode, loopBenchmarks, opcodeBenchmarks, runSuite, compare
+
+def testAddressingMode():
+    assert(addressingMode(0xA9) == "immediate")
+    assert(addressingMode(0xB1) == "indirectY")
+    assert(addressingMode(0xBE) == "absoluteY")
+    assert(addressingMode(0x96) == "zeroPageY")
+    assert(addressingMode(0x0A) == "accumulator")
+    assert(addressingMode(0xD0) == "relative")
+
+def testSuiteReport():
+    benchmarks = opcodeBenchmarks([0xEA, 0x0A]) + loopBenchmarks()[:1]
+    report = json.loads(json.dumps(runSuite(benchmarks, instructions=2000, samples=100)))
+    nop = report["results"]["opcode EA"]
+    assert(nop["instructions"] == 2000)
+    assert(nop["ips"] > 0 and nop["mhz"] > 0)
+    assert(nop["p50Ns"] <= nop["p99Ns"])
+    # broken (here: unimplemented) op-codes are reported, not fatal
+    assert("error" in report["results"]["opcode 0A"])
+    assert(report["results"]["branch tight loop"]["group"] == "branch")
+
+def testCompare():
+    base = {"results": {"a": {"ips": 100.0}, "b": {"ips": 100.0}, "c": {"error": "x"}}}
+    new = {"results": {"a": {"ips": 90.0}, "b": {"ips": 99.0}, "c": {"ips": 1.0}}}
+    rows = compare(base, new, threshold=0.05)
+    assert([(row[0], row[4]) for row in rows] == [("a", True), ("b", False)])
+
+tests = [
+    testAddressingMode,
+    testSuiteReport,
+    testCompare
+]
+
+def testAll():
+    for test in tests:
+        test()
+        print("test passed: " + test.__name__)
+
+if __name__ == "__main__":
+    testAll()
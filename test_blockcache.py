@@ -0,0 +1,145 @@
+from cpu import CPU, RunResult
+from memory import Memory
+
+# LDX #5, loop: ADC #3, DEX, BNE loop, JMP $1008
+loopProgram = [0xA2, 0x05, 0x69, 0x03, 0xCA, 0xD0, 0xFB, 0xEA, 0x4C, 0x08, 0x10]
+
+def runSteps(cpu, n):
+    cycles = 0
+    for i in range(n): cycles += cpu.runSingleInstructionCycle()
+    return cycles
+
+def runBlocks(cpu, n):
+    instructions = 0
+    cycles = 0
+    while instructions < n:
+        i, c = cpu.runBlock()
+        instructions += i
+        cycles += c
+    return instructions, cycles
+
+def testBlockMatchesSingleStep():
+    memory = Memory()
+    cpu = CPU(memory)
+    cpu.reset()
+    memory.setBytes(0x1000, loopProgram)
+
+    blockMemory = Memory()
+    blockCpu = CPU(blockMemory, useBlockCache=True)
+    blockCpu.reset()
+    blockMemory.setBytes(0x1000, loopProgram)
+
+    # LDX + 5 iterations of ADC, DEX, BNE + NOP + JMP
+    instructions, cycles = runBlocks(blockCpu, 18)
+    assert(instructions == 18)
+    assert(cycles == runSteps(cpu, 18))
+    assert(blockCpu.getPC() == cpu.getPC() == 0x1008)
+    assert(blockCpu.getRegister("A") == cpu.getRegister("A") == 15)
+    assert(blockCpu.getRegister("X") == cpu.getRegister("X") == 0)
+    assert(blockCpu.getFlag("zero"))
+
+def testBlockInvalidatedOnWrite():
+    memory = Memory()
+    cpu = CPU(memory, useBlockCache=True)
+    cpu.reset()
+    # LDA #1, JMP $1000
+    memory.setBytes(0x1000, [0xA9, 0x01, 0x4C, 0x00, 0x10])
+    assert(cpu.runBlock() == (2, 5))
+    assert(cpu.getRegister("A") == 1)
+
+    # patch LDA #1 into LDX #1
+    memory.setByte(0x1000, 0xA2)
+    assert(cpu.runBlock() == (2, 5))
+    assert(cpu.getRegister("X") == 1)
+
+def testDroppedBlockUnmarked():
+    memory = Memory()
+    cpu = CPU(memory, useBlockCache=True)
+    cpu.reset()
+    # NOP, NOP, JMP $1001: two overlapping blocks, at $1000 and at $1001
+    memory.setBytes(0x1000, [0xEA, 0xEA, 0x4C, 0x01, 0x10])
+    cache = cpu._blockCache
+    cache.getBlock(0x1000)
+    cache.getBlock(0x1001)
+    memory.setByte(0x1000, 0xEA)
+    # later writes to $1000 don't invalidate anything, the bytes of the block at $1001 still do
+    assert(0x1000 not in cache._blocks and 0x1001 in cache._blocks)
+    assert(cache._codeMap[0x1000] == 0)
+    assert(cache._codeMap[0x1001:0x1005] == b"\x01" * 4)
+    memory.setByte(0x1003, 0x01)
+    assert(not cache._blocks and not any(cache._codeMap))
+
+def testBlockStopsAtUnimplemented():
+    memory = Memory()
+    cpu = CPU(memory, useBlockCache=True)
+    cpu.reset()
+    # NOP, NOP, BRK
+    memory.setBytes(0x1000, [0xEA, 0xEA, 0x00])
+    assert(cpu.runBlock() == (2, 4))
+    assert(cpu.getPC() == 0x1002)
+
+def testRunUntilWithBlocks():
+    memory = Memory()
+    cpu = CPU(memory, useBlockCache=True)
+    cpu.reset()
+    memory.setBytes(0x1000, loopProgram)
+    result = cpu.runUntil()
+    assert(result.reason == RunResult.STOP_TRAP)
+    assert(result.pc == 0x1008)
+    assert(result.instructions == 18)
+    assert(cpu.getRegister("A") == 15)
+
+    # STA $10, JMP $2002: the trap is the last instruction of a longer block
+    memory.setBytes(0x2000, [0x85, 0x10, 0x4C, 0x02, 0x20])
+    cpu.setPC(0x2000)
+    result = cpu.runUntil()
+    assert(result.reason == RunResult.STOP_TRAP)
+    assert(result.pc == 0x2002)
+
+# LDX #$10, loop: LDA $20F0,X, STA $2180,X, DEX, BNE loop, LDA #5, STA $11, loop2: INC $10, BNE loop2,
+# CMP #5, BEQ +2, LDX #$FF, loop3: DEY, BNE loop3, JMP $101C
+fusionProgram = [0xA2, 0x10, 0xBD, 0xF0, 0x20, 0x9D, 0x80, 0x21, 0xCA, 0xD0, 0xF7, 0xA9, 0x05, 0x85, 0x11,
+                 0xE6, 0x10, 0xD0, 0xFC, 0xC9, 0x05, 0xF0, 0x02, 0xA2, 0xFF, 0x88, 0xD0, 0xFD, 0x4C, 0x1C, 0x10]
+
+def runFusion(program, pc, useBlockCache, pairs=None):
+    memory = Memory()
+    cpu = CPU(memory, useBlockCache=useBlockCache)
+    cpu.reset()
+    memory.setBytes(0x20F0, bytes(range(1, 0x21)))
+    memory.setBytes(pc, program)
+    cpu.setPC(pc)
+    if pairs is not None: cpu.fuseOpcodePairs(pairs)
+    result = cpu.runUntil()
+    assert(result.reason == RunResult.STOP_TRAP)
+    return (result.pc, result.instructions, result.cycles, cpu.a, cpu.x, cpu.y, cpu.sp, cpu.p, memory.snapshot())
+
+def testFusedMatchesUnfused():
+    # INC $03, BNE +0, INX, JMP $0005: INC patches the branch offset, so the fused INC BNE has to stop after INC
+    selfModifying = [0xE6, 0x03, 0xD0, 0x00, 0xE8, 0x4C, 0x05, 0x00]
+    for program, pc in ((fusionProgram, 0x1000), (selfModifying, 0x0000)):
+        stepped = runFusion(program, pc, False)
+        assert(runFusion(program, pc, True, []) == stepped)
+        assert(runFusion(program, pc, True) == stepped)
+    assert(stepped[4] == 0)
+
+    memory = Memory()
+    cpu = CPU(memory, useBlockCache=True)
+    assert(cpu.fuseOpcodePairs([(0xCA, 0xD0), (0xD0, 0xCA), (0xEA, 0x20), (0x02, 0xEA)]) == [(0xCA, 0xD0)])
+    assert(cpu.fork()._fusedHandlers.keys() == {(0xCA, 0xD0)})
+
+tests = [
+    testBlockMatchesSingleStep,
+    testBlockInvalidatedOnWrite,
+    testDroppedBlockUnmarked,
+    testBlockStopsAtUnimplemented,
+    testRunUntilWithBlocks,
+    testFusedMatchesUnfused
+]
+
+def testAll():
+    for test in tests:
+        test()
+        print("test passed: " + test.__name__)
+
+if __name__ == "__main__":
+    testAll()
@@ -0,0 +1,127 @@
+import time
+from bus import Bus, RAM, ROM, MIRROR, DEVICE
+from cpu import CPU, RunResult, StopCondition
+from memory import Memory
+
+def testRAMFastPath():
+    bus = Bus()
+    assert("getByte" not in bus.__dict__)
+    bus.setByte(0x1234, 0x56)
+    assert(bus.getByte(0x1234) == 0x56)
+
+    # ROM is read from the backing RAM, only writes dispatch
+    bus.mapROM(0xF0)
+    assert("getByte" not in bus.__dict__ and "fetchByte" not in bus.__dict__ and "setByte" in bus.__dict__)
+    bus.mapDevice(0xD0, 1, read=lambda addr: 0)
+    assert("getByte" in bus.__dict__ and "fetchByte" in bus.__dict__)
+    bus.mapRAM(0xD0)
+    bus.mapRAM(0xF0)
+    assert("getByte" not in bus.__dict__ and "fetchByte" not in bus.__dict__ and "setByte" not in bus.__dict__)
+    assert(bus.pageType(0xF0) == RAM)
+
+def testRAMSpeedWithDevice():
+    # LDX #$28, outer: LDY #0, loop: LDA $2000,Y, STA $3000,Y, DEY, BNE loop, DEX, BNE outer, JMP $1010
+    program = [0xA2, 0x28, 0xA0, 0x00, 0xB9, 0x00, 0x20, 0x99, 0x00, 0x30, 0x88, 0xD0, 0xF7, 0xCA, 0xD0, 0xF2, 0x4C, 0x10, 0x10]
+    def bestTime(createMemory):
+        best = None
+        for i in range(5):
+            memory = createMemory()
+            cpu = CPU(memory, checked=False)
+            cpu.reset()
+            memory.setBytes(0x1000, program)
+            beginTime = time.perf_counter()
+            cpu.runUntil(StopCondition())
+            elapsed = time.perf_counter() - beginTime
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+    def busWithDevice():
+        bus = Bus(checked=False)
+        bus.mapDevice(0xD0, 1, read=lambda addr: 0, write=lambda addr, val: None)
+        return bus
+    # RAM accesses on a bus with a device page run at (about) Memory's speed, with some slack for noise
+    assert(bestTime(busWithDevice) < bestTime(lambda: Memory(checked=False)) * 1.15)
+
+def testROM():
+    bus = Bus()
+    bus.mapROM(0xE0, 0x20, bytes([0xEA, 0xEA]))
+    assert(bus.pageType(0xFF) == ROM)
+    bus.setByte(0xE000, 0x00)
+    assert(bus.getByte(0xE000) == 0xEA)
+    # bulk writes load the backing RAM
+    bus.setBytes(0xE000, [0x4C])
+    assert(bus.getByte(0xE000) == 0x4C)
+
+def testMirror():
+    bus = Bus()
+    # 2 KiB of RAM mirrored up to 0x1FFF
+    bus.mapMirror(0x08, 0x18, 0x00, 0x08)
+    assert(bus.pageType(0x1F) == MIRROR)
+    bus.setByte(0x0801, 0x42)
+    assert(bus.getByte(0x0001) == 0x42)
+    assert(bus.getByte(0x1801) == 0x42)
+    bus.setByte(0x1FFF, 0x24)
+    assert(bus.getByte(0x07FF) == 0x24)
+
+def testDevice():
+    bus = Bus()
+    written = []
+    bus.mapDevice(0xD0, 1, read=lambda addr: addr & 0xFF, write=lambda addr, val: written.append((addr, val)))
+    assert(bus.pageType(0xD0) == DEVICE)
+    assert(bus.getByte(0xD012) == 0x12)
+    assert(bus.fetchByte(0xD013) == 0x13)
+    bus.setByte(0xD020, 0x07)
+    assert(written == [(0xD020, 0x07)])
+    # the backing RAM is untouched
+    assert(bus.getBytes(0xD020, 1) == bytes(1))
+
+def testCPUOnBus():
+    bus = Bus()
+    written = []
+    bus.mapDevice(0xD0, 1, read=lambda addr: 0x99, write=lambda addr, val: written.append(val))
+    cpu = CPU(bus, useBlockCache=True)
+    cpu.reset()
+    # LDA $D000, STA $D001, JMP $1006
+    bus.setBytes(0x1000, [0xAD, 0x00, 0xD0, 0x8D, 0x01, 0xD0, 0x4C, 0x06, 0x10])
+    result = cpu.runUntil()
+    assert(result.reason == RunResult.STOP_TRAP)
+    assert(cpu.a == 0x99)
+    assert(written == [0x99])
+
+def testFork():
+    bus = Bus()
+    bus.mapROM(0xE0, 0x20, bytes([0xEA]))
+    bus.mapMirror(0x08, 0x18, 0x00, 0x08)
+    bus.setByte(0x0001, 0x42)
+    fork = bus.fork()
+    # the fork keeps the mapping and has its own RAM
+    assert(fork.pageType(0xE0) == ROM and fork.pageType(0x1F) == MIRROR)
+    fork.setByte(0xE000, 0x00)
+    assert(fork.getByte(0xE000) == 0xEA)
+    fork.setByte(0x0801, 0x24)
+    assert(fork.getByte(0x0001) == 0x24 and bus.getByte(0x0001) == 0x42)
+
+    cpu = CPU(bus)
+    assert(type(cpu.fork()._memory) is Bus)
+    bus.mapDevice(0xD0, 1)
+    try:
+        bus.fork()
+        assert(False)
+    except ValueError: pass
+
+tests = [
+    testRAMFastPath,
+    testRAMSpeedWithDevice,
+    testROM,
+    testMirror,
+    testDevice,
+    testCPUOnBus,
+    testFork
+]
+
+def testAll():
+    for test in tests:
+        test()
+        print("test passed: " + test.__name__)
+
+if __name__ == "__main__":
+    testAll()
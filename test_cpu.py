@@ -1,4 +1,4 @@
-from cpu import CPU
+from cpu import CPU, StopCondition, RunResult, UnimplementedInstruction
 from memory import Memory
 
 memory = Memory()
@@ -11,7 +11,29 @@ def testNOP():
     assert(cpu.runSingleInstructionCycle() == 2)
     assert(cpu.runSingleInstructionCycle() == 2)
 
-#BRANCH TODO tests
+#BRANCH
+def testBranchCycles():
+    # 2 cycles not taken, 3 taken, 4 if the target is on another page than the op-code after the branch
+    memory.setBytes(0x1000, [0xD0, 0x02, 0xF0, 0x7B])
+    memory.setBytes(0x107F, [0xF0, 0x7D])
+    memory.setBytes(0x10FE, [0xF0, 0x10])
+    memory.setBytes(0x1110, [0xF0, 0xDE])
+    memory.setBytes(0x10F0, [0xF0, 0x20])
+    cpu.setFlag("zero", True)
+    assert(cpu.runSingleInstructionCycle() == 2)
+    assert(cpu.getPC() == 0x1002)
+    assert(cpu.runSingleInstructionCycle() == 3)
+    assert(cpu.getPC() == 0x107F)
+    assert(cpu.runSingleInstructionCycle() == 3)
+    assert(cpu.getPC() == 0x10FE)
+    # the operand is on another page than the target, the next op-code isn't
+    assert(cpu.runSingleInstructionCycle() == 3)
+    assert(cpu.getPC() == 0x1110)
+    # backwards and forwards across a page boundary
+    assert(cpu.runSingleInstructionCycle() == 4)
+    assert(cpu.getPC() == 0x10F0)
+    assert(cpu.runSingleInstructionCycle() == 4)
+    assert(cpu.getPC() == 0x1112)
 
 #JMP
 def testJMPDirect():
@@ -31,6 +53,34 @@ def testJMPIndirect():
     assert(cpu.runSingleInstructionCycle() == 2)
     assert(cpu.getPC() == 0x4412)
 
+def testJSRRTS():
+    # JSR $3311, NOP; at $3311: RTS
+    memory.setBytes(0x1000, [0x20, 0x11, 0x33, 0xEA])
+    memory.setByte(0x3311, 0x60)
+    assert(cpu.runSingleInstructionCycle() == 6)
+    assert(cpu.getPC() == 0x3311)
+    assert(cpu.getRegister("SP") == 0xFB)
+    # return address - 1, high byte pushed first
+    assert(memory.getByte(0x01FD) == 0x10 and memory.getByte(0x01FC) == 0x02)
+    assert(cpu.runSingleInstructionCycle() == 6)
+    assert(cpu.getPC() == 0x1003)
+    assert(cpu.getRegister("SP") == 0xFD)
+
+#Transfer
+def testTransfer():
+    # TAX, TAY, TSX, TXA
+    memory.setBytes(0x1000, [0xAA, 0xA8, 0xBA, 0x8A])
+    cpu.a = 0x80
+    assert(cpu.runSingleInstructionCycle() == 2)
+    assert(cpu.getRegister("X") == 0x80)
+    assert(cpu.getFlag("negative"))
+    assert(cpu.runSingleInstructionCycle() == 2)
+    assert(cpu.y == 0x80)
+    assert(cpu.runSingleInstructionCycle() == 2)
+    assert(cpu.x == 0xFD)
+    assert(cpu.runSingleInstructionCycle() == 2)
+    assert(cpu.getRegister("A") == 0xFD)
+
 #TXS
 def testTXS():
     memory.setBytes(0x1000, [0x9A])
@@ -48,11 +98,142 @@ def testCLD():
     assert(cpu.runSingleInstructionCycle() == 2)
     assert(not cpu.getFlag("decimal mode"))
 
+#PHP
+def testPHP():
+    memory.setBytes(0x1000, [0x08])
+    cpu.setFlag("carry", True)
+    cpu.setFlag("negative", True)
+    cpu.setFlag("break command", True)
+    assert(cpu.runSingleInstructionCycle() == 4)
+    assert(memory.getByte(0x01FD) == 0b10000001)
+    assert(cpu.getRegister("SP") == 0xFC)
+
+#PLA / PLP
+def testPull():
+    # PLA, PLP: pull from sp + 1, not from sp
+    memory.setBytes(0x1000, [0x68, 0x28])
+    memory.setBytes(0x01FD, [0x11, 0x80, 0b11000011])
+    assert(cpu.runSingleInstructionCycle() == 4)
+    assert(cpu.getRegister("A") == 0x80)
+    assert(cpu.getFlag("negative"))
+    assert(cpu.getRegister("SP") == 0xFE)
+    assert(cpu.runSingleInstructionCycle() == 4)
+    assert(cpu.getByteFromFlags() == 0b11000011)
+    assert(cpu.getRegister("SP") == 0xFF)
+
+#Flags
+def testFlagsFromByte():
+    cpu.setFlag("break command", True)
+    cpu.setFlagsFromByte(0b11111111)
+    assert(cpu.getFlag("negative") and cpu.getFlag("overflow") and cpu.getFlag("decimal mode"))
+    assert(cpu.getFlag("interrupt disable") and cpu.getFlag("zero") and cpu.getFlag("carry"))
+    assert(cpu.getByteFromFlags() == 0b11001111)
+
+    cpu.setFlagsFromByte(0b00000000)
+    assert(cpu.getFlag("break command"))
+    assert(not cpu.getFlag("carry"))
+    assert(cpu.getByteFromFlags() == 0)
+
+def testLazyZNFlags():
+    # LDA #$00, PHP, LDA #$80, BEQ +0, BMI +0
+    memory.setBytes(0x1000, [0xA9, 0x00, 0x08, 0xA9, 0x80, 0xF0, 0x00, 0x30, 0x00])
+    cpu.p = 0
+    cpu.runSingleInstructionCycle()
+    assert(cpu.getFlag("zero") and not cpu.getFlag("negative"))
+    cpu.runSingleInstructionCycle()
+    assert(memory.getByte(0x01FD) == 0b00000010)
+    cpu.runSingleInstructionCycle()
+    assert(cpu.p == 0b10000000)
+    # Z and N both set, which no result can do
+    cpu.setFlagsFromByte(0b10000011)
+    assert(cpu.getFlag("zero") and cpu.getFlag("negative") and cpu.getFlag("carry"))
+    assert(cpu.getByteFromFlags() == 0b10000011)
+    # both branches are taken
+    assert(cpu.runSingleInstructionCycle() == 3)
+    assert(cpu.runSingleInstructionCycle() == 3)
+
+    cpu.setFlag("zero", False)
+    assert(cpu.p & 0b10000010 == 0b10000000)
+
 #Decrement and Increment TODO tests
 
-#STA TODO tests
+#STX / STY
+def testSTXSTY():
+    # STX $20, STX $20,Y, STX $3000, STY $21, STY $21,X, STY $3001
+    memory.setBytes(0x1000, [0x86, 0x20, 0x96, 0x20, 0x8E, 0x00, 0x30, 0x84, 0x21, 0x94, 0x21, 0x8C, 0x01, 0x30])
+    cpu.setRegister("X", 0x80)
+    cpu.setRegister("Y", 0x22)
+    assert(cpu.runSingleInstructionCycle() == 3)
+    assert(memory.getByte(0x20) == 0x80)
+    assert(cpu.runSingleInstructionCycle() == 4)
+    assert(memory.getByte(0x42) == 0x80)
+    assert(cpu.runSingleInstructionCycle() == 4)
+    assert(memory.getByte(0x3000) == 0x80)
+    assert(cpu.runSingleInstructionCycle() == 3)
+    assert(memory.getByte(0x21) == 0x22)
+    # zero page indexed addresses wrap in the zero page
+    assert(cpu.runSingleInstructionCycle() == 4)
+    assert(memory.getByte(0xA1) == 0x22)
+    assert(cpu.runSingleInstructionCycle() == 4)
+    assert(memory.getByte(0x3001) == 0x22)
+    # stores don't touch the flags
+    assert(cpu.getByteFromFlags() == 0)
+
+#STA
+def testSTAZeroPageX():
+    memory.setBytes(0x1000, [0x95, 0x10, 0x95, 0xF0])
+    cpu.setRegister("A", 0x99)
+    cpu.setRegister("X", 0x20)
+    assert(cpu.runSingleInstructionCycle() == 4)
+    assert(memory.getByte(0x30) == 0x99)
+    assert(cpu.runSingleInstructionCycle() == 4)
+    assert(memory.getByte(0x10) == 0x99)
+    assert(memory.getByte(0x110) == 0)
+    assert(not cpu.getFlag("negative"))
+
+def testIndirectYPointerWrap():
+    # LDA ($FF),Y, STA ($FF),Y: the pointer's high byte comes from $00, not $100
+    memory.setBytes(0x1000, [0xB1, 0xFF, 0x91, 0xFF])
+    memory.setByte(0xFF, 0x00)
+    memory.setByte(0x00, 0x30)
+    memory.setByte(0x100, 0x40)
+    memory.setByte(0x3005, 0x77)
+    cpu.setRegister("Y", 5)
+    assert(cpu.runSingleInstructionCycle() == 5)
+    assert(cpu.getRegister("A") == 0x77)
+    cpu.setRegister("A", 0x12)
+    assert(cpu.runSingleInstructionCycle() == 6)
+    assert(memory.getByte(0x3005) == 0x12)
+    assert(memory.getByte(0x4005) == 0)
+
+#CMP / CPX / CPY
+def testCompare():
+    # CMP #$40, CMP $20, CMP $20,X, CPX #$03, CPX $21, CPY #$3F, CPY $23
+    memory.setBytes(0x1000, [0xC9, 0x40, 0xC5, 0x20, 0xD5, 0x20, 0xE0, 0x03, 0xE4, 0x21, 0xC0, 0x3F, 0xC4, 0x23])
+    memory.setBytes(0x20, [0x41, 0x02, 0x50, 0x40])
+    cpu.setRegister("A", 0x40)
+    cpu.setRegister("X", 0x02)
+    cpu.setRegister("Y", 0x40)
+    def flags(): return (cpu.getFlag("carry"), cpu.getFlag("zero"), cpu.getFlag("negative"))
+
+    assert(cpu.runSingleInstructionCycle() == 2)
+    assert(flags() == (True, True, False))
+    assert(cpu.runSingleInstructionCycle() == 3)
+    assert(flags() == (False, False, True))
+    # indexed by X ($22), not Y ($60)
+    assert(cpu.runSingleInstructionCycle() == 4)
+    assert(flags() == (False, False, True))
+    assert(cpu.runSingleInstructionCycle() == 2)
+    assert(flags() == (False, False, True))
+    assert(cpu.runSingleInstructionCycle() == 3)
+    assert(flags() == (True, True, False))
+    assert(cpu.runSingleInstructionCycle() == 2)
+    assert(flags() == (True, False, False))
+    assert(cpu.runSingleInstructionCycle() == 3)
+    assert(flags() == (True, True, False))
+    # compares leave the registers alone
+    assert((cpu.a, cpu.x, cpu.y) == (0x40, 0x02, 0x40))
 
-#ADC TODO BCD Mode
 def testADCImm():
     # overflow, zero, carry and negative
     memory.setBytes(0x1000, [0x69, 12, 0x69, 128, 0x69, 64, 0x69, 1, 0x69, 0])
@@ -532,7 +713,6 @@ def testADCIndirect():
     cpu.resetFlags()
     cpu.setRegister("Y", 0)
 
-# TODO SBC Tests and BCD Mode
 def testSBCImm():
     # overflow, zero, carry and negative
     memory.setBytes(0x1000, [0xE9, 1, 0xE9, 0x10, 0xE9, 0x00])
@@ -567,6 +747,52 @@ def testSBCImm():
     assert(not cpu.getFlag("overflow"))
     cpu.resetFlags()
 
+def testSBCNoBorrow():
+    # 5 - 0 without borrow keeps the carry set
+    memory.setBytes(0x1000, [0xE9, 0x00])
+    cpu.setFlag("carry", True)
+    cpu.setRegister("A", 5)
+    assert(cpu.runSingleInstructionCycle() == 2)
+    assert(cpu.getRegister("A") == 5)
+    assert(cpu.getFlag("carry"))
+
+# BCD Mode
+def testADCDecimal():
+    memory.setBytes(0x1000, [0x69, 0x01, 0x69, 0x01, 0x69, 0x46])
+    cpu.setFlag("decimal mode", True)
+
+    cpu.setRegister("A", 0x19)
+    assert(cpu.runSingleInstructionCycle() == 2)
+    assert(cpu.getRegister("A") == 0x20)
+    assert(not cpu.getFlag("carry"))
+
+    cpu.setRegister("A", 0x99)
+    assert(cpu.runSingleInstructionCycle() == 2)
+    assert(cpu.getRegister("A") == 0x00)
+    assert(cpu.getFlag("carry"))
+    assert(not cpu.getFlag("zero"))
+
+    cpu.setRegister("A", 0x58)
+    assert(cpu.runSingleInstructionCycle() == 2)
+    assert(cpu.getRegister("A") == 0x05)
+    assert(cpu.getFlag("carry"))
+
+def testSBCDecimal():
+    memory.setBytes(0x1000, [0xE9, 0x12, 0xE9, 0x34])
+    cpu.setFlag("decimal mode", True)
+    cpu.setFlag("carry", True)
+
+    cpu.setRegister("A", 0x46)
+    assert(cpu.runSingleInstructionCycle() == 2)
+    assert(cpu.getRegister("A") == 0x34)
+    assert(cpu.getFlag("carry"))
+
+    cpu.setRegister("A", 0x21)
+    assert(cpu.runSingleInstructionCycle() == 2)
+    assert(cpu.getRegister("A") == 0x87)
+    assert(not cpu.getFlag("carry"))
+    assert(cpu.getFlag("negative"))
+
 
 #LDA
 def testLDAImm():
@@ -773,14 +999,131 @@ def testLDYAbsoluteY():
     assert(cpu.runSingleInstructionCycle() == 5)
     assert(cpu.getRegister("Y") == 0x30) 
 
+# runUntil
+def testRunUntilTrap():
+    # LDX #3, DEX, BNE -3, JMP $1005
+    memory.setBytes(0x1000, [0xA2, 0x03, 0xCA, 0xD0, 0xFD, 0x4C, 0x05, 0x10])
+    result = cpu.runUntil()
+    assert(result.reason == RunResult.STOP_TRAP)
+    assert(result.pc == 0x1005)
+    assert(result.instructions == 8)
+    assert(result.cycles == 2 + 3 * 2 + 2 * 3 + 2 + 3)
+    assert(cpu.getRegister("X") == 0)
+
+def testRunUntilStops():
+    # NOP, NOP, NOP, BRK
+    memory.setBytes(0x1000, [0xEA, 0xEA, 0xEA, 0x00])
+    result = cpu.runUntil(StopCondition(breakpoints=[0x1002]))
+    assert(result.reason == RunResult.STOP_BREAKPOINT)
+    assert((result.pc, result.instructions, result.cycles) == (0x1002, 2, 4))
+
+    cpu.setPC(0x1000)
+    result = cpu.runUntil(maxInstructions=1)
+    assert(result.reason == RunResult.STOP_MAX_INSTRUCTIONS)
+    assert(result.pc == 0x1001)
+
+    result = cpu.runUntil(maxCycles=3)
+    assert(result.reason == RunResult.STOP_MAX_CYCLES)
+    assert(result.pc == 0x1003)
+
+    result = cpu.runUntil()
+    assert(result.reason == RunResult.STOP_BRK)
+    assert(result.instructions == 0)
+
+    result = cpu.runUntil(StopCondition(brk=False))
+    assert(result.reason == RunResult.STOP_UNIMPLEMENTED)
+    assert(result.pc == 0x1003)
+
+def testDecodeInstruction():
+    # LDA #$42, LDA $1234, NOP, ASL A (not implemented yet)
+    memory.setBytes(0x1000, [0xA9, 0x42, 0xAD, 0x34, 0x12, 0xEA, 0x0A])
+    assert(cpu.decodeInstruction() == 0x42)
+    assert((cpu.currentInstruction, cpu.getPC()) == (0xA9, 0x1002))
+    assert(cpu.decodeInstruction() == 0x1234)
+    assert(cpu.getPC() == 0x1005)
+    assert(cpu.decodeInstruction() == 0)
+    assert(cpu.getPC() == 0x1006)
+
+    cpu.setPC(0x1005)
+    cpu.runSingleInstructionCycle()
+    try:
+        cpu.runSingleInstructionCycle()
+        assert(False)
+    except UnimplementedInstruction as error:
+        assert(error.opcode == 0x0A)
+    # PC is left at the op-code
+    assert(cpu.getPC() == 0x1006)
+
+# release mode
+def testUnchecked():
+    uncheckedMemory = Memory(checked=False)
+    uncheckedCpu = CPU(uncheckedMemory, checked=False)
+    uncheckedCpu.reset()
+    uncheckedMemory.setBytes(0x1000, [0xA2, 0x80, 0xEA, 0x69, 0x01])
+    assert(uncheckedCpu.runSingleInstructionCycle() == 2)
+    assert(uncheckedCpu.getRegister("X") == 0x80)
+    assert(uncheckedCpu.getFlag("negative"))
+    uncheckedCpu.runSingleInstructionCycle()
+    uncheckedCpu.setFlag("carry", True)
+    assert(uncheckedCpu.runSingleInstructionCycle() == 2)
+    assert(uncheckedCpu.getRegister("A") == 2)
+    assert(uncheckedCpu.getPC() == 0x1005)
+
+def testSnapshotRestore():
+    # LDA #5, LDX #3, loop: STA $20, DEX, BNE loop
+    memory.setBytes(0x1000, [0xA9, 0x05, 0xA2, 0x03, 0x85, 0x20, 0xCA, 0xD0, 0xFB])
+    cpu.runSingleInstructionCycle()
+    cpu.runSingleInstructionCycle()
+    snapshot = cpu.snapshot()
+
+    for i in range(2):
+        cpu.runUntil(maxInstructions=10)
+        assert(cpu.getPC() == 0x1009)
+        assert(cpu.getRegister("X") == 0)
+        assert(cpu.getFlag("zero"))
+        assert(memory.getByte(0x20) == 5)
+
+        cpu.restore(snapshot)
+        assert(cpu.getPC() == 0x1004)
+        assert(cpu.getRegister("X") == 3)
+        assert(not cpu.getFlag("zero"))
+        assert(memory.getByte(0x20) == 0)
+
+def testFork():
+    # LDA #5, STA $20, JMP $1004
+    memory.setBytes(0x1000, [0xA9, 0x05, 0x85, 0x20, 0x4C, 0x04, 0x10])
+    cpu.runSingleInstructionCycle()
+    fork = cpu.fork()
+    assert(fork.getRegister("A") == 5)
+    assert(fork.getPC() == 0x1002)
+
+    fork.runUntil()
+    assert(fork.getPC() == 0x1004)
+    assert(fork._memory.getByte(0x20) == 5)
+    assert(cpu.getPC() == 0x1002)
+    assert(memory.getByte(0x20) == 0)
+
 tests = [
     testNOP,
 
+    testBranchCycles,
+
     testJMPDirect,
     testJMPIndirect,
+    testJSRRTS,
 
+    testTransfer,
     testTXS,
     testCLD,
+    testPHP,
+    testPull,
+    testFlagsFromByte,
+    testLazyZNFlags,
+
+    testSTXSTY,
+    testSTAZeroPageX,
+    testIndirectYPointerWrap,
+    testCompare,
 
     testADCImm,
     testADCZeroPage,
@@ -799,6 +1142,9 @@ tests = [
     testLDAIndirectY,
 
     testSBCImm,
+    testSBCNoBorrow,
+    testADCDecimal,
+    testSBCDecimal,
 
     testLDXImm,
     testLDXZeroPage,
@@ -810,7 +1156,15 @@ tests = [
     testLDYZeroPage,
     testLDYZeroPageY,
     testLDYAbsolute,
-    testLDYAbsoluteY
+    testLDYAbsoluteY,
+
+    testRunUntilTrap,
+    testRunUntilStops,
+    testDecodeInstruction,
+
+    testUnchecked,
+    testSnapshotRestore,
+    testFork
 ]
 
 def testAll():
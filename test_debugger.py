@@ -0,0 +1,93 @@
+from cpu import CPU, RunResult
+from debugger import Debugger
+from memory import Memory
+
+# LDX #$10, loop: TXA, STA $30, DEX, BNE loop, LDA $40, JMP *
+loopProgram = [0xA2, 0x10, 0x8A, 0x85, 0x30, 0xCA, 0xD0, 0xFA, 0xA5, 0x40, 0x4C, 0x0A, 0x10]
+
+def makeDebugger(useBlockCache=False):
+    memory = Memory()
+    cpu = CPU(memory, useBlockCache=useBlockCache)
+    cpu.reset()
+    memory.setBytes(0x1000, loopProgram)
+    return cpu, Debugger(cpu)
+
+def testBreakpoint():
+    for useBlockCache in (False, True):
+        cpu, debugger = makeDebugger(useBlockCache)
+        breakpoint = debugger.addBreakpoint(0x1005)
+        result = debugger.run()
+        assert(result.reason == RunResult.STOP_BREAKPOINT and result.pc == 0x1005)
+        assert(debugger.hit is breakpoint and cpu.x == 0x10)
+        # continuing executes the instruction at the breakpoint first
+        result = debugger.run()
+        assert(result.pc == 0x1005 and cpu.x == 0x0F)
+        assert(breakpoint.hits == 2)
+
+        debugger.removeBreakpoint(breakpoint)
+        result = debugger.run()
+        assert(result.reason == RunResult.STOP_TRAP and result.pc == 0x100A)
+        assert(debugger.hit is None)
+
+def testConditionalBreakpoint():
+    for useBlockCache in (False, True):
+        cpu, debugger = makeDebugger(useBlockCache)
+        breakpoint = debugger.addBreakpoint(0x1005, condition=lambda cpu: cpu.x == 3)
+        result = debugger.run()
+        assert(result.reason == RunResult.STOP_BREAKPOINT and cpu.x == 3)
+        assert(breakpoint.hits == 1)
+        # 13 loop iterations: 2 instructions before the loop, 4 per iteration
+        assert(result.instructions == 1 + 4 * 13 + 2)
+
+        cpu, debugger = makeDebugger(useBlockCache)
+        debugger.addBreakpoint(0x1005, ignoreCount=2)
+        debugger.run()
+        assert(cpu.x == 0x0E)
+
+def testWriteWatchpoint():
+    for useBlockCache in (False, True):
+        cpu, debugger = makeDebugger(useBlockCache)
+        watchpoint = debugger.addWatchpoint(0x30, condition=lambda cpu, addr, val: val == 5)
+        result = debugger.run()
+        # stops after the STA
+        assert(result.reason == RunResult.STOP_BREAKPOINT and result.pc == 0x1005)
+        assert(debugger.hit is watchpoint)
+        assert(watchpoint.lastAddr == 0x30 and watchpoint.lastVal == 5)
+        assert(cpu._memory.getByte(0x30) == 5)
+
+        debugger.removeWatchpoint(watchpoint)
+        assert(debugger.run().reason == RunResult.STOP_TRAP)
+
+def testReadWatchpoint():
+    for useBlockCache in (False, True):
+        cpu, debugger = makeDebugger(useBlockCache)
+        # code pages aren't hit by op-code and operand fetches
+        debugger.addWatchpoint(0x1000, 0x100, read=True, write=False)
+        watchpoint = debugger.addWatchpoint(0x40, read=True, write=False)
+        result = debugger.run()
+        assert(result.reason == RunResult.STOP_BREAKPOINT and result.pc == 0x100A)
+        assert(debugger.hit is watchpoint and watchpoint.hits == 1)
+
+def testBudgets():
+    cpu, debugger = makeDebugger()
+    debugger.addBreakpoint(0x1005, condition=lambda cpu: False)
+    result = debugger.run(maxInstructions=10)
+    assert(result.reason == RunResult.STOP_MAX_INSTRUCTIONS and result.instructions == 10)
+    result = debugger.run(maxCycles=20)
+    assert(result.reason == RunResult.STOP_MAX_CYCLES and result.cycles >= 20)
+
+tests = [
+    testBreakpoint,
+    testConditionalBreakpoint,
+    testWriteWatchpoint,
+    testReadWatchpoint,
+    testBudgets
+]
+
+def testAll():
+    for test in tests:
+        test()
+        print("test passed: " + test.__name__)
+
+if __name__ == "__main__":
+    testAll()
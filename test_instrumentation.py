@@ -0,0 +1,77 @@
+from cpu import CPU, RunResult, StopCondition
+from memory import Memory
+
+# LDX #3, loop: DEX, BNE loop, JMP $1005
+loopProgram = [0xA2, 0x03, 0xCA, 0xD0, 0xFD, 0x4C, 0x05, 0x10]
+
+def makeCpu(useBlockCache=False):
+    memory = Memory()
+    cpu = CPU(memory, useBlockCache=useBlockCache)
+    cpu.reset()
+    memory.setBytes(0x1000, loopProgram)
+    return cpu
+
+def testCountsAndCycles():
+    for useBlockCache in (False, True):
+        cpu = makeCpu(useBlockCache)
+        histogram = cpu.enableInstrumentation()
+        result = cpu.runUntil(StopCondition())
+        assert(result.reason == RunResult.STOP_TRAP)
+        assert(histogram.counts[0xA2] == 1 and histogram.cycles[0xA2] == 2)
+        assert(histogram.counts[0xCA] == 3 and histogram.cycles[0xCA] == 6)
+        assert(histogram.counts[0xD0] == 3)
+        assert(histogram.counts[0x4C] == 1 and histogram.cycles[0x4C] == 3)
+        assert(sum(histogram.counts) == result.instructions)
+        assert(sum(histogram.cycles) == result.cycles)
+
+def testReportSortedByCycles():
+    cpu = makeCpu()
+    histogram = cpu.enableInstrumentation()
+    cpu.runUntil(StopCondition())
+    rows = histogram.report()
+    assert(all(rows[i][2] >= rows[i + 1][2] for i in range(len(rows) - 1)))
+    assert(abs(sum(row[3] for row in rows) - 1.0) < 1e-9)
+    assert("CA" in str(histogram))
+
+def testDisable():
+    cpu = makeCpu(useBlockCache=True)
+    histogram = cpu.enableInstrumentation()
+    assert(cpu.enableInstrumentation() is histogram)
+    assert(cpu.disableInstrumentation() is histogram)
+    assert(cpu.disableInstrumentation() is None)
+    cpu.runUntil(StopCondition())
+    assert(sum(histogram.counts) == 0)
+
+def testPairCounts():
+    cpu = makeCpu(useBlockCache=True)
+    histogram = cpu.enableInstrumentation()
+    result = cpu.runUntil(StopCondition())
+    assert(histogram.pairs[0xA2 << 8 | 0xCA] == 1)
+    assert(histogram.pairs[0xCA << 8 | 0xD0] == 3)
+    assert(histogram.pairs[0xD0 << 8 | 0xCA] == 2)
+    assert(sum(histogram.pairs) == result.instructions - 1)
+    assert(histogram.pairReport(1) == [(0xCA, 0xD0, 3)])
+    # a branch can't be the first op-code of a fused pair
+    assert(histogram.fusionCandidates() == [(0xCA, 0xD0), (0xA2, 0xCA)])
+    histogram.clear()
+    assert(sum(histogram.pairs) == 0)
+    # the instrumented handlers go on counting into the cleared histogram
+    cpu.setPC(0x1000)
+    cpu.runUntil(StopCondition())
+    assert(histogram.pairs[0xCA << 8 | 0xD0] == 3)
+    assert(histogram.pairReport(1) == [(0xCA, 0xD0, 3)])
+
+tests = [
+    testCountsAndCycles,
+    testReportSortedByCycles,
+    testDisable,
+    testPairCounts
+]
+
+def testAll():
+    for test in tests:
+        test()
+        print("test passed: " + test.__name__)
+
+if __name__ == "__main__":
+    testAll()
@@ -0,0 +1,78 @@
+import os
+import tempfile
+
+from loader import load, loadBinary, parseIntelHex, parseSRecord, ImageFormatError
+from memory import Memory
+
+DIR = os.path.dirname(os.path.abspath(__file__))
+
+def writeTemp(name, content):
+    path = os.path.join(tempfile.mkdtemp(), name)
+    with open(path, "wb" if type(content) == bytes else "w") as file:
+        file.write(content)
+    return path
+
+def testLoadBinary():
+    path = writeTemp("program.bin", bytes([0xA9, 0x01, 0x4C, 0x00, 0x10]))
+    for useMmap in (False, True):
+        memory = Memory()
+        assert(loadBinary(memory, path, 0x1000, useMmap) == (0x1000, 0x1005))
+        assert(memory.getBytes(0x1000, 5) == bytes([0xA9, 0x01, 0x4C, 0x00, 0x10]))
+
+    # 64 KiB images like the functional test fill the whole address space
+    functionalTest = os.path.join(DIR, "testProgram", "6502_functional_test.bin")
+    memory = Memory(checked=False)
+    load(memory, functionalTest, useMmap=True)
+    with open(functionalTest, "rb") as file:
+        assert(memory.getBytes(0, 65536) == file.read())
+
+def testIntelHex():
+    path = writeTemp("program.hex", "\n".join([
+        ":03100000A9014CF7",
+        ":02100300001DCE",
+        ":0400000500001000E7",
+        ":00000001FF"
+    ]))
+    image = parseIntelHex(path)
+    assert(image.entry == 0x1000)
+    assert(len(image.segments) == 1)
+
+    memory = Memory()
+    load(memory, path)
+    assert(memory.getBytes(0x1000, 5) == bytes([0xA9, 0x01, 0x4C, 0x00, 0x1D]))
+
+def testSRecord():
+    path = writeTemp("program.s19", "\n".join([
+        "S00600004844521B",
+        "S1081000A9014C0010E1",
+        "S9031000EC"
+    ]))
+    image = parseSRecord(path)
+    assert(image.entry == 0x1000)
+
+    memory = Memory()
+    load(memory, path)
+    assert(memory.getBytes(0x1000, 5) == bytes([0xA9, 0x01, 0x4C, 0x00, 0x10]))
+
+def testBadChecksum():
+    for name, content in (("bad.hex", ":03100000A9014CBE"), ("bad.s19", "S1081000A9014C00109E")):
+        try:
+            load(Memory(), writeTemp(name, content))
+            assert(False)
+        except ImageFormatError as error:
+            assert(error.lineNumber == 1)
+
+tests = [
+    testLoadBinary,
+    testIntelHex,
+    testSRecord,
+    testBadChecksum
+]
+
+def testAll():
+    for test in tests:
+        test()
+        print("test passed: " + test.__name__)
+
+if __name__ == "__main__":
+    testAll()
@@ -0,0 +1,116 @@
+from memory import Memory
+
+def testSetGetBytes():
+    memory = Memory()
+    memory.setBytes(0x1FFE, [1, 2, 3, 4])
+    assert(memory.getBytes(0x1FFE, 4) == bytes([1, 2, 3, 4]))
+    assert(memory.getByte(0x2001) == 4)
+
+    memory.setBytes(0xFFFE, b"\x22\x33")
+    assert(memory.getBytes(0xFFFD, 3) == bytes([0x10, 0x22, 0x33]))
+
+def testFill():
+    memory = Memory()
+    memory.fill(0x0200, 0x100, 0xEA)
+    assert(memory.getBytes(0x01FF, 2) == bytes([0x00, 0xEA]))
+    assert(memory.getBytes(0x02FF, 2) == bytes([0xEA, 0x00]))
+
+def testResetMemory():
+    memory = Memory()
+    memory.fill(0, 65536, 0xFF)
+    memory.resetMemory()
+    assert(memory.getBytes(0, 4) == bytes(4))
+    assert(memory.getBytes(0xFFFC, 2) == bytes([0x00, 0x10]))
+
+def testCheckedRange():
+    memory = Memory()
+    try:
+        memory.setBytes(0xFFFF, [1, 2])
+        assert(False)
+    except AssertionError as e:
+        assert(str(e) == "")
+
+    # unchecked memory still can't grow past 64 KiB
+    memory = Memory(checked=False)
+    try:
+        memory.setBytes(0xFFFF, [1, 2])
+        assert(False)
+    except BufferError:
+        pass
+
+def testSnapshotRestore():
+    memory = Memory()
+    notified = []
+    memory.addBulkWriteHook(lambda addrStart, addrEnd: notified.append((addrStart, addrEnd)))
+    image = memory.snapshot()
+    memory.setByte(0x1234, 0x56)
+
+    memory.restore(image)
+    assert(memory.getByte(0x1234) == 0)
+    assert(notified == [(0, 65536)])
+    # restoring unchanged memory doesn't notify
+    memory.restore(image)
+    assert(len(notified) == 1)
+
+def testForkCopyOnWrite():
+    memory = Memory()
+    memory.setBytes(0x1000, [1, 2, 3])
+    fork = memory.fork()
+    assert(fork.getBytes(0x1000, 3) == bytes([1, 2, 3]))
+
+    fork.setByte(0x1001, 9)
+    memory.setByte(0x1002, 8)
+    assert(fork.getBytes(0x1000, 3) == bytes([1, 9, 3]))
+    assert(memory.getBytes(0x1000, 3) == bytes([1, 2, 8]))
+    assert(fork.dirtyPages() == [0x10])
+
+    # forks of a fork share pages until they are written
+    child = fork.fork()
+    assert(child._pages[0x10] is fork._pages[0x10])
+    child.setBytes(0x10FF, [7, 7])
+    assert(child.dirtyPages() == [0x10, 0x11])
+    assert(fork.getBytes(0x10FF, 2) == bytes(2))
+    fork.setByte(0x1000, 4)
+    assert(child.getByte(0x1000) == 1)
+    assert(child.snapshot()[0x1000:0x1003] == bytes([1, 9, 3]))
+    # ranges spanning several pages, and the end of memory
+    child.setBytes(0xFFFE, [5, 6])
+    assert(child.getBytes(0x10FE, 0x203) == child.snapshot()[0x10FE:0x1301])
+    assert(child.getBytes(0xFFFE, 2) == bytes([5, 6]))
+    assert(child.getBytes(0x2000, 0) == b"")
+
+def testReadHooks():
+    for memory in (Memory(), Memory().fork()):
+        reads = []
+        hook = lambda addr, val: reads.append((addr, val))
+        memory.setByte(0x1234, 0x56)
+        memory.addReadHook(0x12, hook)
+        assert(memory.getByte(0x1234) == 0x56)
+        assert(memory.getByte(0x1334) == 0)
+        assert(reads == [(0x1234, 0x56)])
+        # op-code and operand fetches aren't reads
+        assert(memory.fetchByte(0x1234) == 0x56)
+        assert(len(reads) == 1)
+
+        memory.removeReadHook(0x12, hook)
+        assert("getByte" not in memory.__dict__)
+        memory.getByte(0x1234)
+        assert(len(reads) == 1)
+
+tests = [
+    testSetGetBytes,
+    testFill,
+    testResetMemory,
+    testCheckedRange,
+    testSnapshotRestore,
+    testForkCopyOnWrite,
+    testReadHooks
+]
+
+def testAll():
+    for test in tests:
+        test()
+        print("test passed: " + test.__name__)
+
+if __name__ == "__main__":
+    testAll()
@@ -0,0 +1,102 @@
+import contextlib
+import io
+import os
+import tempfile
+
+from cpu import CPU, RunResult, StopCondition
+from memory import Memory
+from profiler import Profiler, SymbolTable, main
+
+# main:  JSR outer, JSR inner, JMP main
+# outer: JSR inner, RTS
+# inner: LDX #$20, loop: DEX, BNE loop, RTS
+program = {
+    0x1000: [0x20, 0x00, 0x11, 0x20, 0x00, 0x12, 0x4C, 0x00, 0x10],
+    0x1100: [0x20, 0x00, 0x12, 0x60],
+    0x1200: [0xA2, 0x20, 0xCA, 0xD0, 0xFD, 0x60]
+}
+labels = """al C:1000 .main
+al C:1100 .outer
+al 001200 .inner
+al 001202 .inner_loop
+"""
+runEverything = StopCondition(trap=False, brk=False)
+
+def makeCpu(useBlockCache=False):
+    memory = Memory()
+    cpu = CPU(memory, useBlockCache=useBlockCache)
+    cpu.reset()
+    for addr, code in program.items(): memory.setBytes(addr, code)
+    return cpu
+
+def makeSymbols():
+    path = os.path.join(tempfile.mkdtemp(), "labels.txt")
+    with open(path, "w") as file: file.write(labels)
+    return SymbolTable.fromFile(path)
+
+def testSymbolLookup():
+    symbols = makeSymbols()
+    assert(len(symbols) == 4)
+    assert(symbols.lookup(0x1000) == "main")
+    assert(symbols.lookup(0x10FF) == "main")
+    assert(symbols.lookup(0x1203) == "inner_loop")
+    assert(symbols.lookup(0x0FFF) == "$0FFF")
+    assignments = SymbolTable([(0x2000, "first"), (0x2000, "second")])
+    assert(assignments.lookup(0x2001) == "first")
+
+def testSampleEveryN():
+    for useBlockCache in (False, True):
+        cpu = makeCpu(useBlockCache)
+        symbols = SymbolTable([(0x1000, "main"), (0x1100, "outer"), (0x1200, "inner")])
+        profiler = Profiler(cpu, symbols, every=7)
+        cpu._optimizeDecodeLut()
+        plainLut = cpu._decodeFunctionLookupTable
+        result = profiler.run(runEverything, maxInstructions=7000)
+        assert(result.reason == RunResult.STOP_MAX_INSTRUCTIONS)
+        assert(result.instructions >= 7000)
+        assert(profiler.sampleCount() >= 7000 // 20)
+
+        flat = profiler.flatProfile()
+        assert(flat[0][0] == "inner")
+        total = {symbol: total for symbol, selfCount, share, total in flat}
+        assert(total["outer"] > 0 and total["inner"] >= total["outer"])
+
+        stacks = dict(line.rsplit(" ", 1) for line in profiler.collapsedStacks())
+        assert("outer;inner" in stacks and "inner" in stacks)
+        assert(sum(int(count) for count in stacks.values()) == profiler.sampleCount())
+        # the call tracking handlers are gone after the run
+        assert(cpu._decodeFunctionLookupTable is plainLut)
+
+def testSampleOnInterval():
+    cpu = makeCpu()
+    profiler = Profiler(cpu, makeSymbols(), every=None, interval=0.0005)
+    result = profiler.run(runEverything, maxInstructions=100000)
+    assert(result.instructions == 100000)
+    assert(profiler.sampleCount() > 0)
+    assert("inner_loop" in profiler.formatFlatProfile())
+
+def testMainStartsAtResetVector():
+    # a raw 64 KiB image whose reset vector points at JMP $2000; $1000 holds a BRK
+    image = bytearray(65536)
+    image[0x2000:0x2003] = [0x4C, 0x00, 0x20]
+    image[0xFFFC:0xFFFE] = [0x00, 0x20]
+    path = os.path.join(tempfile.mkdtemp(), "image.bin")
+    with open(path, "wb") as file: file.write(image)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output): assert(main([path]) == 0)
+    assert("stopped (trap) at 0x2000" in output.getvalue())
+
+tests = [
+    testSymbolLookup,
+    testSampleEveryN,
+    testSampleOnInterval,
+    testMainStartsAtResetVector
+]
+
+def testAll():
+    for test in tests:
+        test()
+        print("test passed: " + test.__name__)
+
+if __name__ == "__main__":
+    testAll()
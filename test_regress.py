@@ -0,0 +1,82 @@
+import json
+import os
+import tempfile
+
+import regress
+from regress import loadManifest, runJob, runJobs
+
+def writeManifest(jobs, images):
+    directory = tempfile.mkdtemp()
+    for name, data in images.items():
+        with open(os.path.join(directory, name), "wb") as file: file.write(bytes(data))
+    path = os.path.join(directory, "manifest.json")
+    with open(path, "w") as file: json.dump({"jobs": jobs}, file)
+    return path
+
+images = {
+    # LDA #$42, STA $20, JMP $1004
+    "pass.bin": [0xA9, 0x42, 0x85, 0x20, 0x4C, 0x04, 0x10],
+    # LDA #$42, JMP $1002 (never stores)
+    "fail.bin": [0xA9, 0x42, 0x4C, 0x02, 0x10],
+    # NOP, unimplemented
+    "unimplemented.bin": [0xEA, 0x02],
+}
+
+def testManifest():
+    path = writeManifest([
+        {"name": "pass", "image": "pass.bin", "base": "0x1000", "success": {"pc": "0x1004", "memory": {"0x20": "0x42"}}},
+        {"name": "fail", "image": "fail.bin", "base": 4096, "success": {"memory": {"0x20": 66}}},
+    ], images)
+    jobs = loadManifest(path)
+    assert(jobs[0].base == 0x1000 and jobs[0].successPC == 0x1004 and jobs[0].successMemory == {0x20: 0x42})
+    assert(os.path.isabs(jobs[1].image))
+
+    # one worker machine is reused, nothing leaks from the previous job
+    assert(runJob(jobs[0]).passed)
+    result = runJob(jobs[1])
+    assert(not result.passed)
+    assert(result.reason == "trap" and result.pc == 0x1002)
+
+def testInterruptsDontLeak():
+    path = writeManifest([
+        {"name": "pass", "image": "pass.bin", "base": "0x1000", "success": {"pc": "0x1004", "memory": {"0x20": "0x42"}}},
+    ], images)
+    job = loadManifest(path)[0]
+    assert(runJob(job).passed)
+    # a job that leaves the IRQ line asserted, an NMI pending and an event scheduled on the worker
+    cpu = regress.workerMachine[0]
+    cpu.assertIRQ("device")
+    cpu.nmi()
+    cpu.scheduler.after(20, lambda cycle: cpu.nmi())
+    result = runJob(job)
+    assert(result.passed and result.instructions == 3)
+    assert(len(cpu.scheduler) == 0)
+
+def testRunJobs():
+    path = writeManifest([
+        {"name": "pass " + str(i), "image": "pass.bin", "base": "0x1000", "success": {"pc": "0x1004"}} for i in range(6)
+    ] + [
+        {"name": "unimplemented", "image": "unimplemented.bin", "base": "0x1000", "success": {"reason": "unimplemented", "pc": "0x1001"}},
+        {"name": "missing", "image": "missing.bin"},
+    ], images)
+    summary = runJobs(loadManifest(path), workers=2)
+    assert(summary.passed == 7)
+    assert(summary.failed == 1)
+    assert([result.name for result in summary.results][-2:] == ["unimplemented", "missing"])
+    assert(summary.results[-1].error is not None)
+    assert(summary.cycles == 6 * 8 + 2)
+    json.dumps(summary.toJSON())
+
+tests = [
+    testManifest,
+    testInterruptsDontLeak,
+    testRunJobs
+]
+
+def testAll():
+    for test in tests:
+        test()
+        print("test passed: " + test.__name__)
+
+if __name__ == "__main__":
+    testAll()
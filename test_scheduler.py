@@ -0,0 +1,141 @@
+from cpu import CPU, StopCondition, RunResult
+from memory import Memory
+from scheduler import Scheduler, never
+
+def testOrder():
+    now = [0]
+    scheduler = Scheduler(lambda: now[0])
+    fired = []
+    scheduler.at(30, lambda cycle: fired.append(("c", cycle)))
+    scheduler.at(10, lambda cycle: fired.append(("a", cycle)))
+    scheduler.at(10, lambda cycle: fired.append(("b", cycle)))
+    assert(scheduler.nextCycle == 10 and len(scheduler) == 3)
+
+    assert(scheduler.runDue(9) == 0)
+    now[0] = 15
+    assert(scheduler.runDue() == 2)
+    # same cycle: in the order they were scheduled
+    assert(fired == [("a", 10), ("b", 10)])
+    assert(scheduler.nextCycle == 30)
+
+    scheduler.after(5, lambda cycle: fired.append(("d", cycle)))
+    assert(scheduler.nextCycle == 20)
+    scheduler.runDue(100)
+    assert(fired[2:] == [("d", 20), ("c", 30)])
+    assert(scheduler.nextCycle == never and len(scheduler) == 0)
+
+def testCancel():
+    scheduler = Scheduler(lambda: 0)
+    fired = []
+    first = scheduler.at(10, fired.append)
+    second = scheduler.at(20, fired.append)
+    scheduler.cancel(first)
+    assert(not first.pending() and second.pending())
+    assert(scheduler.nextCycle == 20 and len(scheduler) == 1)
+    scheduler.runDue(30)
+    assert(fired == [20])
+
+    scheduler.at(40, fired.append)
+    scheduler.clear()
+    assert(scheduler.runDue(50) == 0 and scheduler.nextCycle == never)
+
+def makeMachine(useBlockCache):
+    memory = Memory()
+    cpu = CPU(memory, useBlockCache=useBlockCache)
+    cpu.reset()
+    # CLI, loop: JMP loop
+    memory.setBytes(0x1000, [0x58, 0x4C, 0x01, 0x10])
+    # IRQ: INC $40, STA $D000 (acknowledge), RTI
+    memory.setBytes(0x2000, [0xE6, 0x40, 0x8D, 0x00, 0xD0, 0x40])
+    # NMI: INC $41, RTI
+    memory.setBytes(0x2100, [0xE6, 0x41, 0x40])
+    memory.setBytes(0xFFFA, [0x00, 0x21])
+    memory.setBytes(0xFFFE, [0x00, 0x20])
+    return cpu, memory
+
+def testTimerIRQ():
+    for useBlockCache in (False, True):
+        cpu, memory = makeMachine(useBlockCache)
+        timer = "timer"
+        ticks = []
+        def tick(cycle):
+            ticks.append(cycle)
+            cpu.assertIRQ(timer)
+            cpu.scheduler.at(cycle + 100, tick)
+        cpu.scheduler.after(100, tick)
+        memory.addWriteHook(0xD0, lambda addr, val: cpu.releaseIRQ(timer))
+
+        result = cpu.runUntil(StopCondition(trap=False), maxCycles=1000)
+        assert(result.reason == RunResult.STOP_MAX_CYCLES)
+        assert(ticks == [cycle for cycle in range(108, 1008, 100)])
+        # every tick was taken and acknowledged, and the handlers returned to the loop
+        assert(memory.getByte(0x40) == len(ticks))
+        assert(cpu.pc == 0x1001 and cpu.sp == 0xFD)
+        assert(not cpu.getFlag("interrupt disable"))
+
+def testMaskedIRQAndNMI():
+    for useBlockCache in (False, True):
+        cpu, memory = makeMachine(useBlockCache)
+        # SEI instead of CLI
+        memory.setByte(0x1000, 0x78)
+        cpu.scheduler.at(50, lambda cycle: cpu.assertIRQ())
+        cpu.scheduler.at(60, lambda cycle: cpu.nmi())
+        cpu.runUntil(StopCondition(trap=False), maxCycles=200)
+        assert(memory.getByte(0x40) == 0)
+        assert(memory.getByte(0x41) == 1)
+        assert(cpu.getFlag("interrupt disable"))
+
+        # CLI lets the still asserted IRQ through: the second instruction is the handler's INC
+        cpu.setPC(0x1000)
+        memory.setByte(0x1000, 0x58)
+        cpu.runUntil(StopCondition(trap=False), maxInstructions=2)
+        assert(memory.getByte(0x40) == 1)
+
+def runTimerScenario(cpu, memory, condition, maxCycles):
+    def tick(cycle):
+        cpu.assertIRQ("timer")
+        cpu.scheduler.at(cycle + 1000, tick)
+    cpu.scheduler.after(1000, tick)
+    memory.addWriteHook(0xD0, lambda addr, val: cpu.releaseIRQ("timer"))
+    result = cpu.runUntil(condition, maxCycles=maxCycles)
+    return (result.reason, result.pc, result.instructions, result.cycles, cpu.a, cpu.sp, cpu.p, memory.snapshot())
+
+def testIdleFastForward():
+    for useBlockCache in (False, True):
+        # instrumentation disables fast-forwarding, which must not change anything but the speed
+        cpu, memory = makeMachine(useBlockCache)
+        cpu.enableInstrumentation()
+        emulated = runTimerScenario(cpu, memory, StopCondition(trap=False), 10500)
+        cpu, memory = makeMachine(useBlockCache)
+        assert(runTimerScenario(cpu, memory, StopCondition(trap=False), 10500) == emulated)
+        # iterations of JMP * (3 cycles) were skipped
+        assert(cpu._idleIteration == (3, 1))
+        assert(memory.getByte(0x40) == 10)
+
+    # CLI, loop: LDA $40, CMP #3, BNE loop, JMP *: a poll loop, fast-forwarded with the block cache
+    program = [0x58, 0xA5, 0x40, 0xC9, 0x03, 0xD0, 0xFA, 0x4C, 0x07, 0x10]
+    cpu, memory = makeMachine(True)
+    memory.setBytes(0x1000, program)
+    result = runTimerScenario(cpu, memory, StopCondition(trap=True), None)
+    assert(result[:2] == (RunResult.STOP_TRAP, 0x1007))
+    assert(cpu._idleIteration == (8, 3))
+    cpu, memory = makeMachine(True)
+    memory.setBytes(0x1000, program)
+    cpu.enableInstrumentation()
+    assert(runTimerScenario(cpu, memory, StopCondition(trap=True), None) == result)
+
+tests = [
+    testOrder,
+    testCancel,
+    testTimerIRQ,
+    testMaskedIRQAndNMI,
+    testIdleFastForward
+]
+
+def testAll():
+    for test in tests:
+        test()
+        print("test passed: " + test.__name__)
+
+if __name__ == "__main__":
+    testAll()
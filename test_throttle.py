@@ -0,0 +1,66 @@
+import time
+
+from cpu import CPU, RunResult
+from memory import Memory
+from throttle import Throttle
+
+# loop: DEX, BNE loop, JMP loop (5 cycles per iteration)
+loopProgram = [0xCA, 0xD0, 0xFD, 0x4C, 0x00, 0x10]
+
+def makeCpu():
+    memory = Memory(checked=False)
+    cpu = CPU(memory, checked=False)
+    cpu.reset()
+    memory.setBytes(0x1000, loopProgram)
+    return cpu
+
+def testThrottled():
+    cpu = makeCpu()
+    throttle = Throttle(cpu, clockHz=200000)
+    beginTime = time.perf_counter()
+    result = throttle.run(maxCycles=20000)
+    wallTime = time.perf_counter() - beginTime
+
+    assert(result.reason == RunResult.STOP_MAX_CYCLES)
+    assert(result.cycles >= 20000)
+    # 20000 cycles at 200 kHz take 0.1s
+    assert(wallTime >= 0.095)
+    assert(throttle.stats.samples > 0)
+    assert(throttle.stats.sleeps > 0)
+
+def testUnthrottled():
+    cpu = makeCpu()
+    throttle = Throttle(cpu, clockHz=None)
+    result = throttle.run(maxCycles=20000)
+    assert(result.reason == RunResult.STOP_MAX_CYCLES)
+    assert(throttle.stats.sleeps == 0)
+
+def testMaxSeconds():
+    cpu = makeCpu()
+    throttle = Throttle(cpu, clockHz=1000)
+    result = throttle.run(maxSeconds=0.02)
+    assert(result.reason == RunResult.STOP_MAX_TIME)
+    # 1 kHz for 20ms is about 20 cycles
+    assert(result.cycles < 100)
+
+def testStopCondition():
+    cpu = makeCpu()
+    cpu._memory.setBytes(0x1000, [0xEA, 0x4C, 0x01, 0x10])
+    result = Throttle(cpu, clockHz=100000).run()
+    assert(result.reason == RunResult.STOP_TRAP)
+    assert(result.pc == 0x1001)
+
+tests = [
+    testThrottled,
+    testUnthrottled,
+    testMaxSeconds,
+    testStopCondition
+]
+
+def testAll():
+    for test in tests:
+        test()
+        print("test passed: " + test.__name__)
+
+if __name__ == "__main__":
+    testAll()
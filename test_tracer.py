@@ -0,0 +1,182 @@
+import io
+import os
+import tempfile
+import threading
+
+from cpu import CPU, RunResult, StopCondition
+from memory import Memory
+from tracer import Tracer, readTrace, PATCHED
+
+# LDX #3, loop: DEX, BNE loop, JMP $1005
+loopProgram = [0xA2, 0x03, 0xCA, 0xD0, 0xFD, 0x4C, 0x05, 0x10]
+
+def makeCpu():
+    memory = Memory()
+    cpu = CPU(memory)
+    cpu.reset()
+    memory.setBytes(0x1000, loopProgram)
+    return cpu
+
+def tempPath():
+    return os.path.join(tempfile.mkdtemp(), "trace.bin")
+
+def testRecordAndDecode():
+    cpu = makeCpu()
+    tracer = Tracer(cpu)
+    result = tracer.run()
+    assert(result.reason == RunResult.STOP_TRAP)
+    assert(result.instructions == 8)
+
+    path = tempPath()
+    tracer.save(path)
+    records = list(readTrace(path))
+    assert([record.pc for record in records] == [0x1000, 0x1002, 0x1003, 0x1002, 0x1003, 0x1002, 0x1003, 0x1005])
+    # registers and cycles before each instruction
+    assert(records[0].cycles == 8 and records[0].opcode == 0xA2 and records[0].operand1 == 0x03)
+    assert(records[1].cycles == 10 and records[1].x == 3)
+    assert(records[-1].x == 0 and records[-1].p & 0x02)
+    assert(records[-1].operand1 == 0x05 and records[-1].operand2 == 0x10)
+
+def testRingKeepsLatest():
+    cpu = makeCpu()
+    tracer = Tracer(cpu, capacity=4096)
+    tracer.run(StopCondition(trap=False), maxInstructions=5000)
+    records = tracer.records()
+    assert(len(records) == 4096)
+    assert(records[-1][0] == 0x1005)
+
+def testIncrementalFlush():
+    cpu = makeCpu()
+    tracer = Tracer(cpu)
+    file = io.BytesIO()
+    tracer.run(maxInstructions=3)
+    assert(tracer.flush(file) == 3)
+    tracer.run(maxInstructions=2)
+    assert(tracer.flush(file) == 2)
+    assert(tracer.flush(file) == 0)
+
+    # patching the code before it is encoded flags the record, which keeps the bytes which ran
+    tracer.run(maxInstructions=1)
+    cpu._memory.setByte(0x1002, 0xEA)
+    data = tracer.encode(tracer.records()[-1:])
+    assert(data[10] == 0xCA and data[-1] == PATCHED)
+    tracer.run(maxInstructions=1)
+    cpu._memory.setByte(0x1004, 0x00)
+    data = tracer.encode(tracer.records()[-1:])
+    assert(data[10:13] == bytes([0xD0, 0xFD, 0x00]) and data[-1] == PATCHED)
+
+def testStreaming():
+    cpu = makeCpu()
+    tracer = Tracer(cpu, capacity=4096)
+    path = tempPath()
+    tracer.startStreaming(path)
+    tracer.run(StopCondition(trap=False), maxInstructions=20000)
+    tracer.stopStreaming()
+    assert(sum(1 for record in readTrace(path)) + tracer.dropped == 20000)
+
+def makeHookedCpu(hook):
+    memory = Memory()
+    cpu = CPU(memory)
+    cpu.reset()
+    # LDX #0, loop: STA $D000, DEX, BNE loop, JMP $1000
+    memory.setBytes(0x1000, [0xA2, 0x00, 0x8D, 0x00, 0xD0, 0xCA, 0xD0, 0xFA, 0x4C, 0x00, 0x10])
+    memory.addWriteHook(0xD0, hook)
+    return cpu
+
+def testFlushWhileLapping():
+    condition = StopCondition(trap=False)
+    reference = Tracer(makeHookedCpu(lambda addr, val: None), capacity=8192)
+    reference.run(condition, maxInstructions=6000)
+    expected = reference.records()
+
+    # the CPU thread is stopped in the middle of a batch, after it lapped the ring (about 4800 instructions)
+    paused = threading.Event()
+    resume = threading.Event()
+    stores = []
+    def hook(addr, val):
+        stores.append(val)
+        if len(stores) == 1600:
+            paused.set()
+            resume.wait()
+    tracer = Tracer(makeHookedCpu(hook), capacity=4096)
+    thread = threading.Thread(target=tracer.run, args=(condition, 6000))
+    thread.start()
+    paused.wait()
+    file = io.BytesIO()
+    tracer.flush(file)
+    resume.set()
+    thread.join()
+    tracer.flush(file)
+    # the lapped records are dropped, the rest written as they ran
+    assert(tracer.dropped > 0)
+    assert(file.getvalue() == reference.encode(expected[tracer.dropped:]))
+
+    # the ring is lapped between flush reading the count and copying the records
+    tracer = Tracer(makeHookedCpu(lambda addr, val: None), capacity=4096)
+    tracer.run(condition, maxInstructions=3000)
+    copy = tracer._copy
+    def lappingCopy(start, end):
+        tracer.run(condition, maxInstructions=3000)
+        return copy(start, end)
+    tracer._copy = lappingCopy
+    file = io.BytesIO()
+    written = tracer.flush(file)
+    del tracer._copy
+    written += tracer.flush(file)
+    assert(written + tracer.dropped == 6000 and tracer.dropped >= 6000 - 4096)
+    assert(file.getvalue() == reference.encode(expected[tracer.dropped:]))
+
+def makeTimerMachine():
+    memory = Memory()
+    cpu = CPU(memory)
+    cpu.reset()
+    # CLI, loop: JMP loop; IRQ: INC $40, STA $D000 (acknowledge), RTI
+    memory.setBytes(0x1000, [0x58, 0x4C, 0x01, 0x10])
+    memory.setBytes(0x2000, [0xE6, 0x40, 0x8D, 0x00, 0xD0, 0x40])
+    memory.setBytes(0xFFFE, [0x00, 0x20])
+    def tick(cycle):
+        cpu.assertIRQ("timer")
+        cpu.scheduler.at(cycle + 1000, tick)
+    cpu.scheduler.after(1000, tick)
+    memory.addWriteHook(0xD0, lambda addr, val: cpu.releaseIRQ("timer"))
+    return cpu, memory
+
+def runState(cpu, result):
+    return (result.reason, result.pc, result.instructions, result.cycles, cpu.a, cpu.sp, cpu.p, cpu._memory.snapshot())
+
+def testInterrupts():
+    cpu, memory = makeTimerMachine()
+    expected = runState(cpu, cpu.runUntil(StopCondition(trap=False), maxCycles=10500))
+
+    cpu, memory = makeTimerMachine()
+    tracer = Tracer(cpu)
+    assert(runState(cpu, tracer.run(StopCondition(trap=False), maxCycles=10500)) == expected)
+    records = tracer.records()
+    assert(len(records) == expected[2])
+    assert(sum(1 for record in records if record[0] == 0x2000) == 10)
+    # the handler is entered with I set and returns to the loop
+    assert(all(record[7] & 0x04 for record in records if record[0] == 0x2000))
+
+    # skipped idle iterations are recorded as if they had run: instrumentation disables fast-forwarding
+    cpu, memory = makeTimerMachine()
+    cpu.enableInstrumentation()
+    emulated = Tracer(cpu)
+    emulated.run(StopCondition(trap=False), maxCycles=10500)
+    assert(emulated.records() == records)
+
+tests = [
+    testRecordAndDecode,
+    testRingKeepsLatest,
+    testIncrementalFlush,
+    testStreaming,
+    testFlushWhileLapping,
+    testInterrupts
+]
+
+def testAll():
+    for test in tests:
+        test()
+        print("test passed: " + test.__name__)
+
+if __name__ == "__main__":
+    testAll()
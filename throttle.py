@@ -0,0 +1,96 @@
+import time
+
+from cpu import RunResult
+
+class DriftStats:
+    '''
+    Drift is wall time minus emulated time (clock cycles / clockHz) since the throttle started or last resynced.
+    Positive drift means the emulation is behind, negative means it is ahead (and the throttle sleeps).
+    '''
+    def __init__(self):
+        self.samples = 0
+        self.totalDrift = 0.0
+        self.maxAhead = 0.0
+        self.maxBehind = 0.0
+        self.sleeps = 0
+        self.sleepTime = 0.0
+        self.resyncs = 0
+
+    def record(self, drift):
+        self.samples += 1
+        self.totalDrift += drift
+        if drift < 0: self.maxAhead = max(self.maxAhead, -drift)
+        else: self.maxBehind = max(self.maxBehind, drift)
+
+    def meanDrift(self):
+        return self.totalDrift / self.samples if self.samples else 0.0
+
+    def __str__(self):
+        return "drift: mean {mean:.1f}us, max ahead {ahead:.1f}us, max behind {behind:.1f}us, {sleeps} sleeps ({sleepTime:.3f}s), {resyncs} resyncs".format(
+            mean = self.meanDrift() * 1000000, ahead = self.maxAhead * 1000000, behind = self.maxBehind * 1000000,
+            sleeps = self.sleeps, sleepTime = self.sleepTime, resyncs = self.resyncs)
+
+class Throttle:
+    '''
+    Runs a CPU at clockHz without busy waiting:
+    executes sliceSeconds worth of clock cycles with CPU.runUntil, compares the cycles run so far against wall time
+    and sleeps only while the emulation is ahead.
+    clockHz=None runs unthrottled (but still in slices, so maxSeconds works).
+    If the emulation falls behind by more than maxLag seconds (host too slow, process suspended),
+    the throttle resyncs instead of trying to catch up with a burst.
+    '''
+    def __init__(self, cpu, clockHz=1000000, sliceSeconds=0.001, maxLag=0.1):
+        self._cpu = cpu
+        self.clockHz = clockHz
+        self.sliceSeconds = sliceSeconds
+        self.maxLag = maxLag
+        self.stats = DriftStats()
+
+    def _sliceCycles(self):
+        if self.clockHz is None: return 10000
+        return max(1, int(self.clockHz * self.sliceSeconds))
+
+    def run(self, condition=None, maxCycles=None, maxSeconds=None):
+        '''
+        Runs slices until condition (see CPU.runUntil) is met, maxCycles clock cycles ran or maxSeconds passed.
+        Returns a RunResult covering the whole run.
+        '''
+        cpu = self._cpu
+        clockHz = self.clockHz
+        sliceCycles = self._sliceCycles()
+        stats = self.stats
+
+        beginTime = time.perf_counter()
+        syncTime = beginTime
+        syncCycles = 0
+        instructions = 0
+        cycles = 0
+
+        while True:
+            batch = sliceCycles if maxCycles is None else min(sliceCycles, maxCycles - cycles)
+            result = cpu.runUntil(condition, maxCycles=batch)
+            instructions += result.instructions
+            cycles += result.cycles
+
+            reason = result.reason
+            if reason != RunResult.STOP_MAX_CYCLES: break
+            if maxCycles is not None and cycles >= maxCycles: break
+
+            now = time.perf_counter()
+            if clockHz is not None:
+                drift = (now - syncTime) - (cycles - syncCycles) / clockHz
+                stats.record(drift)
+                if drift < 0:
+                    time.sleep(-drift)
+                    stats.sleeps += 1
+                    stats.sleepTime += -drift
+                elif drift > self.maxLag:
+                    syncTime = now
+                    syncCycles = cycles
+                    stats.resyncs += 1
+
+            if maxSeconds is not None and now - beginTime >= maxSeconds:
+                reason = RunResult.STOP_MAX_TIME
+                break
+
+        return RunResult(reason, cpu.pc, instructions, cycles, time.perf_counter() - beginTime)
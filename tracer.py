@@ -0,0 +1,298 @@
+'''
+Instruction trace recorder and decoder.
+
+Tracer.run works like CPU.runUntil (events, interrupts and all), recording PC, op-code, operand, A, X, Y, SP, P and the clock cycle count before every
+instruction into a preallocated ring buffer of the last capacity instructions. Records are encoded into a compact
+binary file on demand (flush) or continuously from a background thread (startStreaming).
+
+Decode a trace file with
+python tracer.py trace.bin [--limit N]
+'''
+import argparse
+import struct
+import sys
+import threading
+import time
+
+from blockcache import instructionLengths
+from cpu import StopCondition, RunResult, UnimplementedInstruction
+from flags import ZN, znFlags
+
+MAGIC = b"6502TRC1"
+recordStruct = struct.Struct("<QHBBBBBBBBB")
+"""
+One instruction: cycles, PC, op-code, 2 operand bytes, A, X, Y, SP, P, recordFlags. 20 bytes, little endian.
+"""
+
+PATCHED = 0b00000001
+"""
+Record flag: the instruction at PC (op-code or operand bytes) had changed by the time the record was encoded.
+The record holds the bytes which ran.
+"""
+
+operandMasks = [(0, 0, 0xFF, 0xFFFF)[length] for length in instructionLengths]
+"""
+op-code -> mask of the operand bytes of its instruction, as a little endian word
+"""
+
+encodeChunk = 4096
+_chunkStructs = {}
+
+def chunkStruct(records):
+    '''
+    returns a Struct packing records consecutive records in one call
+    '''
+    chunk = _chunkStructs.get(records)
+    if chunk is None:
+        chunk = _chunkStructs[records] = struct.Struct("<" + recordStruct.format[1:] * records)
+    return chunk
+
+class TraceRecord:
+    __slots__ = ("cycles", "pc", "opcode", "operand1", "operand2", "a", "x", "y", "sp", "p", "recordFlags")
+
+    def __init__(self, *fields):
+        for name, value in zip(self.__slots__, fields): setattr(self, name, value)
+
+    def __str__(self):
+        status = "".join(name if self.p & (0x80 >> i) else "-" for i, name in enumerate("NV-BDIZC"))
+        return "{cycles:>10} {pc:04X}  {opcode:02X} {operand1:02X} {operand2:02X}  A={a:02X} X={x:02X} Y={y:02X} SP={sp:02X} P={status}{patched}".format(
+            cycles = self.cycles, pc = self.pc, opcode = self.opcode, operand1 = self.operand1, operand2 = self.operand2,
+            a = self.a, x = self.x, y = self.y, sp = self.sp, status = status, patched = " (patched)" if self.recordFlags & PATCHED else "")
+
+class Tracer:
+    '''
+    Records the instructions a CPU runs through Tracer.run. capacity is rounded up to a multiple of 4096 records.
+
+    Recording costs one tuple of the operand and the raw registers per instruction (P is only put together from
+    the CPU's flag fields when records are encoded), which keeps tracing cheap. Code patched between execution
+    and encoding is flagged PATCHED. With streaming, records older than capacity instructions which the background
+    thread couldn't write in time are counted in dropped.
+    '''
+    def __init__(self, cpu, capacity=65536):
+        self._cpu = cpu
+        self.capacity = -(-capacity // 4096) * 4096
+        self._ring = [None] * self.capacity
+        """
+        (pc, opcode, operand, a, x, y, sp, _p, _zn, cycles) per instruction, _p and _zn as in CPU
+        """
+        self._count = 0
+        """
+        records written so far, published after every record
+        """
+        self._flushed = 0
+        """
+        records flushed (or dropped) so far
+        """
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._stream = None
+        self._thread = None
+        self._stopEvent = threading.Event()
+
+    def run(self, condition=None, maxInstructions=None, maxCycles=None):
+        '''
+        CPU.runUntil with tracing, one instruction at a time (the block cache isn't used). Scheduler events,
+        interrupts and idle loops are handled like in runUntil. The iterations of an idle loop which are skipped
+        are recorded all the same (the last capacity of them), as they would have run. Returns a RunResult.
+        '''
+        cpu = self._cpu
+        if condition is None: condition = StopCondition()
+        cpu._optimizeDecodeLut()
+        cpu._clockCyclesThisCycle = 0
+        beginTime = time.perf_counter()
+        try:
+            reason, instructions = cpu._runBatches(self._runBatch, condition, maxInstructions, maxCycles, self._recordIdle)
+        finally:
+            cycles = cpu._clockCyclesThisCycle
+            cpu._clockCyclesThisCycle = 0
+            cpu._clockCycle += cycles
+        return RunResult(reason, cpu.pc, instructions, cycles, time.perf_counter() - beginTime)
+
+    def _runBatch(self, condition, instructionLimit, cycleLimit, fastForward):
+        '''
+        CPU._runInstructionsUntil, recording every instruction. Returns (reason, instructions executed)
+        '''
+        cpu = self._cpu
+        lut = cpu._decodeFunctionLookupTable
+        fetch = cpu._memory.fetchByte
+        lengths = instructionLengths
+        trap = condition.trap
+        breakpointMap = condition.breakpointMap
+        brk = condition.brk
+
+        ring = self._ring
+        capacity = self.capacity
+        # count stands in for the instruction counter (instructions = count - start)
+        start = count = self._count
+        end = start + instructionLimit
+        clockBase = cpu._clockCycle
+        cpu._idleSample = None
+
+        try:
+            while True:
+                pc = cpu.pc
+                if breakpointMap[pc]: return RunResult.STOP_BREAKPOINT, count - start
+                opcode = fetch(pc)
+                if opcode == 0x00 and brk: return RunResult.STOP_BRK, count - start
+
+                length = lengths[opcode]
+                if length == 2: operand = fetch((pc + 1) & 0xFFFF)
+                elif length == 3: operand = fetch((pc + 1) & 0xFFFF) | fetch((pc + 2) & 0xFFFF) << 8
+                else: operand = 0
+
+                ring[count % capacity] = (pc, opcode, operand, cpu.a, cpu.x, cpu.y, cpu.sp, cpu._p, cpu._zn, clockBase + cpu._clockCyclesThisCycle)
+                count += 1
+                self._count = count
+                cpu.pc = (pc + length) & 0xFFFF
+                lut[opcode](operand)
+
+                if cpu.pc == pc:
+                    if trap: return RunResult.STOP_TRAP, count - start
+                    if fastForward and cpu._isIdle(pc, count, 1): return RunResult.IDLE, count - start
+                if count >= end: return RunResult.STOP_MAX_INSTRUCTIONS, count - start
+                if cpu._clockCyclesThisCycle >= cycleLimit: return RunResult.STOP_MAX_CYCLES, count - start
+        except UnimplementedInstruction:
+            # recorded, but not executed
+            return RunResult.STOP_UNIMPLEMENTED, count - start - 1
+
+    def _recordIdle(self, iterations):
+        '''
+        records the iterations of the idle loop of one instruction at PC (see CPU._isIdle) which run is about to skip.
+        Only the last capacity of them can be kept; older ones count as written (and dropped if not flushed).
+        '''
+        cpu = self._cpu
+        iterationCycles = cpu._idleIteration[0]
+        clock = cpu._clockCycle + cpu._clockCyclesThisCycle
+        pc = cpu.pc
+        fetch = cpu._memory.fetchByte
+        opcode = fetch(pc)
+        operand = (fetch((pc + 1) & 0xFFFF) | fetch((pc + 2) & 0xFFFF) << 8) & operandMasks[opcode]
+        state = (pc, opcode, operand, cpu.a, cpu.x, cpu.y, cpu.sp, cpu._p, cpu._zn)
+        ring = self._ring
+        capacity = self.capacity
+        # under the lock: flush mustn't copy slots ahead of _count before it covers them
+        with self._lock:
+            count = self._count
+            for i in range(max(0, iterations - capacity), iterations):
+                ring[(count + i) % capacity] = state + (clock + i * iterationCycles,)
+            self._count = count + iterations
+
+    def records(self):
+        '''
+        returns the buffered records (at most capacity, oldest first) as raw tuples, without flushing them
+        '''
+        count = self._count
+        start = max(0, count - self.capacity)
+        return self._copy(start, count)
+
+    def _copy(self, start, end):
+        '''
+        copies the raw records start to end out of the ring, each slice in one (GIL-atomic) list copy
+        '''
+        capacity = self.capacity
+        first = start % capacity
+        length = end - start
+        if first + length <= capacity: return self._ring[first:first + length]
+        return self._ring[first:] + self._ring[:first + length - capacity]
+
+    def encode(self, records):
+        '''
+        returns records (raw tuples) encoded as consecutive recordStruct bytes
+        '''
+        # one copy of memory instead of three getByte calls per record; the first bytes are repeated so pc + 2 wraps
+        image = self._cpu._memory.snapshot()
+        image += image[:2]
+        masks = operandMasks
+        chunks = []
+        for chunkStart in range(0, len(records), encodeChunk):
+            chunk = records[chunkStart:chunkStart + encodeChunk]
+            values = []
+            extend = values.extend
+            for pc, opcode, operand, a, x, y, sp, p, zn, cycles in chunk:
+                patched = image[pc] != opcode or (image[pc + 1] | image[pc + 2] << 8) & masks[opcode] != operand
+                extend((cycles, pc, opcode, operand & 0xFF, operand >> 8, a, x, y, sp, (p & ~ZN) | znFlags[zn],
+                        PATCHED if patched else 0))
+            chunks.append(chunkStruct(len(chunk)).pack(*values))
+        return b"".join(chunks)
+
+    def flush(self, file):
+        '''
+        writes the records recorded since the last flush to the binary file object file (write the header first,
+        see writeHeader). Returns the number of records written.
+        '''
+        with self._lock:
+            count = self._count
+            start = max(self._flushed, count - self.capacity)
+            self.dropped += start - self._flushed
+            records = self._copy(start, count)
+            # the CPU thread may have lapped the ring while we copied: up to _count records, and maybe the one
+            # it is writing, are in the ring now
+            overwritten = min(len(records), max(0, self._count + 1 - self.capacity - start))
+            if overwritten:
+                records = records[overwritten:]
+                self.dropped += overwritten
+            self._flushed = count
+        file.write(self.encode(records))
+        return len(records)
+
+    def startStreaming(self, path, interval=0.01):
+        '''
+        starts a background thread flushing to a new trace file at path every interval seconds
+        '''
+        self._stream = open(path, "wb")
+        writeHeader(self._stream)
+        self._stopEvent.clear()
+        self._thread = threading.Thread(target=self._streamLoop, args=(interval,), daemon=True)
+        self._thread.start()
+
+    def _streamLoop(self, interval):
+        while not self._stopEvent.wait(interval):
+            self.flush(self._stream)
+
+    def stopStreaming(self):
+        '''
+        stops the background thread, flushes the remaining records and closes the file
+        '''
+        self._stopEvent.set()
+        self._thread.join()
+        self.flush(self._stream)
+        self._stream.close()
+        self._stream = self._thread = None
+
+    def save(self, path):
+        '''
+        writes the buffered records to a new trace file
+        '''
+        with open(path, "wb") as file:
+            writeHeader(file)
+            file.write(self.encode(self.records()))
+
+def writeHeader(file):
+    file.write(MAGIC + struct.pack("<H", recordStruct.size))
+
+def readTrace(path):
+    '''
+    yields the TraceRecords of a trace file
+    '''
+    with open(path, "rb") as file:
+        header = file.read(len(MAGIC) + 2)
+        if header[:len(MAGIC)] != MAGIC: raise ValueError(path + " is not a trace file")
+        (recordSize,) = struct.unpack("<H", header[len(MAGIC):])
+        while True:
+            chunk = file.read(recordSize * 4096)
+            if not chunk: break
+            for fields in struct.iter_unpack("<" + recordStruct.format[1:] + "x" * (recordSize - recordStruct.size), chunk):
+                yield TraceRecord(*fields)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="decode a binary instruction trace")
+    parser.add_argument("trace")
+    parser.add_argument("--limit", type=int, help="only print the first LIMIT records")
+    args = parser.parse_args(argv)
+    for i, record in enumerate(readTrace(args.trace)):
+        if args.limit is not None and i >= args.limit: break
+        print(record)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))